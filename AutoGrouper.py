@@ -0,0 +1,336 @@
+"""AutoGrouper
+
+Automatic grouping of contours by template matching, the 'z' command in MatchSymbols.
+
+The image is dilated once, and the template matching for each ungrouped contour is farmed out to a thread pool
+(OpenCV releases the GIL inside matchTemplate) or a process pool. Results are applied to the ContourContainer in
+index order on the calling thread, so the groups come out the same as the one-at-a-time loop, whatever the number of
+workers. BackgroundGrouping does the matching on a background thread instead, so MatchSymbols can keep drawing while
+it applies the results a few at a time.
+
+Run this file directly to see how throughput scales with the number of workers:
+    python AutoGrouper.py Inputs/DetBwMod.png --workers 1 2 4 8
+"""
+import dataclasses
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ContourContainer import ContourContainer
+from Matching import dilate_image, match_peaks, match_pyramid, match_size_candidates, points_to_indices
+
+
+@dataclasses.dataclass
+class AutoGroupStats:
+    matched: int = 0        # Contours that were used as a template
+    skipped: int = 0        # Matched speculatively, but grouped by an earlier contour before the result was applied
+    workers: int = 1
+    seconds: float = 0.0
+
+    @property
+    def contours_per_second(self) -> float:
+        return (self.matched + self.skipped) / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        return (f"{self.matched} contours matched ({self.skipped} wasted) in {self.seconds:.2f}s with {self.workers} "
+                f"workers, {self.contours_per_second:.1f} contours/s")
+
+
+def apply_matches(contours: ContourContainer, index: int, matches) -> bool:
+    """
+    Start a new group with contour index and every box that matched it
+    :param matches: (N, 2) array like of match center points
+    :return: False if the matches were thrown away as garbage
+    """
+    if len(matches) > contours.length:     # Probably garbage
+        return False
+    apply_match_indices(contours, index, points_to_indices(contours, matches))
+    return True
+
+
+def apply_match_indices(contours: ContourContainer, index: int, match_indices) -> int:
+    """
+    Start a new group with contour index and the matching contours. Contours that already have a group have their
+    group merged in, rather than being taken out of it
+    :return: Id of the new group
+    """
+    new_group = contours.max_group + 1
+    contours.set_group(new_group, index=index)
+    for match_index in match_indices:
+        match_group = contours.get_group(index=match_index)
+        if match_group == 0:
+            contours.set_group(new_group, index=match_index)
+        else:
+            new_group = contours.merge_groups(new_group, match_group)
+    return new_group
+
+
+# Each worker process gets its own copy of the dilated image once, instead of one per task
+_worker_image = None
+
+
+def _init_worker(image):
+    global _worker_image
+    _worker_image = image
+
+
+def _match(image, rect: Sequence[int], candidates: Optional[np.ndarray], thresh_val: float,
+           pyramid_levels: int = 0, pyramid_slack: float = 0.3) -> np.ndarray:
+    """Match points over the whole image, or with candidate boxes, which candidates matched"""
+    if candidates is not None:
+        return match_size_candidates(image, rect, candidates, thresh_val)
+    if pyramid_levels:
+        return match_pyramid(image, rect, thresh_val, pyramid_levels, pyramid_slack)
+    return match_peaks(image, rect, thresh_val)
+
+
+def _match_in_worker(rect: Sequence[int], candidates: Optional[np.ndarray], thresh_val: float,
+                     pyramid_levels: int = 0, pyramid_slack: float = 0.3) -> np.ndarray:
+    return _match(_worker_image, rect, candidates, thresh_val, pyramid_levels, pyramid_slack)
+
+
+class AutoGrouper:
+    """Group every ungrouped contour in a container with the boxes its template matches
+
+    :param thresh_val: Minimum TM_CCOEFF_NORMED score for a match
+    :param workers: Pool size, defaults to the number of cores
+    :param use_processes: Use a process pool instead of threads
+    :param chunk_size: Contours sent to the pool at a time. Contours grouped by an earlier result in the same chunk
+        were matched for nothing, so smaller chunks waste less work but keep the pool less busy. Defaults to 4 per worker
+    :param kernel_size: Dilation kernel, same as get_matches_from_rect
+    :param size_tolerance: If set, a template is only scored against the boxes of about its size (see
+        ContourContainer.get_indices_by_size), instead of over the whole image
+    :param pyramid_levels: When matching over the whole image, find candidates on an image halved this many times
+        and only refine those at full resolution (see Matching.pyramid_scores). 0 matches at full resolution only
+    :param pyramid_slack: How far under thresh_val a coarse score can be and still be refined. Matches whose coarse
+        scores are all lower than that are lost
+    """
+    def __init__(self, thresh_val: float = 0.7, workers: Optional[int] = None, use_processes: bool = False,
+                 chunk_size: Optional[int] = None, kernel_size: Sequence[int] = (2, 2),
+                 size_tolerance: Optional[float] = None, pyramid_levels: int = 0,
+                 pyramid_slack: float = 0.3):
+        self.thresh_val = thresh_val
+        self.size_tolerance = size_tolerance
+        self.pyramid_levels = pyramid_levels
+        self.pyramid_slack = pyramid_slack
+        self.workers = workers or os.cpu_count() or 1
+        self.use_processes = use_processes
+        self.chunk_size = chunk_size or 4 * self.workers
+        self.kernel_size = kernel_size
+
+    def _make_pool(self, image) -> Executor:
+        if self.use_processes:
+            return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(image,))
+        return ThreadPoolExecutor(max_workers=self.workers)
+
+    def match_ungrouped(self, gray, contours: ContourContainer, stats: AutoGroupStats,
+                        stop: Optional[threading.Event] = None,
+                        image: Optional[np.ndarray] = None) -> Iterator[Tuple[int, Optional[np.ndarray]]]:
+        """
+        Match the ungrouped contours, without changing the container
+        The caller applies each result with apply_match_indices, in the order they come. Which contours are still
+        ungrouped is tracked here from the results, rather than read back from the container, so the results are the
+        same however far behind the caller applies them. Only the boxes and the point and size indexes are read, which
+        grouping doesn't change, so this can run on another thread while the caller applies results.
+        :param stop: Stop early once this is set
+        :param image: gray dilated with this grouper's kernel_size, if already made
+        :return: (index, matching contour indices) for each contour used as a template, or (index, None) when its
+            matches were thrown away as garbage and it stays ungrouped
+        """
+        if image is None:
+            image = dilate_image(gray, self.kernel_size)
+        if self.use_processes:
+            match = partial(_match_in_worker, thresh_val=self.thresh_val, pyramid_levels=self.pyramid_levels,
+                            pyramid_slack=self.pyramid_slack)
+        else:
+            match = partial(_match, image, thresh_val=self.thresh_val, pyramid_levels=self.pyramid_levels,
+                            pyramid_slack=self.pyramid_slack)
+        # Grouping doesn't add or remove boxes, so the boxes can be looked up once
+        all_boxes = contours.get_box_array(all=True)
+        length = len(all_boxes)
+        grouped = contours.get_group_array() != 0
+
+        with self._make_pool(image) as pool:
+            next_index = 0
+            while next_index < length and not (stop is not None and stop.is_set()):
+                end = min(next_index + self.chunk_size, length)
+                chunk = [index for index in range(next_index, end) if not grouped[index]]
+                next_index = end
+                rects = [all_boxes[index] for index in chunk]
+                if self.size_tolerance is None:
+                    candidates = [None] * len(chunk)
+                else:
+                    candidates = [contours.get_indices_by_size(w, h, self.size_tolerance) for _, _, w, h in rects]
+                boxes = [None if found is None else all_boxes[found] for found in candidates]
+                for index, found, matches in zip(chunk, candidates, pool.map(match, rects, boxes)):
+                    if grouped[index]:
+                        stats.skipped += 1
+                        continue
+                    stats.matched += 1
+                    if found is not None:
+                        found = found[matches]
+                        indices = found[found != index]
+                    elif len(matches) > length:     # Probably garbage, same as apply_matches
+                        yield index, None
+                        continue
+                    else:
+                        indices = points_to_indices(contours, matches)
+                    grouped[index] = True
+                    grouped[indices] = True
+                    yield index, indices
+
+    def run(self, gray, contours: ContourContainer, image: Optional[np.ndarray] = None) -> AutoGroupStats:
+        """
+        Group the contours in place, and return how long it took
+        :param image: gray dilated with this grouper's kernel_size, if already made
+        """
+        stats = AutoGroupStats(workers=self.workers)
+        start = time.perf_counter()
+        for index, indices in self.match_ungrouped(gray, contours, stats, image=image):
+            if indices is not None:
+                apply_match_indices(contours, index, indices)
+        stats.seconds = time.perf_counter() - start
+        return stats
+
+
+class BackgroundGrouping:
+    """Runs an AutoGrouper on a background thread, for the caller to apply the results a few at a time
+
+    Call start(), then apply() regularly from the thread that owns the container, until finished. The container must
+    not be changed in any other way until then. The groups come out the same as AutoGrouper.run, however the applying
+    is spread out, paused or cut short: cancelling leaves the groups of the contours applied so far.
+    :param image: gray dilated with the grouper's kernel_size, if already made
+    """
+    def __init__(self, grouper: AutoGrouper, gray, contours: ContourContainer, image: Optional[np.ndarray] = None):
+        self.grouper = grouper
+        self.gray = gray
+        self.image = image
+        self.contours = contours
+        self.stats = AutoGroupStats(workers=grouper.workers)
+        self.finished = False
+        # Last contour index applied, for progress
+        self.position = 0
+        self._results = queue.SimpleQueue()
+        self._stop = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._start = 0.0
+
+    def start(self):
+        # Build the lazy point and size indexes here, not on the worker while the caller may be querying them too
+        self.contours.get_indices_by_points(np.empty((0, 2), dtype=np.int32))
+        self.contours.get_indices_by_size(1, 1)
+        self._start = time.perf_counter()
+        self._thread.start()
+
+    def _work(self):
+        try:
+            for result in self.grouper.match_ungrouped(self.gray, self.contours, self.stats, stop=self._stop,
+                                                       image=self.image):
+                self._running.wait()
+                if self._stop.is_set():
+                    break
+                self._results.put(result)
+        finally:
+            self._results.put(None)
+
+    @property
+    def paused(self) -> bool:
+        return not self._running.is_set()
+
+    def pause(self):
+        """Stop matching and applying until resume()"""
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def cancel(self):
+        """Stop matching. Results not applied yet are dropped, wait() for the worker to finish"""
+        self._stop.set()
+        self._running.set()
+
+    def wait(self):
+        self._thread.join()
+        self.finished = True
+        self.stats.seconds = time.perf_counter() - self._start
+
+    def apply(self, max_seconds: float = 0.02) -> int:
+        """
+        Apply the results that are ready, for up to max_seconds
+        :return: Number of contours applied
+        """
+        if self.finished or self.paused:
+            return 0
+        deadline = time.perf_counter() + max_seconds
+        applied = 0
+        while time.perf_counter() < deadline:
+            if self._stop.is_set():
+                self.wait()
+                break
+            try:
+                result = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if result is None:
+                self.wait()
+                break
+            index, indices = result
+            if indices is not None:
+                apply_match_indices(self.contours, index, indices)
+            self.position = index
+            applied += 1
+        return applied
+
+    @property
+    def progress(self) -> float:
+        """Fraction of the contours gone through"""
+        return 1.0 if self.finished else (self.position + 1) / max(self.contours.length, 1)
+
+
+if __name__ == "__main__":
+    import argparse
+    from SymbolPipeline import get_contours, load_image, new_container
+
+    parser = argparse.ArgumentParser(description='Time automatic grouping of a black and white symbol image.')
+    parser.add_argument('image', help='Black and white image, symbols in white')
+    parser.add_argument('--workers', help='Worker counts to try', nargs='+', type=int, default=[1, os.cpu_count()])
+    parser.add_argument('--processes', help='Use a process pool instead of threads', action='store_true')
+    parser.add_argument('--thresh', help='Match threshold', type=float, default=0.7)
+    parser.add_argument('--size-tolerance', help='Only match boxes of about the same size', type=float, default=None)
+    parser.add_argument('--pyramid-levels', help='Coarse to fine matching levels', type=int, default=0)
+    parser.add_argument('--pyramid-slack', help='How far under the threshold a coarse match can score and still be '
+                        'refined', type=float, default=0.3)
+    parser.add_argument('--compare', help='Then group once over the whole image and once with this size tolerance, '
+                        'and compare the groups', type=float, default=None)
+    args = parser.parse_args()
+
+    _, gray = load_image(args.image)
+    for workers in args.workers:
+        contour_container = new_container(gray)
+        get_contours(gray, contour_container)
+        grouper = AutoGrouper(thresh_val=args.thresh, workers=workers, use_processes=args.processes,
+                              size_tolerance=args.size_tolerance, pyramid_levels=args.pyramid_levels,
+                              pyramid_slack=args.pyramid_slack)
+        print(grouper.run(gray, contour_container))
+
+    if args.compare is not None:
+        from FeatureGrouping import rand_index
+        results = []
+        for size_tolerance in (None, args.compare):
+            contour_container = new_container(gray)
+            get_contours(gray, contour_container)
+            AutoGrouper(thresh_val=args.thresh, size_tolerance=size_tolerance).run(gray, contour_container)
+            groups = contour_container.get_group_array()
+            results.append(groups)
+            print(f"{'whole image' if size_tolerance is None else f'size tolerance {size_tolerance}'}: "
+                  f"{len(np.unique(groups[groups != 0]))} groups")
+        agreement = rand_index(*results)
+        print(f"Rand index between the two: {agreement:.3f}, {'the same' if agreement == 1 else 'different'} groups")
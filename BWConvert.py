@@ -5,12 +5,22 @@ Initially copied from OpenCV help docs, heavily modified
 
 Pressing 's' will save the image to saved_image.png, pressing 'q' will quit
 
+A still image is only thresholded again when a trackbar moves, and only in the channel that changed.
+
+With a camera, capturing, converting and displaying run on their own threads, handing over only the newest frame, so
+a slow stage drops frames instead of falling behind. The frame rate and latency of each stage are printed as it runs.
 """
 
 # Eyedropper says the HSV of the lines is at 20, 100, 18 to 22, 69, 20. HSV of the paper is 31, 32, 73 to 33, 50, 58
 # This shows good detection with range of 11, 55, 149 to 43, 122, 243
 
+import queue
+import threading
+import time
+from typing import Optional
+
 import cv2
+import numpy as np
 
 # Some static parameters
 max_value = 255
@@ -30,6 +40,21 @@ high_H_name = 'High H'
 high_S_name = 'High S'
 high_V_name = 'High V'
 save_file_name = 'saved_image.png'
+# Seconds between printing the pipeline stats
+stats_interval = 2.0
+# For a still image, wait until the trackbars have been still this long before thresholding again, but don't leave
+# the image out of date for longer than max_stale while one is being dragged
+debounce = 0.03
+max_stale = 0.15
+# Seconds between checking the trackbars while nothing is changing
+idle_poll = 0.1
+# perf_counter time the thresholds last changed
+last_change = 0.0
+
+def thresholds_changed():
+    global last_change
+    last_change = time.perf_counter()
+
 
 # The functions below are linked to the trackbars and called when the values change
 # They interpret the value and make sure we do not get max < min
@@ -39,6 +64,7 @@ def on_low_H_thresh_trackbar(val):
     low_H = val
     low_H = min(high_H - 1, low_H)
     cv2.setTrackbarPos(low_H_name, window_detection_name, low_H)
+    thresholds_changed()
 
 
 def on_high_H_thresh_trackbar(val):
@@ -47,6 +73,7 @@ def on_high_H_thresh_trackbar(val):
     high_H = val
     high_H = max(high_H, low_H + 1)
     cv2.setTrackbarPos(high_H_name, window_detection_name, high_H)
+    thresholds_changed()
 
 
 def on_low_S_thresh_trackbar(val):
@@ -55,6 +82,7 @@ def on_low_S_thresh_trackbar(val):
     low_S = val
     low_S = min(high_S - 1, low_S)
     cv2.setTrackbarPos(low_S_name, window_detection_name, low_S)
+    thresholds_changed()
 
 
 def on_high_S_thresh_trackbar(val):
@@ -63,6 +91,7 @@ def on_high_S_thresh_trackbar(val):
     high_S = val
     high_S = max(high_S, low_S + 1)
     cv2.setTrackbarPos(high_S_name, window_detection_name, high_S)
+    thresholds_changed()
 
 
 def on_low_V_thresh_trackbar(val):
@@ -71,6 +100,7 @@ def on_low_V_thresh_trackbar(val):
     low_V = val
     low_V = min(high_V - 1, low_V)
     cv2.setTrackbarPos(low_V_name, window_detection_name, low_V)
+    thresholds_changed()
 
 
 def on_high_V_thresh_trackbar(val):
@@ -79,6 +109,255 @@ def on_high_V_thresh_trackbar(val):
     high_V = val
     high_V = max(high_V, low_V + 1)
     cv2.setTrackbarPos(high_V_name, window_detection_name, high_V)
+    thresholds_changed()
+
+
+def apply_detection(frame_input, grey: bool, out=None):
+    """Threshold the converted frame with the current trackbar values, into out if it is given"""
+    if grey:
+        # frame_threshold = cv2.adaptiveThreshold(frame_HSV, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
+        #                            cv2.THRESH_BINARY_INV, 11, 2)
+        _, out = cv2.threshold(frame_input, low_H, low_S, cv2.THRESH_BINARY_INV, dst=out)
+        return out
+    return cv2.inRange(frame_input, (low_H, low_S, low_V), (high_H, high_S, high_V), dst=out)
+
+
+class StillThreshold:
+    """Threshold of a still image, kept up to date with the trackbars a channel at a time
+
+    The channels are split once up front and each keeps its own mask, so moving one trackbar is one single channel
+    inRange pass plus ANDing the masks together, all into buffers allocated once. The result is the same as
+    apply_detection. Single channel inRange is used over cv2.LUT with per-channel tables, which is several times
+    slower here.
+    """
+    def __init__(self, frame_input, grey: bool):
+        self.grey = grey
+        self.channels = [frame_input] if grey else cv2.split(frame_input)
+        self.frame_threshold = np.empty_like(self.channels[0])
+        # In grey there is only the one mask, it is the result
+        self.masks = [self.frame_threshold] if grey else [np.empty_like(channel) for channel in self.channels]
+        self._bounds = [None] * len(self.channels)
+
+    def _current_bounds(self):
+        if self.grey:
+            return [(low_H, low_S)]
+        return [(low_H, high_H), (low_S, high_S), (low_V, high_V)]
+
+    def stale(self) -> bool:
+        return self._current_bounds() != self._bounds
+
+    def update(self) -> bool:
+        """Redo the masks of the channels whose bounds changed. :return: False if none had"""
+        bounds = self._current_bounds()
+        changed = [i for i, (new, old) in enumerate(zip(bounds, self._bounds)) if new != old]
+        if not changed:
+            return False
+        for i in changed:
+            if self.grey:
+                cv2.threshold(self.channels[i], bounds[i][0], bounds[i][1], cv2.THRESH_BINARY_INV, dst=self.masks[i])
+            else:
+                cv2.inRange(self.channels[i], bounds[i][0], bounds[i][1], dst=self.masks[i])
+        self._bounds = bounds
+        if not self.grey:
+            cv2.bitwise_and(self.masks[0], self.masks[1], dst=self.frame_threshold)
+            cv2.bitwise_and(self.frame_threshold, self.masks[2], dst=self.frame_threshold)
+        return True
+
+
+def run_still(frame_input, grey: bool):
+    """Show a still image and its threshold until 'q', only doing work when a trackbar moves"""
+    still = StillThreshold(frame_input, grey)
+    still.update()
+    cv2.imshow(window_capture_name, frame_input)
+    cv2.imshow(window_detection_name, still.frame_threshold)
+    stale_since = None
+    while True:
+        # Sleep in waitKey while nothing changes, the trackbar callbacks run inside it
+        key = cv2.waitKey(int((debounce if stale_since is not None else idle_poll) * 1000))
+        if key == ord('s'):
+            cv2.imwrite(save_file_name, still.frame_threshold)
+        if key == ord('q') or key == 27:
+            break
+
+        now = time.perf_counter()
+        if stale_since is None and still.stale():
+            stale_since = now
+        if stale_since is not None and (now - last_change >= debounce or now - stale_since >= max_stale):
+            if still.update():
+                cv2.imshow(window_detection_name, still.frame_threshold)
+            stale_since = None
+
+
+class LatestSlot:
+    """Hands the newest item from one thread to another. Putting replaces an item that was not taken yet"""
+    def __init__(self):
+        self._item = None
+        self._ready = threading.Condition()
+
+    def put(self, item):
+        """:return: The item that was replaced, or None"""
+        with self._ready:
+            replaced, self._item = self._item, item
+            self._ready.notify()
+        return replaced
+
+    def take(self, timeout: Optional[float] = None):
+        """:return: The item, or None if nothing came within timeout"""
+        with self._ready:
+            if self._item is None:
+                self._ready.wait(timeout)
+            item, self._item = self._item, None
+        return item
+
+
+class StageStats:
+    """Frame count, dropped frames and latency of one pipeline stage"""
+    def __init__(self, name: str):
+        self.name = name
+        self.frames = 0
+        self.dropped = 0
+        self.latency = 0.0
+        self._lock = threading.Lock()
+
+    def done(self, since: float):
+        """Count a frame, with its latency from since on the perf_counter clock"""
+        with self._lock:
+            self.frames += 1
+            self.latency += time.perf_counter() - since
+
+    def drop(self):
+        with self._lock:
+            self.dropped += 1
+
+    def report(self, seconds: float) -> str:
+        """Stats since the last report, and start counting again"""
+        with self._lock:
+            frames, dropped, latency = self.frames, self.dropped, self.latency
+            self.frames = self.dropped = 0
+            self.latency = 0.0
+        return (f"{self.name} {frames / seconds:5.1f} fps, {latency / max(frames, 1) * 1000:5.1f} ms"
+                f"{f', {dropped} dropped' if dropped else ''}")
+
+
+class CameraPipeline:
+    """Capture and processing threads for the camera, feeding the display loop
+
+    The frames travel in preallocated buffers. Each stage takes a free buffer, fills it in place and puts it in the
+    next stage's LatestSlot, and a buffer goes back on the free queue once the next stage is done with it or it was
+    replaced by a newer frame. Three buffers per stage cover the one being filled, the one waiting and the one being
+    read, so nothing is allocated per frame and no stage ever waits for a slower one.
+    """
+    def __init__(self, cap, grey: bool):
+        self.cap = cap
+        self.grey = grey
+        self.convert_code = cv2.COLOR_BGR2GRAY if grey else cv2.COLOR_BGR2HSV
+        self.stopped = threading.Event()
+        self.captured = LatestSlot()
+        self.processed = LatestSlot()
+        self.free_frames = queue.SimpleQueue()
+        self.free_results = queue.SimpleQueue()
+        self.capture_stats = StageStats('capture')
+        self.process_stats = StageStats('process')
+        self.display_stats = StageStats('display')
+        self._threads = []
+
+    def start(self) -> bool:
+        """Size the buffers from the first frame and start the threads. False if the camera gives no frames"""
+        ret, frame = self.cap.read()
+        if not ret or frame is None:
+            return False
+        converted = cv2.cvtColor(frame, self.convert_code)
+        for _ in range(3):
+            self.free_frames.put(frame.copy())
+            self.free_results.put((converted.copy(), apply_detection(converted, self.grey)))
+        self._threads = [threading.Thread(target=self._capture, daemon=True),
+                         threading.Thread(target=self._process, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        return True
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self._threads:
+            thread.join()
+
+    def _capture(self):
+        while not self.stopped.is_set():
+            frame = self.free_frames.get()
+            read_at = time.perf_counter()
+            ret, frame = self.cap.read(frame)
+            captured_at = time.perf_counter()
+            if not ret or frame is None:
+                self.stopped.set()
+                break
+            # The capture latency is the time waiting for the camera, the others count from when the frame arrived
+            self.capture_stats.done(read_at)
+            replaced = self.captured.put((frame, captured_at))
+            if replaced is not None:
+                self.process_stats.drop()
+                self.free_frames.put(replaced[0])
+
+    def _process(self):
+        while not self.stopped.is_set():
+            item = self.captured.take(timeout=0.1)
+            if item is None:
+                continue
+            frame, captured_at = item
+            converted, threshold = self.free_results.get()
+            cv2.cvtColor(frame, self.convert_code, dst=converted)
+            self.free_frames.put(frame)
+            apply_detection(converted, self.grey, out=threshold)
+            self.process_stats.done(captured_at)
+            replaced = self.processed.put((converted, threshold, captured_at))
+            if replaced is not None:
+                self.display_stats.drop()
+                self.free_results.put(replaced[:2])
+
+    def take_result(self, timeout: float):
+        """:return: The newest (converted, threshold, captured_at), or None. Hand the buffers back with release()"""
+        return self.processed.take(timeout)
+
+    def release(self, result):
+        self.display_stats.done(result[2])
+        self.free_results.put(result[:2])
+
+    def report(self, seconds: float) -> str:
+        return ' | '.join(stats.report(seconds) for stats in
+                          (self.capture_stats, self.process_stats, self.display_stats))
+
+
+def run_camera(cap, grey: bool):
+    """Show the camera feed and its threshold until 'q', the display loop of a CameraPipeline"""
+    pipeline = CameraPipeline(cap, grey)
+    if not pipeline.start():
+        return
+    frame_threshold = None
+    last_report = time.perf_counter()
+    try:
+        while not pipeline.stopped.is_set():
+            result = pipeline.take_result(timeout=0.03)
+            if result is not None:
+                cv2.imshow(window_capture_name, result[0])
+                cv2.imshow(window_detection_name, result[1])
+                if frame_threshold is None:
+                    frame_threshold = result[1].copy()
+                else:
+                    frame_threshold[:] = result[1]
+                pipeline.release(result)
+
+            now = time.perf_counter()
+            if now - last_report >= stats_interval:
+                print(pipeline.report(now - last_report))
+                last_report = now
+
+            # Respond to key presses
+            key = cv2.waitKey(1)
+            if key == ord('s') and frame_threshold is not None:
+                cv2.imwrite(save_file_name, frame_threshold)
+            if key == ord('q') or key == 27:
+                break
+    finally:
+        pipeline.stop()
 
 
 if __name__ == "__main__":
@@ -116,39 +395,13 @@ if __name__ == "__main__":
     if not args.grey:
         cv2.createTrackbar(high_V_name, window_detection_name, high_V, max_value, on_high_V_thresh_trackbar)
 
-    # If we're not getting the image from a camera, we can just read it in once here
-    if cap is None:
+    if cap is not None:
+        run_camera(cap, args.grey)
+        cap.release()
+    else:
+        # Not getting the image from a camera, we can just read it in once here
         if args.grey:
             frame_input = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
         else:
             frame_input = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-
-    while True:
-        # Read in camera image and convert it to desired format
-        if cap is not None:
-            ret, frame = cap.read()
-            if frame is None:
-                break
-            if args.grey:
-                frame_input = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            else:
-                frame_input = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-        # Apply detection
-        if args.grey:
-            # frame_threshold = cv2.adaptiveThreshold(frame_HSV, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
-            #                            cv2.THRESH_BINARY_INV, 11, 2)
-            _, frame_threshold = cv2.threshold(frame_input, low_H, low_S, cv2.THRESH_BINARY_INV)
-        else:
-            frame_threshold = cv2.inRange(frame_input, (low_H, low_S, low_V), (high_H, high_S, high_V))
-
-        # display image. We could skip the frame input display for static images, but it is cheap and potentially
-        # helpful to update it
-        cv2.imshow(window_capture_name, frame_input)
-        cv2.imshow(window_detection_name, frame_threshold)
-
-        # Respond to key presses
-        key = cv2.waitKey(30)
-        if key == ord('s'):
-            cv2.imwrite(save_file_name, frame_threshold)
-        if key == ord('q') or key == 27:
-            break
+        run_still(frame_input, args.grey)
@@ -0,0 +1,29 @@
+"""BatchFiles
+
+What the batch scripts (SymbolPipeline.py, CodeFinder.py) share: expanding the paths given on the command line into
+images, and setting up the worker processes. Only needs OpenCV, so a script using it doesn't load the grouping stack.
+"""
+import os
+from typing import Iterable, List
+
+import cv2
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+def find_images(paths: Iterable[str]) -> List[str]:
+    """Expand directories into the images they hold, sorted by name. Files are kept as given"""
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            images.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                          if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            images.append(path)
+    return images
+
+
+def init_batch_worker():
+    """Process pool initializer for batch work"""
+    # Each process already has an image to itself, OpenCV's own threads would only compete with the other processes
+    cv2.setNumThreads(1)
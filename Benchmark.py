@@ -0,0 +1,389 @@
+"""Benchmark
+
+Repeatable timing and memory benchmarks of the hot paths: contour detection, matching from a rect, the 'z' automatic
+grouping, and the container queries, on synthetic symbol sheets of any size.
+
+A sheet is a seeded random alphabet of glyphs, each a connected stroke of its own size, laid out in lines like text,
+so the same arguments always give the same image. Every benchmark is run --repeat times after an untimed setup, and
+then once more under tracemalloc for its peak memory. Results go to a JSON file, which a later run can be compared
+against to catch regressions:
+    python Benchmark.py --symbols 1000 10000 100000 --out before.json
+    python Benchmark.py --symbols 1000 10000 100000 --out after.json --compare before.json
+--width and --height fix the sheet size, with the symbols spread out over it, to time the whole-image matching on
+large sparse pages:
+    python Benchmark.py --symbols 1000 --width 6000 --height 8000 --only match_rect group_template
+"""
+import gc
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+import MatchSymbols
+from AutoGrouper import AutoGrouper
+from ContourContainer import ArrayContourContainer, ContourContainer
+from FeatureGrouping import FeatureGrouper
+from ScoreCache import ScoreCache
+from SymbolPipeline import get_contours
+from TiledProcessing import get_contours_tiled
+
+CONTAINERS = {'list': ContourContainer, 'array': ArrayContourContainer}
+# Number of lookups in each query benchmark
+QUERIES = 1000
+
+
+@dataclass
+class Sheet:
+    """A synthetic symbol sheet and what is on it"""
+    gray: np.ndarray
+    # (N, 4) int32 x, y, w, h of each symbol, in reading order
+    boxes: np.ndarray
+    # Glyph of each symbol
+    labels: np.ndarray
+
+
+def make_glyphs(count: int, rng: np.random.Generator, size: Optional[Tuple[int, int]] = None) -> List[np.ndarray]:
+    """
+    Random glyphs, each a single connected stroke cropped to its bounding box
+    :param size: Width, height to make every glyph, by drawing its stroke inside a frame of that size. Otherwise each
+        glyph has a random size
+    """
+    glyphs = []
+    for _ in range(count):
+        width, height = size or (int(rng.integers(6, 14)), int(rng.integers(10, 18)))
+        canvas = np.zeros((height, width), dtype=np.uint8)
+        points = np.column_stack((rng.integers(0, width, 5), rng.integers(0, height, 5))).astype(np.int32)
+        cv2.polylines(canvas, [points], False, 255, 1)
+        if size is not None:
+            cv2.rectangle(canvas, (0, 0), (width - 1, height - 1), 255, 1)
+        x, y, w, h = cv2.boundingRect(canvas)
+        glyphs.append(canvas[y:y + h, x:x + w].copy())
+    return glyphs
+
+
+def make_sheet(symbols: int, alphabet: int = 40, seed: int = 0, gap: int = 6,
+               glyph_size: Optional[Tuple[int, int]] = None, width: Optional[int] = None,
+               height: Optional[int] = None) -> Sheet:
+    """
+    Lay out symbols random glyphs from an alphabet in lines, white on black
+    :param gap: Pixels between symbols, and between lines
+    :param glyph_size: Make every glyph this width and height, see make_glyphs
+    :param width: Sheet width in pixels. The lines are as long as fit, and the symbols are spread out along them
+    :param height: Sheet height in pixels. The lines are spread out down the sheet. Without either, the sheet is
+        packed tight in roughly the shape of a page
+    :raises ValueError: If the symbols don't fit on a sheet of that size
+    """
+    rng = np.random.default_rng(seed)
+    glyphs = make_glyphs(alphabet, rng, glyph_size)
+    cell_w = max(glyph.shape[1] for glyph in glyphs) + gap
+    cell_h = max(glyph.shape[0] for glyph in glyphs) + gap
+    if width is not None:
+        columns = (width - gap) // cell_w
+    elif height is not None:
+        columns = -(-symbols // max((height - gap) // cell_h, 1))
+    else:
+        # Roughly the shape of a page
+        columns = max(int(np.sqrt(symbols * 1.4 * cell_h / cell_w)), 1)
+    columns = min(columns, max(symbols, 1))
+    if columns < 1:
+        raise ValueError(f"Symbols up to {cell_w - gap} pixels wide don't fit on a sheet {width} pixels wide")
+    rows = -(-symbols // columns)
+    if height is not None and rows * cell_h + gap > height:
+        raise ValueError(f"{symbols} symbols need a sheet {rows * cell_h + gap} pixels high, not {height}")
+    width = columns * cell_w + gap if width is None else width
+    height = rows * cell_h + gap if height is None else height
+    # The same as the cell size for a packed sheet
+    pitch_x = (width - gap) // columns
+    pitch_y = (height - gap) // max(rows, 1)
+    gray = np.zeros((height, width), dtype=np.uint8)
+    labels = rng.integers(0, alphabet, symbols)
+    boxes = np.empty((symbols, 4), dtype=np.int32)
+    for index, label in enumerate(labels.tolist()):
+        glyph = glyphs[label]
+        h, w = glyph.shape
+        # Bottom aligned on the line, like letters
+        x = gap + (index % columns) * pitch_x
+        y = gap + (index // columns) * pitch_y + cell_h - gap - h
+        gray[y:y + h, x:x + w] = glyph
+        boxes[index] = (x, y, w, h)
+    return Sheet(gray=gray, boxes=boxes, labels=labels)
+
+
+def filled_container(sheet: Sheet, kind: str = 'array') -> ContourContainer:
+    contours = CONTAINERS[kind](width=sheet.gray.shape[1], height=sheet.gray.shape[0], min_width=2, min_height=2)
+    contours.add_many(sheet.boxes)
+    # Build the lazy indexes, so the query benchmarks don't time the first query building them
+    contours.get_index_by_point(0, 0)
+    contours.get_indices_by_size(1, 1)
+    contours.get_reading_order()
+    return contours
+
+
+# Each benchmark takes the sheet and the run's random generator, does its untimed setup, and returns the function to
+# time. The function may return a count, which is saved with the result as a sanity check
+BENCHMARKS: Dict[str, Callable[[Sheet, np.random.Generator], Callable[[], Optional[int]]]] = {}
+
+
+def benchmark(name: str):
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+@benchmark('contours')
+def _contours(sheet, rng):
+    contours = filled_container(sheet)
+    contours.truncate(0)
+    return lambda: get_contours(sheet.gray, contours) or contours.length
+
+
+@benchmark('contours_tiled')
+def _contours_tiled(sheet, rng):
+    contours = filled_container(sheet)
+    contours.truncate(0)
+    return lambda: get_contours_tiled(sheet.gray, contours, tile_size=1024) or contours.length
+
+
+def _random_rect(sheet, rng):
+    return sheet.boxes[rng.integers(len(sheet.boxes))].tolist()
+
+
+@benchmark('match_rect')
+def _match_rect(sheet, rng):
+    # A new cache, so this is the first click on a symbol
+    MatchSymbols.score_cache = ScoreCache()
+    rect = _random_rect(sheet, rng)
+    return lambda: len(MatchSymbols.get_matches_from_rect(rect, sheet.gray))
+
+
+@benchmark('match_rect_cached')
+def _match_rect_cached(sheet, rng):
+    # Moving the threshold trackbar after a click
+    MatchSymbols.score_cache = ScoreCache()
+    rect = _random_rect(sheet, rng)
+    MatchSymbols.get_matches_from_rect(rect, sheet.gray)
+    return lambda: len(MatchSymbols.get_matches_from_rect(rect, sheet.gray))
+
+
+def _grouping(grouper):
+    def prepare(sheet, rng):
+        contours = filled_container(sheet)
+        return lambda: grouper.run(sheet.gray, contours) and len(np.unique(contours.get_group_array()))
+    return prepare
+
+
+BENCHMARKS['group_template'] = _grouping(AutoGrouper())
+BENCHMARKS['group_template_size'] = _grouping(AutoGrouper(size_tolerance=0.25))
+BENCHMARKS['group_feature'] = _grouping(FeatureGrouper())
+
+
+def _container_benchmarks(kind: str):
+    @benchmark(f'{kind}_add_many')
+    def _add_many(sheet, rng):
+        contours = filled_container(sheet, kind)
+        contours.truncate(0)
+        return lambda: contours.add_many(sheet.boxes)
+
+    @benchmark(f'{kind}_point')
+    def _point(sheet, rng):
+        # One lookup at a time, like mouse clicks
+        contours = filled_container(sheet, kind)
+        points = _random_points(sheet, rng).tolist()
+        return lambda: sum(contours.get_index_by_point(x, y) >= 0 for x, y in points)
+
+    @benchmark(f'{kind}_points')
+    def _points(sheet, rng):
+        contours = filled_container(sheet, kind)
+        points = _random_points(sheet, rng)
+        return lambda: int((contours.get_indices_by_points(points) >= 0).sum())
+
+    @benchmark(f'{kind}_rect')
+    def _rect(sheet, rng):
+        contours = filled_container(sheet, kind)
+        height, width = sheet.gray.shape
+        rects = np.column_stack((rng.integers(0, width, QUERIES), rng.integers(0, height, QUERIES),
+                                 rng.integers(20, 200, (QUERIES, 2)))).tolist()
+        return lambda: sum(len(contours.get_indices_in_rect(rect)) for rect in rects)
+
+    @benchmark(f'{kind}_size')
+    def _size(sheet, rng):
+        contours = filled_container(sheet, kind)
+        sizes = sheet.boxes[rng.integers(0, len(sheet.boxes), QUERIES), 2:].tolist()
+        return lambda: sum(len(contours.get_indices_by_size(w, h)) for w, h in sizes)
+
+    @benchmark(f'{kind}_set_group')
+    def _set_group(sheet, rng):
+        contours = filled_container(sheet, kind)
+        indices = rng.integers(0, len(sheet.boxes), QUERIES).tolist()
+        groups = rng.integers(1, 50, QUERIES).tolist()
+
+        def run():
+            for index, group in zip(indices, groups):
+                contours.set_group(group, index=index)
+        return run
+
+    @benchmark(f'{kind}_decode')
+    def _decode(sheet, rng):
+        # Regroup a symbol, then read the whole sheet again
+        contours = filled_container(sheet, kind)
+        contours.set_groups(np.arange(contours.length), sheet.labels + 1)
+        letters = {group: chr(ord('a') + group % 26) for group in range(1, 27)}
+        indices = rng.integers(0, len(sheet.boxes), 20).tolist()
+
+        def run():
+            for index in indices:
+                contours.set_group(contours.get_group(index) % 40 + 1, index=index)
+                text = contours.decode(letters, space_gap=10)
+            return len(text)
+        return run
+
+    @benchmark(f'{kind}_line_edit')
+    def _line_edit(sheet, rng):
+        # Move a symbol, like deleting and redrawing its box, then get the lines again
+        contours = filled_container(sheet, kind)
+        indices = rng.integers(0, len(sheet.boxes), 20).tolist()
+
+        def run():
+            for index in indices:
+                box = [int(v) for v in contours.get_box(index=index)]
+                contours.remove(index)
+                contours.add(rect=box)
+                lines = contours.get_lines()
+            return len(lines)
+        return run
+
+    @benchmark(f'{kind}_save_load')
+    def _save_load(sheet, rng):
+        contours = filled_container(sheet, kind)
+        filename = f'benchmark_{os.getpid()}.sym'
+
+        def run():
+            try:
+                contours.save(filename)
+                loaded = CONTAINERS[kind]()
+                loaded.load(filename)
+                return loaded.length
+            finally:
+                os.remove(filename)
+        return run
+
+
+def _random_points(sheet, rng) -> np.ndarray:
+    height, width = sheet.gray.shape
+    return np.column_stack((rng.integers(0, width, QUERIES), rng.integers(0, height, QUERIES)))
+
+
+for _kind in CONTAINERS:
+    _container_benchmarks(_kind)
+
+
+def run_benchmark(name: str, sheet: Sheet, repeat: int, seed: int = 0, memory: bool = True) -> dict:
+    """
+    Time one benchmark on a sheet
+    :return: Result dict with the min and median seconds, each run's seconds, the peak traced bytes and the count
+    """
+    times = []
+    count = None
+    for _ in range(repeat):
+        run = BENCHMARKS[name](sheet, np.random.default_rng(seed))
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            count = run()
+            times.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+    peak = None
+    if memory:
+        run = BENCHMARKS[name](sheet, np.random.default_rng(seed))
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {'name': name, 'symbols': len(sheet.boxes), 'width': sheet.gray.shape[1], 'height': sheet.gray.shape[0],
+            'min': min(times), 'median': statistics.median(times), 'times': times, 'peak_bytes': peak,
+            'count': None if count is None else int(count)}
+
+
+def environment() -> dict:
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(results: List[dict], baseline: List[dict], tolerance: float) -> int:
+    """
+    Print each benchmark's speed against the baseline
+    :param tolerance: Fraction slower than the baseline min time that counts as a regression
+    :return: Number of regressions
+    """
+    def key(result: dict):
+        # Results from before the sheet size was recorded have None for it, so they are not compared
+        return result['name'], result['symbols'], result.get('width'), result.get('height')
+
+    before = {key(result): result for result in baseline}
+    regressions = 0
+    for result in results:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        ratio = result['min'] / old['min'] if old['min'] > 0 else float('inf')
+        slower = ratio > 1 + tolerance
+        regressions += slower
+        print(f"{result['name']:>22} {result['symbols']:>7} {result['width']}x{result['height']}: "
+              f"{old['min'] * 1000:9.2f} -> {result['min'] * 1000:9.2f} ms "
+              f"x{ratio:.2f}{'  SLOWER' if slower else ''}"
+              f"{'  count changed' if old.get('count') != result.get('count') else ''}")
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths on synthetic symbol sheets.')
+    parser.add_argument('--symbols', help='Sheet sizes, in symbols', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--width', help='Sheet width in pixels, defaults to fitting the symbols', type=int,
+                        default=None)
+    parser.add_argument('--height', help='Sheet height in pixels, defaults to fitting the symbols', type=int,
+                        default=None)
+    parser.add_argument('--only', help='Benchmarks to run, defaults to all', nargs='+', choices=sorted(BENCHMARKS),
+                        default=None)
+    parser.add_argument('--repeat', help='Timed runs of each benchmark', type=int, default=3)
+    parser.add_argument('--seed', help='Seed for the sheets and queries', type=int, default=0)
+    parser.add_argument('--no-memory', help='Skip the tracemalloc run', action='store_true')
+    parser.add_argument('--out', help='JSON file for the results', default='benchmark.json')
+    parser.add_argument('--compare', help='Earlier results file to compare against', default=None)
+    parser.add_argument('--tolerance', help='Fraction slower that counts as a regression', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = []
+    for symbols in args.symbols:
+        sheet = make_sheet(symbols, seed=args.seed, width=args.width, height=args.height)
+        print(f"{symbols} symbols, {sheet.gray.shape[1]}x{sheet.gray.shape[0]} sheet")
+        for name in args.only or BENCHMARKS:
+            result = run_benchmark(name, sheet, args.repeat, args.seed, memory=not args.no_memory)
+            results.append(result)
+            memory = '' if result['peak_bytes'] is None else f", peak {result['peak_bytes'] / 1e6:.1f} MB"
+            print(f"{name:>22}: min {result['min'] * 1000:9.2f} ms, median {result['median'] * 1000:9.2f} ms"
+                  f"{memory}")
+
+    with open(args.out, 'w') as fp:
+        json.dump({'environment': environment(), 'seed': args.seed, 'repeat': args.repeat, 'results': results}, fp,
+                  indent=1)
+    print(f"Wrote {args.out}")
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            if compare(results, json.load(fp)['results'], args.tolerance):
+                sys.exit(1)
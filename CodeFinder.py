@@ -1,53 +1,127 @@
+"""CodeFinder
+
+Find the straight lines of a given color in images. Each contour of the color that is long enough gets a line fitted to
+it, and the line endpoints of all the contours of an image are worked out together as one array.
+
+Run it directly on images or directories to get the lines of all of them as CSV, working on a process pool:
+    python CodeFinder.py Inputs/ --lower 0 100 100 --upper 10 255 255 --min-length 50 --csv lines.csv
+"""
+import csv
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, Optional, Sequence, Tuple
+
 import cv2
 import numpy as np
 
+from BatchFiles import find_images, init_batch_worker
+
+CSV_COLUMNS = ('image', 'left_x', 'left_y', 'right_x', 'right_y', 'length')
+
+
+def color_mask(image, color_lower: Optional[Sequence[int]], color_upper: Optional[Sequence[int]]) -> np.ndarray:
+    """
+    Pixels of a BGR image inside the HSV range. Without a range, the image is thresholded with Otsu instead
+    """
+    if color_lower is None or color_upper is None:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        return mask
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    return cv2.inRange(hsv, tuple(color_lower), tuple(color_upper))
 
-def find_straight_lines(image_path, color_lower, color_upper, min_length):
-    # Read the image
-    image = cv2.imread(image_path)
 
-    # Convert the image to the HSV color space
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+def fit_lines(found_contours, min_length: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit a line to every contour at least min_length long
+    :return: (N, 4) float array of vx, vy, x, y from cv2.fitLine with DIST_L2, and the closed length of each contour
+    """
+    arc_lengths = np.array([cv2.arcLength(contour, True) for contour in found_contours], dtype=np.float64)
+    keep = np.flatnonzero(arc_lengths >= min_length)
+    lines = np.array([cv2.fitLine(found_contours[i], cv2.DIST_L2, 0, 0.01, 0.01) for i in keep.tolist()],
+                     dtype=np.float64).reshape(-1, 4)
+    return lines, arc_lengths[keep]
 
-    # Apply thresolding to separate symbols from the background
-    ret, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
 
-    # Find contours in the mask
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+def find_straight_lines(image, color_lower: Optional[Sequence[int]], color_upper: Optional[Sequence[int]],
+                        min_length: float) -> np.ndarray:
+    """
+    Find the lines of one color in an image
+    :param image: BGR image, or the path to one
+    :param color_lower: Lower bound of the HSV color range, None to threshold with Otsu instead
+    :param color_upper: Upper bound of the HSV color range
+    :param min_length: Skip contours shorter than this
+    :return: (N, 5) float array of left x, left y, right x, right y and contour length. The line runs the length of
+        the contour either way from the middle of the contour
+    """
+    if isinstance(image, str):
+        path, image = image, cv2.imread(image)
+        if image is None:
+            raise FileNotFoundError(f"Could not read image {path}")
+    mask = color_mask(image, color_lower, color_upper)
+    found_contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    lines, arc_lengths = fit_lines(found_contours, min_length)
+    offsets = lines[:, :2] * arc_lengths[:, None]
+    # Truncated towards zero like int(), which is what the endpoints were before
+    return np.column_stack((np.trunc(lines[:, 2:] - offsets), np.trunc(lines[:, 2:] + offsets), arc_lengths))
 
-    # Initialize an empty list to store the detected lines
-    detected_lines = []
 
-    # Iterate through the contours
-    for contour in contours:
-        # Get the length of the contour
-        length = cv2.arcLength(contour, True)
+def _find_one(job):
+    image_path, color_lower, color_upper, min_length = job
+    return image_path, find_straight_lines(image_path, color_lower, color_upper, min_length)
 
-        # If the length meets the minimum length requirement
-        if length >= min_length:
-            # Fit a straight line to the contour
-            vx, vy, x, y = cv2.fitLine(contour, cv2.DIST_L2, 0, 0.01, 0.01)
 
-            # Calculate the endpoints of the line
-            left_x = int(x - vx * length)
-            left_y = int(y - vy * length)
-            right_x = int(x + vx * length)
-            right_y = int(y + vy * length)
+def find_lines_batch(paths: Iterable[str], color_lower: Optional[Sequence[int]], color_upper: Optional[Sequence[int]],
+                     min_length: float, workers: Optional[int] = None) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    find_straight_lines on many images, on a process pool
+    :param paths: Images, or directories of images
+    :param workers: Number of processes, defaults to one per CPU
+    :return: (image path, lines) in the same order as the images, as each one is done
+    """
+    jobs = [(image, color_lower, color_upper, min_length) for image in find_images(paths)]
+    workers = min(workers or os.cpu_count() or 1, max(len(jobs), 1))
+    if workers == 1:
+        yield from map(_find_one, jobs)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker) as pool:
+        yield from pool.map(_find_one, jobs)
 
-            detected_lines.append(((left_x, left_y), (right_x, right_y)))
 
-    return detected_lines
+def write_csv(fp, results: Iterable[Tuple[str, np.ndarray]]) -> int:
+    """
+    Write the lines from find_lines_batch as CSV, one row per line
+    :return: Number of lines written
+    """
+    writer = csv.writer(fp)
+    writer.writerow(CSV_COLUMNS)
+    count = 0
+    for image_path, lines in results:
+        for left_x, left_y, right_x, right_y, length in lines.tolist():
+            writer.writerow((image_path, int(left_x), int(left_y), int(right_x), int(right_y), f"{length:.2f}"))
+        count += len(lines)
+    return count
 
 
-# Specify the path to your image
-image_path = "Inputs/DetReduced.png"
+if __name__ == "__main__":
+    import argparse
 
-# Specify the color range (in HSV format) and minimum line length
-color_lower = [0, 100, 100]  # Lower bound of the color range
-color_upper = [10, 255, 255]  # Upper bound of the color range
-min_length = 50  # Minimum line length
+    parser = argparse.ArgumentParser(description='Find the straight lines of a color in a batch of images.')
+    parser.add_argument('paths', help='Images, or directories of images', nargs='*', default=['Inputs/DetReduced.png'])
+    parser.add_argument('--lower', help='Lower bound of the HSV color range', type=int, nargs=3, default=[0, 100, 100])
+    parser.add_argument('--upper', help='Upper bound of the HSV color range', type=int, nargs=3,
+                        default=[10, 255, 255])
+    parser.add_argument('--otsu', help='Ignore the color range and threshold with Otsu', action='store_true')
+    parser.add_argument('--min-length', help='Minimum line length', type=float, default=50)
+    parser.add_argument('--workers', help='Number of processes, defaults to one per CPU', type=int, default=None)
+    parser.add_argument('--csv', help='File to write the lines to, instead of the screen', default=None)
+    args = parser.parse_args()
 
-# Find and print the detected lines
-lines = find_straight_lines(image_path, color_lower, color_upper, min_length)
-for line in lines:
-    print("Line: ", line)
+    batch = find_lines_batch(args.paths, None if args.otsu else args.lower, None if args.otsu else args.upper,
+                             args.min_length, workers=args.workers)
+    if args.csv is None:
+        write_csv(sys.stdout, batch)
+    else:
+        with open(args.csv, 'w', newline='') as out:
+            print(f"Wrote {write_csv(out, batch)} lines to {args.csv}")
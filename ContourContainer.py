@@ -1,8 +1,16 @@
-import json
-import string
 from cv2 import boundingRect
-from typing import Sequence, Optional, List, Any
+from typing import Sequence, Optional, List, Iterable, Mapping, Set, Tuple
 import dataclasses
+import numpy as np
+from SpatialGrid import SpatialGrid
+from DisjointGroups import MAX_GROUP, DisjointGroups
+from SizeBuckets import SizeBuckets
+from ReadingOrder import ReadingOrder, group_frequencies, transcribe
+from SessionFile import Session, load_session, save_json_session, save_session
+
+# Operations the mutating methods record for a journal. The others only come from undoing these
+FORWARD_OPERATIONS = ('add', 'add_many', 'remove', 'set_group', 'set_group_all', 'set_groups', 'set_active', 'merge')
+
 
 class ContourNotFound(Exception):
     def __init__(self, message="Contour not found"):
@@ -23,13 +31,197 @@ class ContourContainer:
 
     Contours are stored as x, y, w, h. X, Y of the bottom left point, w = width, h = height
     Goal is to have an initial, simple implementation, and then add in tests and more efficiency
+    Point lookups go through a SpatialGrid, size lookups through SizeBuckets, and reading order through ReadingOrder,
+    all kept in step with add, remove and load
+    Groups are kept in DisjointGroups, so they can be merged, and group queries only touch the group's members.
+    ContourElement.group holds the id the contour was given, get_group returns the id of the group it is in now.
+    Every change bumps `version` and records the indices it touched, see take_changes
+    When `journal` is set (see Journal.py), every change is also recorded as an operation, along with the operation
+    that undoes it, and apply() replays them
     """
     contours: List[ContourElement]
 
-    def __init__(self, width: int=806, height: int=504, min_width: int=0, min_height: int=0 ):
+    def __init__(self, width: int=806, height: int=504, min_width: int=0, min_height: int=0, cell_size: int=32):
+        self.version = 0
+        self._changed: Set[int] = set()
+        self._changed_all = True
+        # Set by a loaded session until the indexes are built from it, see _ensure_indexed
+        self._indexed = True
+        self._group_state = None
+        self._grid = SpatialGrid(cell_size=cell_size)
+        self._size_buckets = SizeBuckets()
+        self._reading_order = ReadingOrder()
+        self._group_sets = DisjointGroups()
         self.contours = []
         self.min_size = [min_width, min_height]
-        self.max_group = 0
+        # OperationJournal recording the changes, if any
+        self.journal = None
+
+    # The indexes. After ArrayContourContainer loads a session they are only built on first use
+    @property
+    def grid(self) -> SpatialGrid:
+        self._ensure_indexed()
+        return self._grid
+
+    @property
+    def size_buckets(self) -> SizeBuckets:
+        self._ensure_indexed()
+        return self._size_buckets
+
+    @property
+    def reading_order(self) -> ReadingOrder:
+        self._ensure_indexed()
+        return self._reading_order
+
+    @property
+    def group_sets(self) -> DisjointGroups:
+        self._ensure_indexed()
+        return self._group_sets
+
+    def _ensure_indexed(self):
+        """Build the indexes of a session loaded with set_session, if that hasn't been done yet"""
+        if self._indexed:
+            return
+        self._indexed = True
+        boxes = self.get_box_array(all=True)
+        self._grid.build(boxes)
+        self._size_buckets.build(boxes)
+        self._reading_order.build(boxes)
+        if self._group_state is not None:
+            self._group_sets.set_state(self._group_state, self._raw_labels())
+        else:
+            self._group_sets.build(self._raw_labels())
+        self._group_state = None
+
+    @property
+    def max_group(self) -> int:
+        return self.group_sets.max_group
+
+    def _mark(self, indices: Iterable[int] = (), all: bool = False):
+        self.version += 1
+        if all:
+            self._changed_all = True
+        elif not self._changed_all:
+            self._changed.update(int(i) for i in indices)
+
+    def take_changes(self) -> Optional[Set[int]]:
+        """
+        Indices of the contours whose box, group or active state changed since the last call
+        :return: Set of indices, or None if everything should be treated as changed (a load, or a remove shifting
+            the indices)
+        """
+        changed = None if self._changed_all else self._changed
+        self._changed = set()
+        self._changed_all = False
+        return changed
+
+    def _journal_begin(self, *op):
+        """Work out how to undo an operation before it happens, if a journal is recording"""
+        if self.journal is None:
+            return None
+        op = list(op)
+        return op, self._undo_for(op)
+
+    def _journal_end(self, pending):
+        if pending is not None and self.journal is not None:
+            self.journal.record(*pending)
+
+    def _dropped_group(self, index: int):
+        """State of the group of a contour, if moving the contour out of it would drop the group"""
+        label = self._raw_label(index)
+        if self.group_sets.find(label) == 0 or self.group_sets.size(label) > 1:
+            return None
+        return list(self.group_sets.group_state(label))
+
+    def _undo_for(self, op: list) -> list:
+        """The operation that puts the container back the way it is now, after op has been applied"""
+        name = op[0]
+        if name == 'add':
+            return ['remove', self.length]
+        if name == 'add_many':
+            return ['truncate', self.length]
+        if name == 'remove':
+            index = op[1]
+            return ['insert', index, [int(x) for x in self.get_box(index=index)], self._raw_label(index),
+                    self.get_active(index), self._dropped_group(index)]
+        if name == 'set_group':
+            index = op[2]
+            return ['regroup', index, self._raw_label(index), self._dropped_group(index)]
+        if name in ('set_group_all', 'set_groups'):
+            return ['set_labels', self._raw_labels().tolist(), self.group_sets.state()]
+        if name == 'set_active':
+            return ['set_active', op[1], [self.get_active(index) for index in op[1]]]
+        if name == 'merge':
+            root, absorbed = self.group_sets.merge_roots(op[1], op[2])
+            # Merging in a group without members changes nothing, see DisjointGroups.merge
+            if root == absorbed or not self.group_sets.size(absorbed):
+                return ['unmerge', root, None]
+            return ['unmerge', root, list(self.group_sets.group_state(absorbed))]
+        raise ValueError(f"Unknown operation {name}")
+
+    def apply(self, op: Sequence):
+        """
+        Apply an operation recorded by a journal
+        :param op: List of the operation name and its arguments
+        """
+        journal, self.journal = self.journal, None
+        undo = self._undo_for(list(op)) if journal is not None and op[0] in FORWARD_OPERATIONS else None
+        try:
+            name, args = op[0], op[1:]
+            if name == 'add':
+                self.add(rect=args[0], group=args[1])
+            elif name == 'add_many':
+                self.add_many(args[0], args[1])
+            elif name in ('remove', 'truncate'):
+                if name == 'remove':
+                    self.remove(args[0])
+                else:
+                    self.truncate(args[0])
+                if len(args) > 1 and args[1] is not None:
+                    self.group_sets.restore(*args[1])
+            elif name == 'insert':
+                self.insert(*args[:4])
+                if args[4] is not None:
+                    self.group_sets.restore(*args[4])
+            elif name == 'set_group':
+                self.set_group(args[0], index=args[1])
+            elif name == 'regroup':
+                self.set_group(args[1], index=args[0])
+                for state in args[2:]:
+                    if state is not None:
+                        self.group_sets.restore(*state)
+            elif name == 'set_group_all':
+                self.set_group(args[0], all=True)
+            elif name == 'set_groups':
+                self.set_groups(args[0], args[1])
+            elif name == 'set_labels':
+                self._set_raw_labels(args[0])
+                self.group_sets.set_state(args[1], args[0])
+                self._mark(all=True)
+            elif name == 'set_active':
+                self.set_active(args[0], args[1])
+            elif name == 'merge':
+                self.merge_groups(args[0], args[1])
+            elif name == 'unmerge':
+                self.group_sets.unmerge(*args)
+                self._mark(args[1][2] if args[1] is not None else ())
+            else:
+                raise ValueError(f"Unknown operation {name}")
+        finally:
+            self.journal = journal
+        if journal is not None:
+            journal.record(list(op), undo)
+
+    def _raw_label(self, index: int) -> int:
+        """Group id the contour was given, before merges are resolved"""
+        return self.contours[index].group
+
+    def _raw_labels(self) -> np.ndarray:
+        return np.array([x.group for x in self.contours], dtype=np.int64)
+
+    def _set_raw_labels(self, labels: Sequence[int]):
+        for contour, label in zip(self.contours, labels):
+            contour.group = label
 
     def add(self, contour=None, rect=None, group=0):
         if contour is not None:
@@ -37,11 +229,83 @@ class ContourContainer:
         if rect[2] < self.min_size[0] or rect[3] < self.min_size[1]:
             # print(f"Contour is too small")
             return
+        pending = self._journal_begin('add', [int(x) for x in rect], group)
         self.contours.append(ContourElement(box=rect, group=group))
+        self.grid.add(len(self.contours) - 1, rect)
+        self.size_buckets.add(len(self.contours) - 1, rect[2], rect[3])
+        self.reading_order.add(len(self.contours) - 1, rect)
+        self.group_sets.add(len(self.contours) - 1, group)
+        self._mark([len(self.contours) - 1])
+        self._journal_end(pending)
+
+    def _large_enough(self, boxes) -> np.ndarray:
+        boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        return boxes[(boxes[:, 2] >= self.min_size[0]) & (boxes[:, 3] >= self.min_size[1])]
+
+    def add_many(self, boxes, group: int = 0) -> int:
+        """
+        Add many boxes at once, dropping the ones under the minimum size, same as calling add for each
+        :param boxes: (N, 4) array like of x, y, w, h
+        :return: Number of boxes added
+        """
+        boxes = self._large_enough(boxes)
+        if not len(boxes):
+            return 0
+        pending = self._journal_begin('add_many', boxes, group)
+        start = self.length
+        self.contours.extend(ContourElement(box=box, group=group) for box in boxes.tolist())
+        self._index_added(start, boxes, group)
+        self._journal_end(pending)
+        return len(boxes)
+
+    def _index_added(self, start: int, boxes: np.ndarray, group: int):
+        self.grid.add_many(start, boxes)
+        self.size_buckets.add_many(start, boxes)
+        self.reading_order.add_many(start, boxes)
+        self.group_sets.add_many(range(start, start + len(boxes)), group)
+        self._mark(range(start, start + len(boxes)))
+
+    def truncate(self, count: int):
+        """Drop every contour from index count up. This is how an add_many is undone"""
+        for index in range(self.length - 1, count - 1, -1):
+            self.group_sets.discard(index, self._raw_label(index))
+        self.group_sets.truncate(count)
+        del self.contours[count:]
+        self.grid.truncate(count)
+        self.size_buckets.truncate(count)
+        self.reading_order.truncate(count)
+        self._mark(all=True)
 
     def remove(self, index: int):
-        assert(index < len(self.contours), f"Subtracting illegal index of {index} from contours length {len(self.contours)}")
+        assert 0 <= index < len(self.contours), f"Subtracting illegal index of {index} from contours length {len(self.contours)}"
+        pending = self._journal_begin('remove', index)
+        self.group_sets.remove(index, self.contours[index].group)
         del self.contours[index]
+        self.grid.remove(index)
+        self.size_buckets.remove(index)
+        self.reading_order.remove(index)
+        self._mark(all=True)
+        self._journal_end(pending)
+
+    def insert(self, index: int, rect: Sequence[int], group: int = 0, active: bool = False):
+        """Put a contour in at index, shifting the ones from there up. This is how a remove is undone"""
+        self.contours.insert(index, ContourElement(box=rect, active=active, group=group))
+        self.grid.insert(index, rect)
+        self.size_buckets.insert(index, rect[2], rect[3])
+        self.reading_order.insert(index, rect)
+        self.group_sets.insert(index, group)
+        self._mark(all=True)
+
+    def _check_index(self, index: int, x_in: Optional[int] = None, y_in: Optional[int] = None):
+        """Raise ContourNotFound for an index that is not a contour, like the -1 of a point lookup that missed"""
+        if not 0 <= index < self.length:
+            where = f"index {index}" if x_in is None else f"{x_in}, {y_in}"
+            raise ContourNotFound(message=f"No contour found at {where}")
+
+    @staticmethod
+    def _check_group(group: int):
+        if not 0 <= group <= MAX_GROUP:
+            raise ValueError(f"Group ids must be from 0 to {MAX_GROUP}, got {group}")
 
     @staticmethod
     def point_in_rect(x_in: int, y_in: int, rect: Sequence[int]) -> bool:
@@ -54,10 +318,30 @@ class ContourContainer:
         :params x_in, y_in: (x, y) point position
         :return: Contour index or -1 for Not Found
         """
-        for index, contour in enumerate(self.contours):
-            if self.point_in_rect(x_in, y_in, contour.box):
-                return index
-        return -1
+        return self.grid.query_point(x_in, y_in)
+
+    def get_indices_by_points(self, points) -> np.ndarray:
+        """
+        Find the contour boxes containing a whole array of points at once
+        :param points: (N, 2) array like of x, y points
+        :return: Array of N contour indices, -1 for Not Found
+        """
+        return self.grid.query_points(points)
+
+    def get_indices_by_size(self, width: int, height: int, tolerance: float = 0.25) -> np.ndarray:
+        """
+        Find the contour boxes of about the same size
+        :param tolerance: How far the width and height can be from the given ones, as a fraction of them, plus 1 pixel
+        :return: Sorted array of contour indices
+        """
+        slack_w = int(tolerance * width) + 1
+        slack_h = int(tolerance * height) + 1
+        return self.size_buckets.query(width - slack_w, width + slack_w, height - slack_h, height + slack_h)
+
+    def get_indices_in_rect(self, rect: Sequence[int]) -> np.ndarray:
+        """Sorted indices of the contour boxes overlapping rect, given as x, y, w, h"""
+        x, y, w, h = rect
+        return self.grid.query_rect(x, y, x + w, y + h)
 
     def get_box(self, x_in: Optional[int]=None, y_in: Optional[int]=None, index: Optional[int] = None) -> Sequence[int]:
         if index is None:
@@ -68,15 +352,10 @@ class ContourContainer:
 
     def group(self, group: int, index: Optional[int]=None, x_in: Optional[int]=None,
               y_in: Optional[int]=None, all=False) -> None:
-        if all:
-            for contour in self.contours:
-                contour.group = group
-            return
-        if index is None:
-            if x_in is None or y_in is None:
-                assert(False, f"Classify called with no parameters")
+        if index is None and not all:
+            assert x_in is not None and y_in is not None, f"Classify called with no parameters"
             index = self.get_index_by_point(x_in, y_in)
-        self.contours[index].group = group
+        self.set_group(group, index=index, all=all)
 
     def get_boxes(self, group: Optional[int]=None, active: Optional[bool]=None, all: bool=False):
         if all:
@@ -88,59 +367,474 @@ class ContourContainer:
                 yield box
             return
         if group is not None:
-            for box in [x.box for x in self.contours if x.group == group]:
-                yield box
+            for index in self.group_sets.indices(group).tolist():
+                yield self.contours[index].box
+
+    def get_box_array(self, group: Optional[int]=None, active: Optional[bool]=None, all: bool=False) -> np.ndarray:
+        """Same selection as get_boxes, returned as one (N, 4) array"""
+        return np.array(list(self.get_boxes(group=group, active=active, all=all)), dtype=np.int32).reshape(-1, 4)
+
+    def get_group_array(self) -> np.ndarray:
+        """Current group of every contour, in index order"""
+        return self.group_sets.resolve([x.group for x in self.contours])
+
+    def get_session(self, exact: bool = False) -> Session:
+        """
+        Snapshot of the boxes, current groups and active flags, as saved by save
+        :param exact: Keep the group ids the contours were given and how they were merged, instead of the merged ids,
+            so a journal can replay operations onto it
+        """
+        return Session(min_size=list(self.min_size), boxes=self.get_box_array(all=True),
+                       groups=self._raw_labels() if exact else self.get_group_array(),
+                       active=np.array([x.active for x in self.contours], dtype=bool),
+                       group_state=self.group_sets.state() if exact else None)
+
+    def set_session(self, session: Session):
+        """Replace the contents of the container with a saved session"""
+        self.min_size = list(session.min_size)
+        self.contours = [ContourElement(box=box, active=active, group=group) for box, active, group in
+                         zip(np.asarray(session.boxes).tolist(), np.asarray(session.active, dtype=bool).tolist(),
+                             np.asarray(session.groups).tolist())]
+        self._indexed = False
+        self._group_state = session.group_state
+        self._ensure_indexed()
+        self._mark(all=True)
 
     def save(self, filename: str):
-        contours_out = [dataclasses.asdict(x) for x in self.contours]
-        with open(filename, 'w+') as fp:
-            fp.write(json.dumps(self.min_size)+'\n')
-            fp.write(json.dumps(contours_out))
+        """Save to a binary session file (see SessionFile.py), or the original JSON format if the name ends in .json"""
+        if filename.endswith('.json'):
+            save_json_session(filename, self.get_session())
+        else:
+            save_session(filename, self.get_session())
 
     def load(self, filename: str):
-        with open(filename, 'r') as fp:
-            self.min_size = json.loads(fp.readline())
-            contours_json = json.loads(fp.readline())
-        self.contours = [ContourElement(box=x['box'], group=x['group']) for x in contours_json]
+        """Load a binary or JSON session, including which boxes were active"""
+        self.set_session(load_session(filename))
+        if self.journal is not None:
+            # Loading replaces everything, so the journal starts over from here
+            self.journal.checkpoint()
+
+    def set_active(self, indices: Sequence[int], values):
+        """Set the active flag of many contours, values being one bool for all of them or one per index"""
+        indices = [int(index) for index in indices]
+        pending = self._journal_begin('set_active', indices, values)
+        for index, value in zip(indices, np.broadcast_to(values, len(indices)).tolist()):
+            self.contours[index].active = value
+        self._mark(indices)
+        self._journal_end(pending)
 
     def select_boxes(self, x_in: int=None, y_in: int=None, group=None, index: Optional[int]=None):
         if group is not None:
-            indices = [i for i, x in enumerate(self.contours) if x.group==group]
-            for i in indices:
+            members = self.group_sets.members(group).tolist()
+            pending = self._journal_begin('set_active', members, True)
+            for i in members:
                 self.contours[i].active = True
+            self._mark(members)
+            self._journal_end(pending)
             return
         if index is None:
             index = self.get_index_by_point(x_in, y_in)
+        self._check_index(index, x_in, y_in)
+        pending = self._journal_begin('set_active', [index], True)
         self.contours[index].active = True
+        self._mark([index])
+        self._journal_end(pending)
 
     def unselect_boxes(self, x_in: int=None, y_in: int=None, all=False, index=None):
         if all:
+            changed = [i for i, contour in enumerate(self.contours) if contour.active]
+            pending = self._journal_begin('set_active', changed, False)
             for contour in self.contours:
                 contour.active = False
+            self._mark(changed)
+            self._journal_end(pending)
             return
         if index is None:
             index = self.get_index_by_point(x_in, y_in)
+        self._check_index(index, x_in, y_in)
+        pending = self._journal_begin('set_active', [index], False)
         self.contours[index].active = False
+        self._mark([index])
+        self._journal_end(pending)
 
     @property
     def length(self):
         return len(self.contours)
 
+    def get_active(self, index: int) -> bool:
+        return self.contours[index].active
+
     def get_group(self, index: int = None, selected: Optional[bool]=None) -> int:
         if selected is not None:
             for contour in self.contours:
                 if contour.active:
-                    return contour.group
+                    return self.group_sets.find(contour.group)
         if index is not None:
-            return self.contours[index].group
+            return self.group_sets.find(self.contours[index].group)
         return -1
 
     def set_group(self, setting: int, index: int = None, all=False):
-        if setting > self.max_group:
-            self.max_group = setting
         if all:
+            self._check_group(setting)
+            pending = self._journal_begin('set_group_all', setting)
             for contour in self.contours:
                 contour.group = setting
+            self.group_sets.build([setting] * len(self.contours))
+            self._mark(all=True)
+            self._journal_end(pending)
         if index is not None:
+            self._check_index(index)
+            self._check_group(setting)
+            pending = self._journal_begin('set_group', setting, index)
+            self.group_sets.move(index, self.contours[index].group, setting)
             self.contours[index].group = setting
+            self._mark([index])
+            self._journal_end(pending)
             return
+
+    def set_groups(self, indices: Sequence[int], groups: Sequence[int]):
+        """Set the group of many contours at once, one group per index"""
+        indices = [int(index) for index in indices]
+        groups = [int(group) for group in groups]
+        for index, group in zip(indices, groups):
+            self._check_index(index)
+            self._check_group(group)
+        pending = self._journal_begin('set_groups', indices, groups)
+        for index, group in zip(indices, groups):
+            self.group_sets.move(index, self.contours[index].group, group)
+            self.contours[index].group = group
+        self._mark(indices)
+        self._journal_end(pending)
+
+    def merge_groups(self, group_a: int, group_b: int) -> int:
+        """
+        Merge two groups into one, without touching the contours in them
+        :return: Id of the merged group
+        """
+        self._check_group(group_a)
+        self._check_group(group_b)
+        pending = self._journal_begin('merge', group_a, group_b)
+        root, moved = self.group_sets.merge(group_a, group_b)
+        self._mark(moved)
+        self._journal_end(pending)
+        return root
+
+    def get_group_indices(self, group: int) -> np.ndarray:
+        """Sorted indices of the contours in a group"""
+        return self.group_sets.indices(group)
+
+    def get_reading_order(self) -> np.ndarray:
+        """Indices of all the contours, line by line from the top, left to right within a line"""
+        return self.reading_order.order()
+
+    def get_lines(self) -> List[np.ndarray]:
+        """Indices of the contours of each line, top to bottom, each left to right"""
+        return self.reading_order.lines()
+
+    @property
+    def line_count(self) -> int:
+        """Number of lines of contours, see get_lines"""
+        return self.reading_order.line_count
+
+    def set_line_gap(self, line_gap: int):
+        """Largest vertical distance between the centers of neighbouring symbols of one line, in pixels"""
+        self.reading_order.set_line_gap(line_gap)
+
+    def decode(self, letters: Mapping[int, str], unknown: str = '?', space_gap: Optional[int] = None) -> str:
+        """
+        The sheet as text, the letter of each contour's group in reading order, one line of text per line of symbols
+        :param letters: Letter of each group id
+        :param unknown: Put in for the contours whose group has no letter
+        :param space_gap: Put a space between neighbouring symbols more than this many pixels apart
+        """
+        return transcribe(self.reading_order.order(), self.reading_order.line_starts(), self.get_group_array(),
+                          letters, unknown, None if space_gap is None else self.get_box_array(all=True), space_gap)
+
+    def group_frequencies(self, ungrouped: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Number of contours in each group
+        :param ungrouped: Count the ungrouped contours too, as group 0
+        :return: Group ids and counts, the most common group first
+        """
+        return group_frequencies(self.get_group_array(), ungrouped)
+
+
+class ArrayContourContainer(ContourContainer):
+    """ContourContainer that stores contours as NumPy columns instead of a list of ContourElements
+
+    Boxes, group ids and active flags live in contiguous arrays (int32 x 4, int32, bool), so group and active queries
+    are masks and bulk updates are single array assignments instead of per-object loops. The columns are 21 bytes per
+    contour, and the grid, size, reading order and group indexes bring it to about 130 bytes, against a few hundred
+    for a ContourElement with its box list plus the indexes. All ContourContainer methods keep their signatures.
+    `contours` still works, but builds ContourElement copies, so changing those does not change the container.
+    """
+    def __init__(self, width: int=806, height: int=504, min_width: int=0, min_height: int=0, cell_size: int=32):
+        self._size = 0
+        self._boxes = np.empty((0, 4), dtype=np.int32)
+        self._groups = np.empty(0, dtype=np.int32)
+        self._active = np.empty(0, dtype=bool)
+        self._mapped = False
+        super().__init__(width=width, height=height, min_width=min_width, min_height=min_height,
+                         cell_size=cell_size)
+
+    @property
+    def contours(self) -> List[ContourElement]:
+        return [ContourElement(box=box, active=active, group=group) for box, active, group in
+                zip(self.boxes.tolist(), self.active.tolist(), self.groups.tolist())]
+
+    @contours.setter
+    def contours(self, contours: List[ContourElement]):
+        # Replaces a loaded session's indexes, so they don't need building first
+        self._indexed = True
+        self._group_state = None
+        self._size = 0
+        self._reserve(len(contours))
+        for contour in contours:
+            self._append(contour.box, contour.group, contour.active)
+        self.grid.build(self.boxes)
+        self.size_buckets.build(self.boxes)
+        self.reading_order.build(self.boxes)
+        self.group_sets.build(self.groups)
+        self._mark(all=True)
+
+    # Views of the columns in use. These alias the container's storage, so copy them before holding on to them
+    @property
+    def boxes(self) -> np.ndarray:
+        return self._boxes[:self._size]
+
+    @property
+    def groups(self) -> np.ndarray:
+        return self._groups[:self._size]
+
+    @property
+    def active(self) -> np.ndarray:
+        return self._active[:self._size]
+
+    def _reserve(self, extra: int):
+        # The indexes of a loaded session are built from the columns as they are before the change
+        self._ensure_indexed()
+        needed = self._size + extra
+        if needed <= len(self._groups):
+            return
+        capacity = max(16, needed, 2 * len(self._groups))
+        boxes = np.empty((capacity, 4), dtype=np.int32)
+        groups = np.empty(capacity, dtype=np.int32)
+        active = np.empty(capacity, dtype=bool)
+        boxes[:self._size] = self.boxes
+        groups[:self._size] = self.groups
+        active[:self._size] = self.active
+        self._boxes, self._groups, self._active = boxes, groups, active
+        self._mapped = False
+
+    def _append(self, rect, group: int, active: bool = False):
+        self._reserve(1)
+        self._boxes[self._size] = rect
+        self._groups[self._size] = group
+        self._active[self._size] = active
+        self._size += 1
+
+    def add(self, contour=None, rect=None, group=0):
+        if contour is not None:
+            rect = boundingRect(contour)
+        if rect[2] < self.min_size[0] or rect[3] < self.min_size[1]:
+            return
+        pending = self._journal_begin('add', [int(x) for x in rect], group)
+        self._append(rect, group)
+        self.grid.add(self._size - 1, rect)
+        self.size_buckets.add(self._size - 1, rect[2], rect[3])
+        self.reading_order.add(self._size - 1, rect)
+        self.group_sets.add(self._size - 1, group)
+        self._mark([self._size - 1])
+        self._journal_end(pending)
+
+    def add_many(self, boxes, group: int = 0) -> int:
+        boxes = self._large_enough(boxes)
+        if not len(boxes):
+            return 0
+        pending = self._journal_begin('add_many', boxes, group)
+        start = self._size
+        self._reserve(len(boxes))
+        self._boxes[start:start + len(boxes)] = boxes
+        self._groups[start:start + len(boxes)] = group
+        self._active[start:start + len(boxes)] = False
+        self._size += len(boxes)
+        self._index_added(start, boxes, group)
+        self._journal_end(pending)
+        return len(boxes)
+
+    def truncate(self, count: int):
+        self._ensure_indexed()
+        for index in range(self._size - 1, count - 1, -1):
+            self.group_sets.discard(index, int(self._groups[index]))
+        self.group_sets.truncate(count)
+        self._size = count
+        self.grid.truncate(count)
+        self.size_buckets.truncate(count)
+        self.reading_order.truncate(count)
+        self._mark(all=True)
+
+    def remove(self, index: int):
+        assert 0 <= index < self._size, f"Subtracting illegal index of {index} from contours length {self._size}"
+        self._ensure_indexed()
+        pending = self._journal_begin('remove', index)
+        self.group_sets.remove(index, int(self._groups[index]))
+        # Shift the tail down in place, keeping the capacity
+        for column in (self._boxes, self._groups, self._active):
+            column[index:self._size - 1] = column[index + 1:self._size]
+        self._size -= 1
+        self.grid.remove(index)
+        self.size_buckets.remove(index)
+        self.reading_order.remove(index)
+        self._mark(all=True)
+        self._journal_end(pending)
+
+    def insert(self, index: int, rect: Sequence[int], group: int = 0, active: bool = False):
+        self._reserve(1)
+        for column in (self._boxes, self._groups, self._active):
+            column[index + 1:self._size + 1] = column[index:self._size]
+        self._boxes[index] = rect
+        self._groups[index] = group
+        self._active[index] = active
+        self._size += 1
+        self.grid.insert(index, rect)
+        self.size_buckets.insert(index, rect[2], rect[3])
+        self.reading_order.insert(index, rect)
+        self.group_sets.insert(index, group)
+        self._mark(all=True)
+
+    def _raw_label(self, index: int) -> int:
+        return int(self._groups[index])
+
+    def _raw_labels(self) -> np.ndarray:
+        return self.groups.astype(np.int64)
+
+    def _set_raw_labels(self, labels: Sequence[int]):
+        self.groups[:] = labels
+
+    def get_box(self, x_in: Optional[int]=None, y_in: Optional[int]=None, index: Optional[int] = None) -> Sequence[int]:
+        if index is None:
+            index = self.get_index_by_point(x_in, y_in)
+        if index < 0:
+            raise ContourNotFound(message=f"No contour found at {x_in}, {y_in}")
+        return tuple(self.boxes[index].tolist())
+
+    def get_box_array(self, group: Optional[int]=None, active: Optional[bool]=None, all: bool=False) -> np.ndarray:
+        """Same selection as get_boxes, returned as one (N, 4) array"""
+        if all:
+            return self.boxes.copy()
+        if active is not None:
+            return self.boxes[self.active == active]
+        if group is not None:
+            return self.boxes[self.group_sets.indices(group)]
+        return np.empty((0, 4), dtype=np.int32)
+
+    def get_group_array(self) -> np.ndarray:
+        return self.group_sets.resolve(self.groups)
+
+    def get_boxes(self, group: Optional[int]=None, active: Optional[bool]=None, all: bool=False):
+        if not all and active is None and group is None:
+            return
+        for box in self.get_box_array(group=group, active=active, all=all).tolist():
+            yield box
+
+    def get_session(self, exact: bool = False) -> Session:
+        return Session(min_size=list(self.min_size), boxes=self.boxes,
+                       groups=self.groups if exact else self.group_sets.resolve(self.groups), active=self.active,
+                       group_state=self.group_sets.state() if exact else None)
+
+    def set_session(self, session: Session):
+        # Adopt the session's columns as storage instead of copying them. For a binary session these are copy-on-write
+        # maps of the file, so only the parts that get used are read. The first append reallocates them as usual.
+        # The indexes are built the first time they are used, so loading itself reads none of the rows
+        self.min_size = list(session.min_size)
+        self._mapped = isinstance(session.boxes, np.memmap)
+        self._size = session.length
+        self._boxes = np.asarray(session.boxes, dtype=np.int32).reshape(-1, 4)
+        self._groups = np.asarray(session.groups, dtype=np.int32)
+        active = np.asarray(session.active)
+        # The file's one byte flags are read as bools in place, a cast would read them all
+        self._active = active.view(bool) if active.dtype == np.uint8 else active.astype(bool, copy=False)
+        self._indexed = False
+        self._group_state = session.group_state
+        self._mark(all=True)
+
+    def save(self, filename: str):
+        # Saving over the file the columns are mapped from fails on some platforms, so read them into memory first
+        if self._mapped:
+            self._boxes, self._groups, self._active = self.boxes.copy(), self.groups.copy(), self.active.copy()
+            self._mapped = False
+        super().save(filename)
+
+    def set_active(self, indices: Sequence[int], values):
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        pending = self._journal_begin('set_active', indices.tolist(), values)
+        self.active[indices] = values
+        self._mark(indices.tolist())
+        self._journal_end(pending)
+
+    def select_boxes(self, x_in: int=None, y_in: int=None, group=None, index: Optional[int]=None):
+        if group is not None:
+            self.set_active(self.group_sets.indices(group), True)
+            return
+        if index is None:
+            index = self.get_index_by_point(x_in, y_in)
+        self._check_index(index, x_in, y_in)
+        self.set_active([index], True)
+
+    def unselect_boxes(self, x_in: int=None, y_in: int=None, all=False, index=None):
+        if all:
+            self.set_active(np.flatnonzero(self.active), False)
+            return
+        if index is None:
+            index = self.get_index_by_point(x_in, y_in)
+        self._check_index(index, x_in, y_in)
+        self.set_active([index], False)
+
+    @property
+    def length(self):
+        return self._size
+
+    def get_active(self, index: int) -> bool:
+        return bool(self.active[index])
+
+    def get_group(self, index: int = None, selected: Optional[bool]=None) -> int:
+        if selected is not None:
+            selected_indices = np.flatnonzero(self.active)
+            if len(selected_indices):
+                return self.group_sets.find(int(self._groups[selected_indices[0]]))
+        if index is not None:
+            return self.group_sets.find(int(self.groups[index]))
+        return -1
+
+    def set_group(self, setting: int, index: int = None, all=False):
+        if all:
+            self._check_group(setting)
+            pending = self._journal_begin('set_group_all', setting)
+            self.groups[:] = setting
+            self.group_sets.build(self.groups)
+            self._mark(all=True)
+            self._journal_end(pending)
+        if index is not None:
+            self._check_index(index)
+            self._check_group(setting)
+            pending = self._journal_begin('set_group', setting, index)
+            self.group_sets.move(index, int(self.groups[index]), setting)
+            self.groups[index] = setting
+            self._mark([index])
+            self._journal_end(pending)
+            return
+
+    def set_groups(self, indices: Sequence[int], groups: Sequence[int]):
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        groups = np.asarray(groups, dtype=np.int64).reshape(-1)
+        if len(indices) and (indices.min() < 0 or indices.max() >= self._size):
+            bad = indices[(indices < 0) | (indices >= self._size)][0]
+            raise ContourNotFound(message=f"No contour found at index {bad}")
+        if len(groups) and groups.min() < 0:
+            self._check_group(int(groups.min()))
+        pending = self._journal_begin('set_groups', indices.tolist(), groups.tolist())
+        for index, group in zip(indices.tolist(), groups.tolist()):
+            self.group_sets.move(index, int(self.groups[index]), group)
+            self.groups[index] = group
+        self._mark(indices.tolist())
+        self._journal_end(pending)
@@ -0,0 +1,183 @@
+"""DerivativeCache
+
+On-disk cache of the things worked out from an image before any grouping starts: the decoded color and grayscale
+images, the dilated images, the contour boxes and the box descriptors. Opening an image that has been seen before then
+skips decoding the PNG, finding the contours and computing descriptors.
+
+Entries are content addressed: the key is a hash of the image file's bytes, what was computed and the parameters it
+was computed with, so an edited image or a changed parameter never gets a stale entry. Each entry is one .npy file.
+Once the cache grows past max_bytes, the least recently used entries are deleted.
+"""
+import hashlib
+import json
+import os
+from typing import Callable, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from FeatureGrouping import box_descriptors
+from Matching import dilate_image
+
+DEFAULT_DIRECTORY = '.symbol_cache'
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+class DerivativeCache:
+    """Arrays stored on disk under keys made from a content hash and parameters
+
+    :param directory: Where the entries go, created if needed
+    :param max_bytes: Size the entries are evicted down to, least recently used first
+    """
+    def __init__(self, directory: str = DEFAULT_DIRECTORY, max_bytes: int = 1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(source_hash: str, kind: str, **params) -> str:
+        return content_hash(json.dumps([source_hash, kind, params], sort_keys=True).encode())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.npy')
+
+    def load(self, key: str) -> Optional[np.ndarray]:
+        path = self._path(key)
+        try:
+            array = np.load(path, allow_pickle=False)
+        except (FileNotFoundError, ValueError, EOFError):
+            # Missing, or cut short by a crash while it was written
+            return None
+        # The modification time is the last use, for eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return array
+
+    def store(self, key: str, array: np.ndarray):
+        path = self._path(key)
+        # Named for the process, so batch workers storing the same entry don't write into each other's file
+        temp_name = f"{path}.{os.getpid()}.tmp"
+        with open(temp_name, 'wb') as fp:
+            np.save(fp, np.ascontiguousarray(array), allow_pickle=False)
+        os.replace(temp_name, path)
+        self.evict()
+
+    def get(self, source_hash: str, kind: str, compute: Callable[[], np.ndarray], **params) -> np.ndarray:
+        """The cached array for source_hash, kind and params, computing and storing it if there isn't one"""
+        key = self.key(source_hash, kind, **params)
+        array = self.load(key)
+        if array is not None:
+            self.hits += 1
+            return array
+        self.misses += 1
+        array = compute()
+        self.store(key, array)
+        return array
+
+    def _entries(self):
+        """Modification time, size and path of every entry"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits in max_bytes"""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, path in self._entries():
+            os.remove(path)
+
+    # The derivatives. Each is keyed by the hash of the image file, from load_image
+
+    def load_image(self, path: str) -> Tuple[np.ndarray, np.ndarray, str]:
+        """
+        SymbolPipeline.load_image, but decoded only the first time
+        :return: The BGR image, the single channel image, and the image file's hash for the other derivatives
+        """
+        try:
+            with open(path, 'rb') as fp:
+                source_hash = content_hash(fp.read())
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Could not read image {path}")
+
+        def decode():
+            base_image = cv2.imread(path)
+            if base_image is None:
+                raise FileNotFoundError(f"Could not read image {path}")
+            return base_image
+        base_image = self.get(source_hash, 'bgr', decode)
+        gray = self.get(source_hash, 'gray', lambda: cv2.cvtColor(base_image, cv2.COLOR_BGR2GRAY))
+        return base_image, gray, source_hash
+
+    def dilated(self, source_hash: str, gray, kernel_size: Sequence[int]) -> np.ndarray:
+        return self.get(source_hash, 'dilated', lambda: dilate_image(gray, kernel_size),
+                        kernel_size=[int(x) for x in kernel_size])
+
+    def contour_boxes(self, source_hash: str, gray, dilate: bool = False, components: bool = False) -> np.ndarray:
+        """SymbolPipeline.find_boxes, the boxes get_contours adds to the container"""
+        # Imported here, SymbolPipeline uses this module
+        from SymbolPipeline import find_boxes
+        return self.get(source_hash, 'contour_boxes', lambda: find_boxes(gray, dilate, components),
+                        dilate=dilate, components=components)
+
+    def descriptors(self, source_hash: str, gray, boxes: np.ndarray, size: Sequence[int] = (8, 12),
+                    kernel_size: Sequence[int] = (2, 2)) -> np.ndarray:
+        """FeatureGrouping.box_descriptors of the boxes, on the image dilated with kernel_size"""
+        boxes = np.ascontiguousarray(boxes, dtype=np.int32)
+        return self.get(source_hash, 'descriptors',
+                        lambda: box_descriptors(self.dilated(source_hash, gray, kernel_size), boxes, size),
+                        boxes=content_hash(boxes.tobytes()), size=[int(x) for x in size],
+                        kernel_size=[int(x) for x in kernel_size])
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from SymbolPipeline import new_container
+
+    parser = argparse.ArgumentParser(description='Time opening an image with and without the derivative cache.')
+    parser.add_argument('image', help='Black and white image, symbols in white')
+    parser.add_argument('--dir', help='Cache directory', default=DEFAULT_DIRECTORY)
+    parser.add_argument('--clear', help='Empty the cache first', action='store_true')
+    args = parser.parse_args()
+
+    cache = DerivativeCache(args.dir)
+    if args.clear:
+        cache.clear()
+    for run in ('first', 'second'):
+        start = time.perf_counter()
+        _, gray, source_hash = cache.load_image(args.image)
+        contour_container = new_container(gray)
+        contour_container.add_many(cache.contour_boxes(source_hash, gray))
+        # The boxes the 'f' grouping in MatchSymbols asks for descriptors of
+        cache.descriptors(source_hash, gray, contour_container.get_box_array(all=True))
+        print(f"{run}: {contour_container.length} boxes in {time.perf_counter() - start:.3f} s, {cache.hits} hits, "
+              f"{cache.misses} misses")
+    print(f"{cache.size() / 1024 / 1024:.1f} MB cached in {args.dir}")
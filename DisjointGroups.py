@@ -0,0 +1,346 @@
+"""DisjointGroups
+
+Union-find over symbol group ids, with an index of which contours are in each group. Merging two groups just links
+their roots, so auto-grouping can join groups transitively instead of overwriting one group with another.
+"""
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+# Group ids are stored as int32
+MAX_GROUP = np.iinfo(np.int32).max
+
+
+class DisjointGroups:
+    """Disjoint sets of group ids, plus the contour indices in each set
+
+    Contours keep the group id they were given, and find() maps it to the id of the root of its set, which is the
+    group id everything else sees. Group 0 is the unclassified group and is never merged.
+    Groups that lose their last member are dropped along with every id merged into them, and merging in an id that
+    has no members doesn't keep it, so max_group is always the highest id still in use and max_group + 1 is always
+    free for a new group.
+
+    Membership is kept in arrays rather than a set per group: the id each contour was given, and the contour indices
+    sorted by that id, rebuilt lazily. A group's members are the runs of that order for each id merged into it, plus
+    the contours that changed group since the order was built. Merging doesn't change the ids the contours were given,
+    so it doesn't touch the order at all. That is 12 bytes per contour, plus the contours changed since the last
+    rebuild.
+    :param max_pending: Contours that can change group before the order is rebuilt, at least. It also grows with the
+        number of contours
+    """
+    def __init__(self, max_pending: int = 1024):
+        self.max_pending = max_pending
+        self._parent: Dict[int, int] = {}
+        self._labels: Dict[int, List[int]] = {}
+        self._sizes: Dict[int, int] = {}
+        self.max_group = 0
+        self.clear()
+
+    def clear(self):
+        self._parent = {0: 0}
+        self._labels = {0: [0]}
+        self._sizes = {0: 0}
+        self.max_group = 0
+        # Every known id, sorted, and its root. Ids not in it are their own root
+        self._ids = np.zeros(1, dtype=np.int64)
+        self._id_roots = np.zeros(1, dtype=np.int64)
+        # Id each contour was given
+        self._given = np.empty(0, dtype=np.int32)
+        self._count = 0
+        # Contour indices sorted by the id they had when it was built, and those ids
+        self._order = np.empty(0, dtype=np.int32)
+        self._order_labels = np.empty(0, dtype=np.int32)
+        self._changed: Set[int] = set()
+        self._dirty = False
+
+    def _set_given(self, labels):
+        labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        if labels.size and (labels.min() < 0 or labels.max() > MAX_GROUP):
+            raise ValueError(f"Group ids must be from 0 to {MAX_GROUP}, got {labels.min()} to {labels.max()}")
+        self._given = labels.astype(np.int32)
+        self._count = len(labels)
+        self._changed = set()
+        self._dirty = True
+        return labels
+
+    def build(self, labels):
+        """Reset to one set per distinct id, contour i being in group labels[i]"""
+        self.clear()
+        labels = self._set_given(labels)
+        unique, counts = np.unique(labels, return_counts=True)
+        for label, count in zip(unique.tolist(), counts.tolist()):
+            self._register(label)
+            self._sizes[label] = count
+
+    def _register(self, label: int):
+        if label in self._parent:
+            return
+        if not 0 <= label <= MAX_GROUP:
+            raise ValueError(f"Group ids must be from 0 to {MAX_GROUP}, got {label}")
+        self._parent[label] = label
+        self._sizes[label] = 0
+        self._labels[label] = [label]
+        self._set_roots([label], label)
+        if label > self.max_group:
+            self.max_group = label
+
+    def _positions(self, labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Where labels are, or would go, in _ids, and which of them are there"""
+        positions = np.searchsorted(self._ids, labels)
+        found = self._ids[np.minimum(positions, len(self._ids) - 1)] == labels
+        return positions, found
+
+    def _set_roots(self, labels: Sequence[int], root: int):
+        labels = np.asarray(labels, dtype=np.int64)
+        positions, found = self._positions(labels)
+        if not found.all():
+            new = np.unique(labels[~found])
+            at = np.searchsorted(self._ids, new)
+            self._ids = np.insert(self._ids, at, new)
+            self._id_roots = np.insert(self._id_roots, at, new)
+            positions = np.searchsorted(self._ids, labels)
+        self._id_roots[positions] = root
+
+    def _forget_roots(self, labels: Sequence[int]):
+        positions, found = self._positions(np.asarray(labels, dtype=np.int64))
+        self._ids = np.delete(self._ids, positions[found])
+        self._id_roots = np.delete(self._id_roots, positions[found])
+
+    def find(self, label: int) -> int:
+        parent = self._parent
+        if label not in parent:
+            return label
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]
+            label = parent[label]
+        return label
+
+    def union(self, label_a: int, label_b: int) -> int:
+        """Merge two groups, returning the id of the merged group"""
+        return self.merge(label_a, label_b)[0]
+
+    def merge(self, label_a: int, label_b: int) -> Tuple[int, np.ndarray]:
+        """
+        Same as union
+        :return: Id of the merged group, and the contours whose group id changed
+        """
+        assert label_a != 0 and label_b != 0, f"Group 0 is unclassified and can't be merged"
+        root_a, root_b = self.merge_roots(label_a, label_b)
+        # The absorbed group is the smaller one, if it has no members there is nothing to merge, and its id isn't kept
+        if root_a == root_b or not self._sizes.get(root_b, 0):
+            return root_a, np.empty(0, dtype=np.int64)
+        moved = self.members(root_b)
+        self._parent[root_b] = root_a
+        self._sizes[root_a] += self._sizes.pop(root_b)
+        absorbed = self._labels.pop(root_b)
+        self._labels[root_a] += absorbed
+        self._set_roots(absorbed, root_a)
+        return root_a, moved
+
+    def merge_roots(self, label_a: int, label_b: int) -> Tuple[int, int]:
+        """
+        Which group merge would keep, and which it would fold into it
+        :return: Root that is kept, root that is absorbed. The same root twice if they are already one group
+        """
+        root_a, root_b = self.find(label_a), self.find(label_b)
+        # Union by size, the smaller set's members and ids are folded into the larger
+        size_a, size_b = self._sizes.get(root_a, 0), self._sizes.get(root_b, 0)
+        if (size_a, -root_a) < (size_b, -root_b):
+            root_a, root_b = root_b, root_a
+        return root_a, root_b
+
+    def known(self, label: int) -> bool:
+        return label in self._parent
+
+    def size(self, label: int) -> int:
+        """Number of contours in a group"""
+        return self._sizes.get(self.find(label), 0)
+
+    def group_state(self, label: int) -> Tuple[int, List[int], List[int]]:
+        """Copy of a group, as its root, every id merged into it and its members, for restore"""
+        root = self.find(label)
+        return root, list(self._labels[root]), self.members(root).tolist()
+
+    def restore(self, root: int, labels: Sequence[int], members: Sequence[int]):
+        """
+        Put back a group saved with group_state, replacing whatever the ids in it are now
+        The contours must already have the ids they had when it was saved, members only gives the group's size
+        """
+        for label in labels:
+            self._sizes.pop(label, None)
+            self._labels.pop(label, None)
+            self._parent[label] = root
+        self._sizes[root] = len(members)
+        self._labels[root] = list(labels)
+        self._set_roots(labels, root)
+        self.max_group = max(self.max_group, max(labels))
+
+    def unmerge(self, root: int, absorbed: Optional[Tuple[int, List[int], List[int]]]):
+        """
+        Undo a merge, given the state of the absorbed group from before it
+        :param root: Root the merge kept
+        :param absorbed: group_state of the absorbed root before the merge, None if the merge did not join anything
+        """
+        if absorbed is None:
+            return
+        absorbed_root, labels, members = absorbed
+        # merge appended the absorbed ids to the root's list, and undo happens in reverse order, so they are last
+        del self._labels[root][-len(labels):]
+        self._sizes[root] -= len(members)
+        self.restore(absorbed_root, labels, members)
+
+    def state(self) -> Tuple[List[Tuple[int, int]], List[Tuple[int, List[int]]]]:
+        """How the ids are merged, as (id, parent) pairs and the ids in each group, for set_state"""
+        return list(self._parent.items()), [(root, list(labels)) for root, labels in self._labels.items()]
+
+    def set_state(self, state, labels):
+        """
+        Put back the merges saved with state, the reverse of build for a container with merged groups
+        :param labels: Group id each contour was given
+        """
+        parents, groups = state
+        self.clear()
+        self._parent = {int(label): int(parent) for label, parent in parents}
+        self._labels = {int(root): [int(label) for label in merged] for root, merged in groups}
+        for root, merged in self._labels.items():
+            if not all(0 <= label <= MAX_GROUP for label in merged):
+                raise ValueError(f"Group ids must be from 0 to {MAX_GROUP}, got {merged}")
+            self._set_roots(merged, root)
+        resolved = self.resolve(self._set_given(labels))
+        self._sizes = {root: 0 for root in self._labels}
+        unique, counts = np.unique(resolved, return_counts=True)
+        self._sizes.update(zip(unique.tolist(), counts.tolist()))
+        # Groups without members, from a session saved before they were dropped, are dropped like discard does
+        for root in [root for root, size in self._sizes.items() if size == 0 and root != 0]:
+            self._drop(root)
+        self.max_group = max(self._parent)
+
+    def _set_label(self, index: int, label: int):
+        """Give a contour an id, appending it if it is a new one"""
+        if index == self._count:
+            if self._count == len(self._given):
+                grown = np.empty(max(16, 2 * len(self._given)), dtype=np.int32)
+                grown[:self._count] = self._given[:self._count]
+                self._given = grown
+            self._count += 1
+        self._given[index] = label
+        self._changed_one(index)
+
+    def _changed_one(self, index: int):
+        if self._dirty:
+            return
+        self._changed.add(index)
+        if len(self._changed) > max(self.max_pending, self._count // 8):
+            self._dirty = True
+            self._changed = set()
+
+    def add(self, index: int, label: int):
+        self._register(label)
+        self._sizes[self.find(label)] += 1
+        self._set_label(int(index), label)
+
+    def add_many(self, indices: Iterable[int], label: int):
+        """Add many contours to the same group, given as a run of indices from the end"""
+        indices = np.fromiter(indices, dtype=np.int64)
+        if len(indices) == 0:
+            return
+        self._register(label)
+        self._sizes[self.find(label)] += len(indices)
+        end = max(self._count, int(indices.max()) + 1)
+        if end > len(self._given):
+            grown = np.empty(max(16, end, 2 * len(self._given)), dtype=np.int32)
+            grown[:self._count] = self._given[:self._count]
+            self._given = grown
+        self._count = end
+        self._given[indices] = label
+        if len(indices) > self.max_pending:
+            self._dirty = True
+            self._changed = set()
+        else:
+            for index in indices.tolist():
+                self._changed_one(index)
+
+    def discard(self, index: int, label: int):
+        """Take a contour out of its group. Its index stays until it is given a group again, or truncated away"""
+        root = self.find(label)
+        self._sizes[root] -= 1
+        if self._sizes[root] or root == 0:
+            return
+        # Last member gone, drop the group and every id that was merged into it
+        if self.max_group in self._drop(root):
+            self.max_group = max(self._parent)
+
+    def _drop(self, root: int) -> List[int]:
+        """Forget a group and every id that was merged into it, returning those ids"""
+        labels = self._labels.pop(root)
+        del self._sizes[root]
+        for merged in labels:
+            del self._parent[merged]
+        self._forget_roots(labels)
+        return labels
+
+    def truncate(self, count: int):
+        """Forget the ids of the contours from index count up, after they have been discarded"""
+        self._count = min(self._count, count)
+        self._dirty = True
+
+    def move(self, index: int, old_label: int, new_label: int):
+        if old_label == new_label:
+            return
+        if new_label in self._parent and self.find(old_label) == self.find(new_label):
+            # Same group, but the id still matters if the merge is undone
+            self._set_label(int(index), new_label)
+            return
+        self.discard(index, old_label)
+        self.add(index, new_label)
+
+    def remove(self, index: int, label: int):
+        """Remove a contour entirely. Higher indices shift down by one"""
+        self.discard(index, label)
+        self._given = np.delete(self._given[:self._count], index)
+        self._count -= 1
+        self._dirty = True
+
+    def insert(self, index: int, label: int):
+        """Add a contour at index. Indices from there up shift up by one"""
+        self._register(label)
+        self._sizes[self.find(label)] += 1
+        self._given = np.insert(self._given[:self._count], index, label)
+        self._count += 1
+        self._dirty = True
+
+    def _ensure_built(self):
+        if not self._dirty:
+            return
+        given = self._given[:self._count]
+        self._order = np.argsort(given, kind='stable').astype(np.int32)
+        self._order_labels = given[self._order]
+        self._changed = set()
+        self._dirty = False
+
+    def members(self, label: int) -> np.ndarray:
+        """Sorted contour indices in a group"""
+        root = self.find(label)
+        if root not in self._labels:
+            return np.empty(0, dtype=np.int64)
+        self._ensure_built()
+        labels = np.array(self._labels[root], dtype=np.int64)
+        starts = np.searchsorted(self._order_labels, labels, side='left')
+        counts = np.searchsorted(self._order_labels, labels, side='right') - starts
+        offset = np.arange(counts.sum(), dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = self._order[np.repeat(starts, counts) + offset].astype(np.int64)
+        if self._changed:
+            candidates = np.concatenate((candidates, np.fromiter(self._changed, dtype=np.int64)))
+        # Contours that changed group since the order was built are in it under their old id
+        candidates = candidates[candidates < self._count]
+        candidates = candidates[self.resolve(self._given[candidates]) == root]
+        return np.unique(candidates)
+
+    def indices(self, label: int) -> np.ndarray:
+        """Sorted contour indices in a group"""
+        return self.members(label)
+
+    def resolve(self, labels) -> np.ndarray:
+        """Vectorized find, turn an array of stored group ids into the ids of their merged groups"""
+        labels = np.asarray(labels, dtype=np.int64)
+        positions, found = self._positions(labels)
+        return np.where(found, self._id_roots[np.minimum(positions, len(self._ids) - 1)], labels)
@@ -0,0 +1,78 @@
+"""Display
+
+Drawing the contour boxes over the image for MatchSymbols. Identified symbols are boxed in Blue, Active symbols are
+in Green.
+"""
+from typing import Optional, Sequence
+
+import cv2
+import numpy as np
+
+from ContourContainer import ContourContainer
+
+ACTIVE_COLOR = (0, 255, 0)
+INACTIVE_COLOR = (255, 0, 0)
+
+
+class BoxRenderer:
+    """Keeps an annotated copy of the image and only redraws what changed in the container
+
+    Each frame, render() checks the container's version. If nothing changed it returns None and does no work.
+    Otherwise it takes the changed indices from the container, and for each changed box puts the original image
+    back in the box's area, then redraws every box overlapping that area, clipped to it. Boxes are drawn active first,
+    then inactive, each in index order, the same as a full redraw, so the result is identical to drawing everything
+    from scratch. After a remove or load, or when most of the boxes changed, it does redraw from scratch.
+    """
+    def __init__(self, base_image, thickness: int = 2, full_redraw_fraction: float = 0.25):
+        self.base_image = base_image
+        self.thickness = thickness
+        self.full_redraw_fraction = full_redraw_fraction
+        self.frame: Optional[np.ndarray] = None
+        self._version = None
+
+    def _draw(self, image, boxes, color, offset: Sequence[int] = (0, 0)):
+        for x, y, w, h in boxes.tolist():
+            x, y = x - offset[0], y - offset[1]
+            cv2.rectangle(image, (x, y), (x + w, y + h), color, self.thickness)
+
+    def redraw(self, contours: ContourContainer) -> np.ndarray:
+        self.frame = self.base_image.copy()
+        self._draw(self.frame, contours.get_box_array(active=True), ACTIVE_COLOR)
+        self._draw(self.frame, contours.get_box_array(active=False), INACTIVE_COLOR)
+        return self.frame
+
+    def _redraw_area(self, contours: ContourContainer, box: Sequence[int]):
+        # A rectangle line of thickness t reaches t // 2 + 1 pixels past the box edge
+        reach = self.thickness // 2 + 1
+        x, y, w, h = box
+        left, top = max(x - reach, 0), max(y - reach, 0)
+        right = min(x + w + reach + 1, self.frame.shape[1])
+        bottom = min(y + h + reach + 1, self.frame.shape[0])
+        if right <= left or bottom <= top:
+            return
+        area = self.frame[top:bottom, left:right]
+        area[:] = self.base_image[top:bottom, left:right]
+
+        # Any box whose line could reach into the area
+        nearby = contours.get_indices_in_rect([left - reach, top - reach, right - left + 2 * reach,
+                                               bottom - top + 2 * reach])
+        active = np.array([contours.get_active(index) for index in nearby.tolist()], dtype=bool)
+        boxes = np.array([contours.get_box(index=index) for index in nearby.tolist()], dtype=np.int64).reshape(-1, 4)
+        self._draw(area, boxes[active], ACTIVE_COLOR, offset=(left, top))
+        self._draw(area, boxes[~active], INACTIVE_COLOR, offset=(left, top))
+
+    def render(self, contours: ContourContainer) -> Optional[np.ndarray]:
+        """
+        Bring the annotated frame up to date with the container
+        :return: The frame, or None if nothing changed since the last call
+        """
+        if self.frame is not None and contours.version == self._version:
+            return None
+        self._version = contours.version
+        changed = contours.take_changes()
+        if self.frame is None or changed is None or len(changed) > self.full_redraw_fraction * contours.length:
+            return self.redraw(contours)
+        for index in sorted(changed):
+            if index < contours.length:
+                self._redraw_area(contours, contours.get_box(index=index))
+        return self.frame
@@ -0,0 +1,144 @@
+"""FeatureGrouping
+
+Fast automatic grouping that compares small fixed-size thumbnails of the boxes, instead of running every ungrouped
+box as a template over the whole image.
+
+Each box is area-sampled down to a few rows and columns of the dilated image, and the thumbnail has its mean removed
+and is scaled to unit length. The dot product of two of these descriptors is then the same correlation score
+TM_CCOEFF_NORMED gives for two aligned boxes, so the same thresh_val can be used. All descriptors are computed in one
+batched pass from the integral image, and each new group is found with one vectorized dot product against the
+remaining boxes.
+
+Run this file directly to compare the result and speed against template matching:
+    python FeatureGrouping.py Inputs/DetBwMod.png
+"""
+import time
+from typing import Optional, Sequence
+
+import cv2
+import numpy as np
+
+from AutoGrouper import AutoGroupStats, apply_match_indices
+from ContourContainer import ContourContainer
+from Matching import dilate_image
+
+
+def box_descriptors(image, boxes, size: Sequence[int] = (8, 12)) -> np.ndarray:
+    """
+    Thumbnail descriptor for every box, normalized so dot products are correlation scores
+    :param image: Single channel image
+    :param boxes: (N, 4) array like of x, y, w, h boxes
+    :param size: Columns, rows of the thumbnail
+    :return: (N, columns * rows) float32 array
+    """
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    columns, rows = size
+    height, width = image.shape[:2]
+    integral = cv2.integral(image, sdepth=cv2.CV_64F)
+
+    def cell_edges(start, length, limit, cells):
+        start = np.clip(start, 0, limit - 1)
+        stop = np.clip(start + length, start + 1, limit)
+        edges = np.rint(start[:, None] + (stop - start)[:, None] * np.linspace(0, 1, cells + 1)).astype(np.int64)
+        # Every cell gets at least one pixel, even for boxes smaller than the thumbnail
+        low = np.minimum(edges[:, :-1], limit - 1)
+        return low, np.maximum(edges[:, 1:], low + 1)
+
+    left, right = cell_edges(boxes[:, 0], boxes[:, 2], width, columns)
+    top, bottom = cell_edges(boxes[:, 1], boxes[:, 3], height, rows)
+    left, right = left[:, None, :], right[:, None, :]
+    top, bottom = top[:, :, None], bottom[:, :, None]
+    sums = integral[bottom, right] - integral[top, right] - integral[bottom, left] + integral[top, left]
+    descriptors = (sums / ((bottom - top) * (right - left))).reshape(len(boxes), -1)
+
+    descriptors -= descriptors.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(descriptors, axis=1, keepdims=True)
+    return (descriptors / np.maximum(norms, 1e-6)).astype(np.float32)
+
+
+def rand_index(groups_a, groups_b) -> float:
+    """Fraction of box pairs two groupings agree on (same group in both, or different in both). Group 0 is unmatched,
+    so ungrouped boxes count as being on their own"""
+    groups_a = np.asarray(groups_a, dtype=np.int64)
+    groups_b = np.asarray(groups_b, dtype=np.int64)
+    count = len(groups_a)
+    if count < 2:
+        return 1.0
+    singles = -1 - np.arange(count)
+    groups_a = np.where(groups_a == 0, singles, groups_a)
+    groups_b = np.where(groups_b == 0, singles, groups_b)
+
+    def pairs(counts):
+        return (counts * (counts - 1) // 2).sum()
+
+    _, joint = np.unique(np.stack((groups_a, groups_b)), axis=1, return_counts=True)
+    same_both = pairs(joint)
+    same_a = pairs(np.unique(groups_a, return_counts=True)[1])
+    same_b = pairs(np.unique(groups_b, return_counts=True)[1])
+    total = count * (count - 1) // 2
+    return (total - same_a - same_b + 2 * same_both) / total
+
+
+class FeatureGrouper:
+    """Group contours by clustering their thumbnail descriptors
+
+    Works like the 'z' grouping: each ungrouped box in index order starts a new group, and takes every box of a similar
+    size whose descriptor scores at least thresh_val against it. Boxes that are already in a group have their group
+    merged in.
+    :param thresh_val: Minimum correlation between two descriptors, same scale as the template matching threshold
+    :param size: Columns, rows of the thumbnail descriptor
+    :param size_tolerance: How far the width and height of a match can be from the box, as a fraction of its size
+    :param kernel_size: Dilation kernel, same as get_matches_from_rect
+    """
+    def __init__(self, thresh_val: float = 0.7, size: Sequence[int] = (8, 12), size_tolerance: float = 0.25,
+                 kernel_size: Sequence[int] = (2, 2)):
+        self.thresh_val = thresh_val
+        self.size = size
+        self.size_tolerance = size_tolerance
+        self.kernel_size = kernel_size
+
+    def run(self, gray, contours: ContourContainer, descriptors: Optional[np.ndarray] = None) -> AutoGroupStats:
+        """
+        Group the contours in place, and return how long it took
+        :param descriptors: box_descriptors of all the boxes with this grouper's size and kernel_size, if already made
+        """
+        stats = AutoGroupStats()
+        start = time.perf_counter()
+        boxes = contours.get_box_array(all=True)
+        if descriptors is None:
+            descriptors = box_descriptors(dilate_image(gray, self.kernel_size), boxes, self.size)
+        ungrouped = contours.get_group_array() == 0
+
+        for index in np.flatnonzero(ungrouped).tolist():
+            if not ungrouped[index]:
+                continue
+            candidates = contours.get_indices_by_size(boxes[index, 2], boxes[index, 3], self.size_tolerance)
+            scores = descriptors[candidates] @ descriptors[index]
+            matched = candidates[scores >= self.thresh_val]
+            apply_match_indices(contours, index, matched[matched != index])
+            ungrouped[matched] = False
+            ungrouped[index] = False
+            stats.matched += 1
+        stats.seconds = time.perf_counter() - start
+        return stats
+
+
+if __name__ == "__main__":
+    import argparse
+    from AutoGrouper import AutoGrouper
+    from SymbolPipeline import get_contours, load_image, new_container
+
+    parser = argparse.ArgumentParser(description='Compare feature grouping against template matching.')
+    parser.add_argument('image', help='Black and white image, symbols in white')
+    parser.add_argument('--thresh', help='Match threshold', type=float, default=0.7)
+    args = parser.parse_args()
+
+    _, gray = load_image(args.image)
+    results = []
+    for grouper in (AutoGrouper(thresh_val=args.thresh), FeatureGrouper(thresh_val=args.thresh)):
+        contour_container = new_container(gray)
+        get_contours(gray, contour_container)
+        print(f"{type(grouper).__name__}: {grouper.run(gray, contour_container)}, "
+              f"{len(np.unique(contour_container.get_group_array()))} groups")
+        results.append(contour_container.get_group_array())
+    print(f"Rand index between the two: {rand_index(*results):.3f}")
@@ -0,0 +1,229 @@
+"""Journal
+
+Append-only journal of the changes to a ContourContainer, for autosave and undo.
+
+Every change the container makes is written as one JSON line holding a sequence number and the operation, and flushed
+straight away, so a crash loses at most the change in progress. Every so often the journal is compacted: the container
+is saved to a binary snapshot (SessionFile.py) on a background thread, and the journal is cut down to the operations
+after it. Recovering is loading the snapshot and replaying the operations after its sequence number.
+
+For undo, the container also hands over the operation that reverses each change, so undoing and redoing is applying
+operations to the container, without ever copying it. Changes can be grouped into actions, so a whole key press or
+click is undone at once.
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from ContourContainer import ContourContainer
+from SessionFile import Session, load_session, save_session
+
+
+def _to_json(value):
+    # NumPy ints and bools come in from index arrays, and add_many passes its boxes as an array
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError(f"Can't journal {type(value).__name__}")
+
+
+class OperationJournal:
+    """Records the operations applied to a container in <base_path>.journal, with snapshots in <base_path>.sym
+
+    Call recover() to load the last state back into the container if there is one, or start() to begin a new journal
+    from what the container holds now. close() deletes both files, so there is only something to recover after a
+    crash. The undo history lives in memory, so it starts empty again after a recover.
+    :param compact_every: Compact once the journal holds this many operations
+    :param max_undo: Number of actions kept for undo
+    """
+    def __init__(self, contours: ContourContainer, base_path: str, compact_every: int = 2000, max_undo: int = 200):
+        self.contours = contours
+        self.journal_path = base_path + '.journal'
+        self.snapshot_path = base_path + '.sym'
+        self.compact_every = compact_every
+        self.max_undo = max_undo
+        self.sequence = 0
+        self._file = None
+        self._lines: List[str] = []
+        self._lock = threading.Lock()
+        self._compactor: Optional[threading.Thread] = None
+        # Each action is a list of (operation, undo operation) pairs
+        self._undo: List[List[Tuple[list, list]]] = []
+        self._redo: List[List[Tuple[list, list]]] = []
+        self._action: Optional[List[Tuple[list, list]]] = None
+        self._depth = 0
+        self._applying: Optional[List[Tuple[list, list]]] = None
+
+    def exists(self) -> bool:
+        return os.path.exists(self.snapshot_path)
+
+    def start(self):
+        """Start a new journal from the current contents of the container"""
+        self.contours.journal = None
+        self.sequence = 0
+        self._lines = []
+        self._write_snapshot(self._take_snapshot(), 0)
+        self.contours.journal = self
+
+    def recover(self) -> int:
+        """
+        Load the snapshot into the container and replay the journal after it
+        :return: Number of operations replayed
+        """
+        self.contours.journal = None
+        # Read into memory, the snapshot file gets replaced by the next compaction
+        session = load_session(self.snapshot_path, mmap=False)
+        self.contours.set_session(session)
+        self.sequence = session.sequence
+        lines = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r') as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A line cut short by a crash, nothing after it was written
+                        break
+                    if entry[0] <= self.sequence:
+                        continue
+                    self.contours.apply(entry[1:])
+                    self.sequence = entry[0]
+                    lines.append(line.rstrip('\n'))
+        with self._lock:
+            self._lines = lines
+            self._rewrite_journal(0)
+        self.contours.journal = self
+        return len(lines)
+
+    def record(self, op: list, undo: Optional[list]):
+        """Called by the container for every change, with the operation that reverses it"""
+        self.sequence += 1
+        line = json.dumps([self.sequence] + op, default=_to_json)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+            self._lines.append(line)
+        if self._applying is not None:
+            self._applying.append((op, undo))
+            return
+        if self._action is not None:
+            self._action.append((op, undo))
+            return
+        self._push([(op, undo)])
+
+    def _push(self, action: List[Tuple[list, list]]):
+        self._undo.append(action)
+        del self._undo[:-self.max_undo]
+        self._redo.clear()
+        if len(self._lines) >= self.compact_every:
+            self.compact()
+
+    @contextmanager
+    def action(self):
+        """Group every change made inside the with block into one undo step"""
+        self._depth += 1
+        if self._depth == 1:
+            self._action = []
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                action, self._action = self._action, None
+                if action:
+                    self._push(action)
+
+    def _apply_all(self, ops: List[list]) -> List[Tuple[list, list]]:
+        self._applying = []
+        try:
+            for op in ops:
+                self.contours.apply(op)
+            return self._applying
+        finally:
+            self._applying = None
+
+    def undo(self) -> bool:
+        """Undo the last action, returning False if there is nothing to undo"""
+        if not self._undo or self._action is not None:
+            return False
+        action = self._undo.pop()
+        self._apply_all([undo for _, undo in reversed(action)])
+        self._redo.append(action)
+        return True
+
+    def redo(self) -> bool:
+        """Redo the last undone action, returning False if there is nothing to redo"""
+        if not self._redo or self._action is not None:
+            return False
+        action = self._redo.pop()
+        self._undo.append(self._apply_all([op for op, _ in action]))
+        return True
+
+    def _take_snapshot(self) -> Session:
+        # Copies, so the container can keep changing while the snapshot is written
+        session = self.contours.get_session(exact=True)
+        return Session(min_size=list(session.min_size), boxes=np.array(session.boxes),
+                       groups=np.array(session.groups), active=np.array(session.active), sequence=self.sequence,
+                       group_state=session.group_state)
+
+    def _rewrite_journal(self, count: int):
+        """Drop the first count lines of the journal. Call with the lock held"""
+        if self._file is not None:
+            self._file.close()
+        del self._lines[:count]
+        temp_name = self.journal_path + '.tmp'
+        with open(temp_name, 'w') as fp:
+            fp.writelines(line + '\n' for line in self._lines)
+        os.replace(temp_name, self.journal_path)
+        self._file = open(self.journal_path, 'a')
+
+    def _write_snapshot(self, session: Session, count: int):
+        # The snapshot goes first. If the journal is not cut down after it, replay skips what the snapshot holds
+        save_session(self.snapshot_path, session)
+        with self._lock:
+            self._rewrite_journal(count)
+
+    def compact(self, wait: bool = False):
+        """
+        Save a snapshot and cut the journal down to the operations after it, on a background thread
+        :param wait: Wait for it to finish
+        """
+        if self._compactor is not None and self._compactor.is_alive():
+            if not wait:
+                return
+            self._compactor.join()
+        self._compactor = threading.Thread(target=self._write_snapshot,
+                                           args=(self._take_snapshot(), len(self._lines)), daemon=True)
+        self._compactor.start()
+        if wait:
+            self._compactor.join()
+
+    def checkpoint(self):
+        """Compact now and forget the undo history, for when the container contents were replaced"""
+        self._undo.clear()
+        self._redo.clear()
+        if self._action is not None:
+            self._action = []
+        self.compact(wait=True)
+
+    def close(self, keep: bool = False):
+        """
+        Stop recording
+        :param keep: Keep the autosave, compacted so the next recover has nothing to replay. Otherwise it is deleted,
+            as the session ended normally and there is nothing to recover
+        """
+        if keep:
+            self.compact(wait=True)
+        elif self._compactor is not None:
+            self._compactor.join()
+        self.contours.journal = None
+        with self._lock:
+            self._file.close()
+            self._file = None
+        if not keep:
+            for path in (self.snapshot_path, self.journal_path):
+                if os.path.exists(path):
+                    os.remove(path)
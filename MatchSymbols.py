@@ -1,13 +1,27 @@
 """MatchSymbols
 
-Run a combination of automated and manual pattern matching. This expects a black and white input image at
-Inputs/DetBwMod.png. The symbols should be in white
+Run a combination of automated and manual pattern matching. This expects a black and white input image, by default
+Inputs/DetBwMod.png. The symbols should be in white. Importing this does not open any window or read the image, that
+is done by main(). For batch processing without the GUI, see SymbolPipeline.py
 """
+import json
+import os
+import sys
+import time
+from contextlib import ExitStack
 import cv2
-import numpy as np
 from enum import Enum
-from ContourContainer import ContourContainer, ContourNotFound
-from typing import Sequence
+from ContourContainer import ContourContainer, ArrayContourContainer, ContourNotFound
+from AutoGrouper import AutoGrouper, BackgroundGrouping
+from DerivativeCache import DEFAULT_DIRECTORY, DerivativeCache, content_hash
+from Display import BoxRenderer
+from FeatureGrouping import FeatureGrouper
+from Journal import OperationJournal
+from Matching import peaks_from_scores, points_to_indices
+from Profiler import Profiler
+from ScoreCache import ScoreCache
+from SymbolPipeline import get_contours, load_image, new_container
+from typing import Optional, Sequence
 
 
 class MouseMode(Enum):
@@ -24,48 +38,37 @@ class MouseMode(Enum):
 thresh_bar_name = "threshold"
 main_window_name = "Code Image"
 thresh_val = 0.7
+# If set, the 'z' grouping only matches boxes within this fraction of the template size, instead of the whole image.
+# Much faster, but a small symbol no longer pulls in the larger boxes it matches part of, so the groups differ
+size_tolerance = None
+# Above 0, the 'z' grouping matches over the whole image instead, coarse to fine on an image halved this many times
+pyramid_levels = 0
+# How far under thresh_val a coarse score can be and still be refined. Thin strokes need more, see
+# Matching.pyramid_scores
+pyramid_slack = 0.3
 mouse_mode = MouseMode.MATCH
 start_pos = [0, 0]
 adding = False
-
-def get_contours(gray, contours: ContourContainer, dilate: bool = False):
-    if dilate:
-        # each word instead of a sentence.
-        rect_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 4))
-
-        # Applying dilation on the threshold image
-        # Warning! Not clear if this assignment will modify the original image!
-        gray = cv2.dilate(gray, rect_kernel, iterations=1)
-
-    # converting to Greyscale and thresholding should have already been done
-    # Find contours in the thresholded image
-    found_contours, _ = cv2.findContours(gray, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    for contour in found_contours:
-        contours.add(contour=contour)
-
+last_match = None
+score_cache = ScoreCache()
+# Set by main()
+contour_container = None
+gray = None
+journal = None
+profiler = None
+# On-disk cache of what main() works out from the image, and the image file's hash it is keyed by
+derivatives = None
+source_hash = None
+# The 'z' grouping while it runs, and the journal action it is recorded in
+grouping_job = None
+grouping_action = None
 
 
 def get_matches_from_rect(rect: Sequence[int], gray, dilate=True):
-    if dilate:
-        # each word instead of a sentence.
-        rect_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2, 2))
-
-        # Applying dilation on the threshold image
-        # Warning! Not clear if this assignment will modify the original image!
-        gray = cv2.dilate(gray, rect_kernel, iterations=1)
-
-    x, y, w, h = rect
-    template = gray[y:y + h, x:x + w]
-    # Compare Hu Moments with another contour's Hu Moments using a similarity metric
-
-    locations = cv2.matchTemplate(gray, template, cv2.TM_CCOEFF_NORMED)
-    locations = np.where(locations >= thresh_val)
-
-    # Convert this to an array of points at the center of each box
-    match_array = []
-    for top_left in zip(*locations[::-1]):
-        match_array.append([top_left[0] + template.shape[1]//2, top_left[1] + template.shape[0]//2])
-    return match_array
+    # The dilated image and score map are cached, so calling this again with a new threshold is cheap
+    scores = score_cache.scores(gray, rect, (2, 2) if dilate else None)
+    # (N, 2) array with one point at the center of each match
+    return peaks_from_scores(scores, gray.shape, thresh_val)
 
 
 def box_contours(image, contours, color=(255, 0, 0)):
@@ -86,16 +89,27 @@ def match_from_point(x: int, y: int, contours: ContourContainer, det_image):
     locations_xy = get_matches_from_rect(rect, det_image, dilate=True)
     # Clear all selections, then set the matching ones to Active
     contours.unselect_boxes(all=True)
-    for x, y in locations_xy:
-        contours.select_boxes(x_in=x, y_in=y)
+    for index in points_to_indices(contours, locations_xy):
+        contours.select_boxes(index=index)
 
 def mouse_callback(event, x, y, flags, param):
+    if grouping_job is not None:
+        # The container must only change through the grouping until it is done
+        return
+    # Everything one mouse event does is one undo step
+    with journal.action():
+        handle_mouse(event, x, y)
+
+
+def handle_mouse(event, x, y):
     global contour_container
     global start_pos
     global adding
+    global last_match
     if mouse_mode == MouseMode.MATCH:
         if event != cv2.EVENT_LBUTTONDOWN:
             return
+        last_match = (x, y)
         match_from_point(x, y, contour_container, gray)
     elif mouse_mode == MouseMode.DELETE:
         if event != cv2.EVENT_LBUTTONDOWN:
@@ -122,9 +136,8 @@ def mouse_callback(event, x, y, flags, param):
     elif mouse_mode == MouseMode.SELECT:
         if event != cv2.EVENT_LBUTTONDOWN:
             return
-        try:
-            index = contour_container.get_index_by_point(x, y)
-        except ContourNotFound as e:
+        index = contour_container.get_index_by_point(x, y)
+        if index < 0:
             print(f"No box at {[x,y]}")
             return
         contour_container.unselect_boxes(all=True)
@@ -136,7 +149,13 @@ def mouse_callback(event, x, y, flags, param):
         if event != cv2.EVENT_LBUTTONDOWN:
             return
         active_group = contour_container.get_group(selected=True)
+        if active_group < 0:
+            print(f"Select a group first")
+            return
         this_index = contour_container.get_index_by_point(x, y)
+        if this_index < 0:
+            print(f"No box at {[x,y]}")
+            return
         contour_container.set_group(active_group, index=this_index)
         contour_container.select_boxes(index=this_index)
     elif mouse_mode == MouseMode.UNGROUP:
@@ -144,6 +163,9 @@ def mouse_callback(event, x, y, flags, param):
             return
         active_group = contour_container.get_group(selected=True)
         this_index = contour_container.get_index_by_point(x, y)
+        if this_index < 0:
+            print(f"No box at {[x,y]}")
+            return
         if contour_container.get_group(index=this_index) != active_group:
             return
         contour_container.set_group(0, index=this_index)
@@ -152,6 +174,9 @@ def mouse_callback(event, x, y, flags, param):
         if event != cv2.EVENT_LBUTTONDOWN:
             return
         this_index = contour_container.get_index_by_point(x, y)
+        if this_index < 0:
+            print(f"No box at {[x,y]}")
+            return
         if contour_container.get_group(index=this_index) != 0:
             return
         contour_container.set_group(contour_container.max_group+1, index=this_index)
@@ -162,22 +187,97 @@ def mouse_callback(event, x, y, flags, param):
 def thresh_trackbar(val):
     global thresh_val
     thresh_val = val/100
+    # Redo the last match with the new threshold, which only re-thresholds the cached score map
+    if mouse_mode == MouseMode.MATCH and last_match is not None and grouping_job is None:
+        with journal.action():
+            match_from_point(*last_match, contour_container, gray)
+
+
+def start_grouping():
+    """Start the 'z' grouping in the background. The whole run is one undo step"""
+    global grouping_job
+    global grouping_action
+    grouping_action = ExitStack()
+    grouping_action.enter_context(journal.action())
+    grouper = AutoGrouper(thresh_val=thresh_val, size_tolerance=None if pyramid_levels else size_tolerance,
+                          pyramid_levels=pyramid_levels, pyramid_slack=pyramid_slack)
+    # Through the score cache, so z reuses the dilated image of the clicks, and of the last time from the disk cache
+    grouping_job = BackgroundGrouping(grouper, gray, contour_container,
+                                      image=score_cache.dilated(gray, grouper.kernel_size))
+    grouping_job.start()
+    print(f"Starting Match, p to pause, c to cancel")
+
+
+def step_grouping():
+    """Apply the grouping results that are ready, and finish up when they are all in"""
+    global grouping_job
+    global grouping_action
+    grouping_job.apply()
+    if not grouping_job.finished:
+        state = 'paused' if grouping_job.paused else 'grouping'
+        cv2.setWindowTitle(main_window_name, f"{main_window_name} - {state} {grouping_job.progress:.0%}")
+        return
+    grouping_action.close()
+    print(f"Done Matching! {grouping_job.stats}")
+    cv2.setWindowTitle(main_window_name, main_window_name)
+    grouping_job = grouping_action = None
+
+
+def grouping_key(key: int) -> bool:
+    """Handle a key press while the grouping runs. :return: False to quit"""
+    if key == ord('p'):
+        if grouping_job.paused:
+            grouping_job.resume()
+        else:
+            grouping_job.pause()
+    elif key == ord('c') or key == ord('q'):
+        grouping_job.cancel()
+        print(f"Cancelling, the groups found so far are kept")
+        if key == ord('q'):
+            grouping_job.wait()
+            step_grouping()
+            return False
+    elif key != -1:
+        print(f"Grouping, p to pause or c to cancel first")
+    return True
 
 
 def update_display(base_image, contours: ContourContainer):
-    return_image = base_image.copy()
-    boxes = contours.get_boxes(active=True)
-    box_contours(return_image, boxes, color=(0, 255, 0))
-    boxes = contours.get_boxes(active=False)
-    box_contours(return_image, boxes, color=(255, 0, 0))
-    return return_image
-
-print(f"""
+    # Full redraw. The main loop uses a BoxRenderer instead, which only redraws what changed
+    return BoxRenderer(base_image).redraw(contours)
+
+
+def instrument(profiler_in: Profiler):
+    """Time the stages of matching and drawing, the automatic grouping, and every container method"""
+    import AutoGrouper as auto_grouper_module
+    import FeatureGrouping as feature_grouping_module
+    import Matching as matching_module
+    import ScoreCache as score_cache_module
+    profiler_in.instrument(sys.modules[__name__], ['get_contours', 'match_from_point', 'get_matches_from_rect',
+                                                   'peaks_from_scores', 'points_to_indices'], prefix='MatchSymbols')
+    # Dilating and scoring are called from the modules' own namespaces
+    profiler_in.instrument(score_cache_module, ['dilate_image', 'match_scores'], prefix='Matching')
+    profiler_in.instrument(auto_grouper_module, ['dilate_image', 'match_size_candidates', 'match_pyramid',
+                                                 'match_peaks'], prefix='Matching')
+    profiler_in.instrument(matching_module, ['candidate_scores', 'pyramid_scores'], prefix='Matching')
+    profiler_in.instrument(feature_grouping_module, ['dilate_image', 'box_descriptors'], prefix='Matching')
+    profiler_in.instrument(AutoGrouper, ['run'])
+    profiler_in.instrument(BackgroundGrouping, ['apply'], operation=False)
+    profiler_in.instrument(FeatureGrouper, ['run'])
+    profiler_in.instrument(BoxRenderer, ['render', 'redraw'], operation=False)
+    profiler_in.instrument(OperationJournal, ['undo', 'redo', 'compact'])
+    profiler_in.instrument(DerivativeCache, ['load_image', 'contour_boxes', 'dilated', 'descriptors'])
+    profiler_in.instrument(ContourContainer)
+    profiler_in.instrument(ArrayContourContainer)
+
+
+HELP_TEXT = """
 Welcome to the program that matches Symbols. This is intended to be used with a black and white image full of
 mysterious symbols. When the image is opened, the software will automatically run contour matching and get an
 initial list of symbols. Identified symbols are boxed in Blue, Active symbols are in Green
 All commands are a single letter. Note that for many commands, you enter the letter then select the symbols to act on:
- z - Run automatic grouping
+ z - Run automatic grouping, in the background. While it runs, p pauses and resumes it and c cancels it
+ f - Run fast automatic grouping, comparing thumbnails of the symbols instead of template matching
  l - Load saved settings
  x - eXport settings
  q - Quit
@@ -188,74 +288,209 @@ All commands are a single letter. Note that for many commands, you enter the let
  u - Ungroup, remove selected symbols from the active group, to the unclassified group
  n - New group, select an ungrouped symbol and start a new group for it
  y - Show all ungrouped symbols
+ r - Read, print the sheet in reading order through the group to letter table, and the most common groups
  m - Match, run the contour matching on the selected symbol. For debug only.
-""")
-# Create an OpenCV window and set the mouse callback
-cv2.namedWindow(main_window_name)
-cv2.setMouseCallback(main_window_name, mouse_callback)
-
-# Load the image
-base_image = cv2.imread("Inputs/DetBwMod.png")
-# original_image = cv2.imread("Inputs/DetImage.jpg")
-
-# Convert the image to grayscale
-gray = cv2.cvtColor(base_image, cv2.COLOR_BGR2GRAY)
-
-contour_container = ContourContainer(min_width=2, min_height=2)
-get_contours(gray, contour_container)
-
-# Create a copy of the image to draw the contours on
-
-cv2.createTrackbar(thresh_bar_name, main_window_name, 0, 100, thresh_trackbar)
-
-# cv2.imshow("Original", original_image)
-
-while True:
-    highlighted_image = update_display(base_image, contour_container)
-    cv2.imshow(main_window_name, highlighted_image)
-
-    key = cv2.waitKey(30)
-    if key == ord('q'):
-        break
-    elif key == ord('m'):
-        mouse_mode = MouseMode.MATCH
-    elif key == ord('d'):
-        mouse_mode = MouseMode.DELETE
-    elif key == ord('a'):
-        mouse_mode = MouseMode.ADD
-    elif key == ord('s'):
-        mouse_mode = MouseMode.SELECT
-    elif key == ord('g'):
-        mouse_mode = MouseMode.GROUP
-    elif key == ord('u'):
-        mouse_mode = MouseMode.UNGROUP
-    elif key == ord('n'):
-        mouse_mode = MouseMode.NEW
-    elif key == ord('x'):
-        contour_container.save('settings.json')
-        print(f"Saved!")
-    elif key == ord('l'):
-        contour_container.load('settings.json')
-    elif key == ord('y'):
-        contour_container.unselect_boxes(all=True)
-        contour_container.select_boxes(group=0)
-    elif key == ord('z'):
-        print(f"Starting Match")
-        for index in range(contour_container.length):
-            print(f"{index=}")
-            if contour_container.get_group(index=index) > 0:
-                continue
-            rect = contour_container.get_box(index=index)
-            new_group = contour_container.max_group + 1
-            matches = get_matches_from_rect(rect, gray)
-            if len(matches) > contour_container.length:     # Probably garbage
-                continue
-            contour_container.set_group(new_group, index=index)
-            for match in matches:
-                match_index = contour_container.get_index_by_point(match[0], match[1])
-                if match_index >= 0:
-                    contour_container.set_group(new_group, index=match_index)
-        print(f"Done Matching!")
-
-
-cv2.destroyAllWindows()
+ [ - Undo the last command
+ ] - Redo
+"""
+
+
+def feature_grouping():
+    """The 'f' grouping, with the descriptors from the on-disk cache when the boxes are ones it has seen"""
+    grouper = FeatureGrouper(thresh_val=thresh_val)
+    if size_tolerance is not None:
+        grouper.size_tolerance = size_tolerance
+    descriptors = None
+    if derivatives is not None:
+        descriptors = derivatives.descriptors(source_hash, gray, contour_container.get_box_array(all=True),
+                                              grouper.size, grouper.kernel_size)
+    return grouper.run(gray, contour_container, descriptors)
+
+
+def load_letters(letters_path: str) -> dict:
+    """Group to letter table, saved as JSON of group id to letter. Empty if there is no file yet"""
+    if not os.path.exists(letters_path):
+        return {}
+    with open(letters_path) as fp:
+        return {int(group): letter for group, letter in json.load(fp).items()}
+
+
+def read_sheet(letters_path: str, top: int = 20):
+    """Print the sheet decoded through the letters table, and the most common groups"""
+    letters = load_letters(letters_path)
+    print(contour_container.decode(letters))
+    groups, counts = contour_container.group_frequencies()
+    total = max(int(counts.sum()), 1)
+    print(f"{len(groups)} groups, {contour_container.line_count} lines. Most common:")
+    for group, count in zip(groups[:top].tolist(), counts[:top].tolist()):
+        print(f"  group {group:>5} {letters.get(group, '?'):>3} {count:>6} {100 * count / total:5.1f}%")
+
+
+def autosave_path(image_path: str, image_hash: str) -> str:
+    """Base path of the autosave of an image, in the working directory"""
+    return f"{os.path.splitext(os.path.basename(image_path))[0]}.{image_hash[:16]}.autosave"
+
+
+def main(image_path: str = "Inputs/DetBwMod.png", settings_path: str = 'settings.sym', recover: bool = True,
+         profile_path: Optional[str] = None, overlay: bool = False, cache_dir: Optional[str] = DEFAULT_DIRECTORY,
+         letters_path: str = 'letters.json'):
+    """
+    :param letters_path: JSON file of group id to letter, read again every time r prints the sheet
+    :param cache_dir: Directory of the on-disk cache of the decoded image, contours, dilated images and descriptors,
+        or None to work them all out every time
+    :param profile_path: Time the stages (see Profiler.py), print them at exit and save the timeline here
+    :param overlay: Time the stages and show the frame time and last operation in the window
+    """
+    global contour_container
+    global gray
+    global mouse_mode
+    global journal
+    global profiler
+    global derivatives
+    global source_hash
+    print(HELP_TEXT)
+    if profile_path is not None or overlay:
+        profiler = Profiler()
+        instrument(profiler)
+    # Create an OpenCV window and set the mouse callback
+    cv2.namedWindow(main_window_name)
+    cv2.setMouseCallback(main_window_name, mouse_callback)
+
+    # Load the image, and its grayscale version
+    if cache_dir is None:
+        base_image, gray = load_image(image_path)
+        with open(image_path, 'rb') as fp:
+            source_hash = content_hash(fp.read())
+    else:
+        derivatives = DerivativeCache(cache_dir)
+        base_image, gray, source_hash = derivatives.load_image(image_path)
+        score_cache.derivatives = derivatives
+        score_cache.set_source(gray, source_hash)
+    # original_image = cv2.imread("Inputs/DetImage.jpg")
+
+    contour_container = new_container(gray)
+    if derivatives is None:
+        get_contours(gray, contour_container)
+    else:
+        contour_container.add_many(derivatives.contour_boxes(source_hash, gray))
+
+    # Every change is journaled next to the image's autosave, so a crash loses nothing. It is named for the image's
+    # contents, an edited image starts over instead of recovering boxes found in the old one
+    journal = OperationJournal(contour_container, autosave_path(image_path, source_hash))
+    if recover and journal.exists():
+        print(f"Recovered the autosaved session, replaying {journal.recover()} changes")
+    else:
+        journal.start()
+
+    # Create a copy of the image to draw the contours on
+
+    cv2.createTrackbar(thresh_bar_name, main_window_name, 0, 100, thresh_trackbar)
+
+    # cv2.imshow("Original", original_image)
+
+    box_renderer = BoxRenderer(base_image)
+    shown_last = None
+    while True:
+        frame_start = time.perf_counter()
+        # Only returns an image when something changed
+        highlighted_image = box_renderer.render(contour_container)
+        if overlay and (highlighted_image is not None or profiler.last is not shown_last):
+            # Drawn on a copy, the renderer keeps its frame clean for the next incremental redraw
+            shown_last = profiler.last
+            highlighted_image = profiler.draw_overlay(box_renderer.frame, time.perf_counter() - frame_start)
+        if highlighted_image is not None:
+            cv2.imshow(main_window_name, highlighted_image)
+
+        key = cv2.waitKey(30 if grouping_job is None else 1)
+        if grouping_job is not None:
+            if not grouping_key(key):
+                break
+            step_grouping()
+            continue
+        if key == ord('q'):
+            break
+        elif key == ord('['):
+            if not journal.undo():
+                print(f"Nothing to undo")
+            continue
+        elif key == ord(']'):
+            if not journal.redo():
+                print(f"Nothing to redo")
+            continue
+
+        # Everything one key does is one undo step
+        with journal.action():
+            if key == ord('m'):
+                mouse_mode = MouseMode.MATCH
+            elif key == ord('d'):
+                mouse_mode = MouseMode.DELETE
+            elif key == ord('a'):
+                mouse_mode = MouseMode.ADD
+            elif key == ord('s'):
+                mouse_mode = MouseMode.SELECT
+            elif key == ord('g'):
+                mouse_mode = MouseMode.GROUP
+            elif key == ord('u'):
+                mouse_mode = MouseMode.UNGROUP
+            elif key == ord('n'):
+                mouse_mode = MouseMode.NEW
+            elif key == ord('x'):
+                contour_container.save(settings_path)
+                print(f"Saved!")
+            elif key == ord('l'):
+                # Fall back to the old JSON settings until a binary session has been saved
+                contour_container.load(settings_path if os.path.exists(settings_path) else 'settings.json')
+            elif key == ord('y'):
+                contour_container.unselect_boxes(all=True)
+                contour_container.select_boxes(group=0)
+            elif key == ord('r'):
+                read_sheet(letters_path)
+            elif key == ord('z'):
+                start_grouping()
+            elif key == ord('f'):
+                stats = feature_grouping()
+                print(f"Done Matching! {stats}")
+
+    # Quit normally, so there is nothing to recover. Press x first to keep the session
+    journal.close()
+    cv2.destroyAllWindows()
+    if profiler is not None:
+        print(profiler.summary())
+        if profile_path is not None:
+            profiler.save_trace(profile_path)
+            print(f"Saved the timeline to {profile_path}")
+        profiler.uninstall()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Group the symbols in a black and white image by hand.')
+    parser.add_argument('image', help='Black and white image, symbols in white', nargs='?',
+                        default="Inputs/DetBwMod.png")
+    parser.add_argument('--settings', help='Session file for the x and l commands, JSON if it ends in .json',
+                        default='settings.sym')
+    parser.add_argument('--fresh', help='Start over instead of recovering the autosaved session',
+                        action='store_true')
+    parser.add_argument('--profile', help='Time the stages, and save the timeline to this Chrome trace file',
+                        default=None)
+    parser.add_argument('--overlay', help='Show the frame time and last operation in the window', action='store_true')
+    parser.add_argument('--cache', help='Directory of the cached image, contours and descriptors',
+                        default=DEFAULT_DIRECTORY)
+    parser.add_argument('--no-cache', help='Work everything out from the image again, without the cache',
+                        action='store_true')
+    parser.add_argument('--letters', help='JSON file of group id to letter, for the r command',
+                        default='letters.json')
+    parser.add_argument('--size-tolerance', help='Make z only match boxes within this fraction of the template size, '
+                        'instead of over the whole image', type=float, default=size_tolerance)
+    parser.add_argument('--pyramid-levels', help='Make z match over the whole image, coarse to fine on an image '
+                        'halved this many times, instead of only the boxes of about the template size', type=int,
+                        default=pyramid_levels)
+    parser.add_argument('--pyramid-slack', help='How far under the threshold a coarse match can score and still be '
+                        'refined', type=float, default=pyramid_slack)
+    args = parser.parse_args()
+    size_tolerance = args.size_tolerance
+    pyramid_levels = args.pyramid_levels
+    pyramid_slack = args.pyramid_slack
+    main(args.image, args.settings, recover=not args.fresh, profile_path=args.profile, overlay=args.overlay,
+         cache_dir=None if args.no_cache else args.cache, letters_path=args.letters)
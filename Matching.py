@@ -0,0 +1,203 @@
+"""Matching
+
+Template matching helpers shared by MatchSymbols and the automatic grouping code. These work on an already
+thresholded black and white image, with the symbols in white.
+"""
+import cv2
+import numpy as np
+from typing import Sequence
+
+
+def dilate_image(gray, kernel_size: Sequence[int] = (2, 2)):
+    """Dilate the image with a rectangular kernel. Returns a new image, the input is not changed"""
+    rect_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, tuple(kernel_size))
+    return cv2.dilate(gray, rect_kernel, iterations=1)
+
+
+def match_scores(image, rect: Sequence[int]) -> np.ndarray:
+    """TM_CCOEFF_NORMED score map for the part of the image in rect run as a template over the whole image"""
+    x, y, w, h = rect
+    template = image[y:y + h, x:x + w]
+    return cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
+
+
+def centers_from_scores(scores: np.ndarray, image_shape: Sequence[int], thresh_val: float) -> np.ndarray:
+    """
+    Threshold a score map from match_scores
+    :param image_shape: Shape of the image that was searched, to work out the template size
+    :return: (N, 2) array of the x, y centers of every location scoring at least thresh_val
+    """
+    template_h = image_shape[0] - scores.shape[0] + 1
+    template_w = image_shape[1] - scores.shape[1] + 1
+    match_y, match_x = np.where(scores >= thresh_val)
+    return np.stack((match_x + template_w // 2, match_y + template_h // 2), axis=1)
+
+
+def peaks_from_scores(scores: np.ndarray, image_shape: Sequence[int], thresh_val: float) -> np.ndarray:
+    """
+    Like centers_from_scores, but only keeps local peaks. Every match shows up as a cluster of locations over the
+    threshold around the best one, so this keeps the locations that score highest within half a template in each
+    direction. Two real matches can't be closer than that without their boxes overlapping.
+    :return: (N, 2) array of the x, y centers of the peaks scoring at least thresh_val
+    """
+    template_h = image_shape[0] - scores.shape[0] + 1
+    template_w = image_shape[1] - scores.shape[1] + 1
+    above = scores >= thresh_val
+    rows = np.flatnonzero(above.any(axis=1))
+    if len(rows) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    cols = np.flatnonzero(above.any(axis=0))
+    # Only look at the part of the map around the matches, padded so the window is complete at its edges
+    pad_y, pad_x = template_h // 2, template_w // 2
+    top, left = max(rows[0] - pad_y, 0), max(cols[0] - pad_x, 0)
+    window = scores[top:rows[-1] + pad_y + 1, left:cols[-1] + pad_x + 1]
+    kernel = np.ones((2 * pad_y + 1, 2 * pad_x + 1), dtype=np.uint8)
+    peaks = ((window >= thresh_val) & (window >= cv2.dilate(window, kernel))).astype(np.uint8)
+
+    # A flat top gives a patch of equal peaks, keep the first pixel of each patch
+    _, labels = cv2.connectedComponents(peaks, connectivity=8)
+    points = cv2.findNonZero(peaks).reshape(-1, 2)
+    _, first = np.unique(labels[points[:, 1], points[:, 0]], return_index=True)
+    return points[first].astype(np.int64) + (left + template_w // 2, top + template_h // 2)
+
+
+def match_centers(image, rect: Sequence[int], thresh_val: float) -> np.ndarray:
+    """
+    Run the part of the image in rect as a template over the whole image
+    :param image: Image to search, normally already dilated
+    :param rect: x, y, w, h of the template
+    :param thresh_val: Minimum TM_CCOEFF_NORMED score for a match
+    :return: (N, 2) array of the x, y centers of every matching location
+    """
+    return centers_from_scores(match_scores(image, rect), image.shape, thresh_val)
+
+
+def match_peaks(image, rect: Sequence[int], thresh_val: float) -> np.ndarray:
+    """Same as match_centers, but with one center per match instead of a cluster of them"""
+    return peaks_from_scores(match_scores(image, rect), image.shape, thresh_val)
+
+
+def pyramid_scores(image, rect: Sequence[int], thresh_val: float, levels: int = 2, coarse_slack: float = 0.3,
+                   min_template: int = 4) -> np.ndarray:
+    """
+    Coarse to fine version of match_scores. The image and template are halved levels times with pyrDown, the full
+    score map is only computed at the coarsest level, and the full resolution scores are only computed around the
+    coarse locations scoring at least thresh_val - coarse_slack. Everywhere else the map is -1.
+
+    Where the full resolution scores are computed they are the match_scores ones, so the peaks are a subset of the
+    match_peaks ones. Only where two locations within half a template score the same, up to float rounding, can the
+    other one be picked. A match is only lost
+    when every coarse location within a coarse pixel of it scores more than coarse_slack under thresh_val. With
+    coarse_slack >= 1 + thresh_val every location is refined and the peaks are the match_peaks ones.
+    :param levels: Number of times to halve the image. Stops early if the template would get smaller than min_template
+    :param coarse_slack: How much lower the coarse score can be than the threshold. Thin strokes blur out when the
+        image is shrunk, so coarse scores run lower than full resolution ones, even for an exact copy of the template.
+        Strokes thinner than 2**levels pixels need more slack, see test_Matching.py
+    :return: Score map the same shape as match_scores gives, for use with peaks_from_scores
+    """
+    x, y, w, h = rect
+    template = image[y:y + h, x:x + w]
+    template_h, template_w = template.shape[:2]
+    image_h, image_w = image.shape[:2]
+
+    coarse_image, coarse_template, level = image, template, 0
+    while level < levels and min(coarse_template.shape[:2]) >= 2 * min_template:
+        coarse_image = cv2.pyrDown(coarse_image)
+        coarse_template = cv2.pyrDown(coarse_template)
+        level += 1
+    if level == 0:
+        return cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
+
+    coarse_scores = cv2.matchTemplate(coarse_image, coarse_template, cv2.TM_CCOEFF_NORMED)
+    candidates = (coarse_scores >= thresh_val - coarse_slack).astype(np.uint8)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(candidates, connectivity=8)
+
+    # Refine the box around each patch of candidates at full resolution. A coarse pixel covers 2**level full ones,
+    # plus a pixel of rounding, and pyrDown rounds odd template sizes up, which shifts the top left corner
+    scores = np.full((image_h - template_h + 1, image_w - template_w + 1), -1, dtype=np.float32)
+    scale = 2 ** level
+    reach = scale + 1
+    shift_x = (template_w - coarse_template.shape[1] * scale) // 2
+    shift_y = (template_h - coarse_template.shape[0] * scale) // 2
+    # Label 0 is the background
+    for coarse_x, coarse_y, coarse_w, coarse_h, _ in stats[1:].tolist():
+        left = max(coarse_x * scale - reach + min(shift_x, 0), 0)
+        top = max(coarse_y * scale - reach + min(shift_y, 0), 0)
+        right = min((coarse_x + coarse_w - 1) * scale + reach + max(shift_x, 0) + 1, scores.shape[1])
+        bottom = min((coarse_y + coarse_h - 1) * scale + reach + max(shift_y, 0) + 1, scores.shape[0])
+        if right <= left or bottom <= top:
+            continue
+        window = image[top:bottom + template_h - 1, left:right + template_w - 1]
+        scores[top:bottom, left:right] = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+    return scores
+
+
+def match_pyramid(image, rect: Sequence[int], thresh_val: float, levels: int = 2,
+                  coarse_slack: float = 0.3) -> np.ndarray:
+    """Same as match_peaks, using coarse to fine matching. See pyramid_scores for how close the two are"""
+    return peaks_from_scores(pyramid_scores(image, rect, thresh_val, levels, coarse_slack), image.shape, thresh_val)
+
+
+def points_to_indices(contours, points) -> np.ndarray:
+    """
+    Look up the contours containing a batch of match points
+    :param contours: ContourContainer to look in
+    :return: Sorted array of the distinct contour indices hit, points outside every box are dropped
+    """
+    indices = np.unique(contours.get_indices_by_points(points))
+    return indices[indices >= 0]
+
+
+def candidate_scores(image, rect: Sequence[int], candidates, batch_size: int = 1024) -> np.ndarray:
+    """
+    Score a template against a set of candidate boxes only, instead of the whole image.
+
+    Around each candidate's center a window of the template size plus half a template on every side is cut out, so
+    the template can shift by up to half its size in each direction, which covers every location whose match center
+    would land inside a box of that size. The windows of a batch are tiled into one mosaic image and scored with a
+    single matchTemplate call, then the best score inside each tile is taken. Positions spanning two tiles are never
+    looked at, so the scores are the same as the full image score map at those locations.
+    :param candidates: (N, 4) array like of x, y, w, h candidate boxes
+    :return: Best TM_CCOEFF_NORMED score for each candidate
+    """
+    candidates = np.asarray(candidates, dtype=np.int64).reshape(-1, 4)
+    x, y, w, h = rect
+    template = image[y:y + h, x:x + w]
+    template_h, template_w = template.shape[:2]
+    pad_y, pad_x = template_h // 2, template_w // 2
+    tile_h, tile_w = template_h + 2 * pad_y, template_w + 2 * pad_x
+    image_h, image_w = image.shape[:2]
+
+    # Pixel rows and columns of every window, clipped to the image so windows at the edge repeat the edge pixels
+    top = candidates[:, 1] + candidates[:, 3] // 2 - template_h // 2 - pad_y
+    left = candidates[:, 0] + candidates[:, 2] // 2 - template_w // 2 - pad_x
+    rows = np.clip(top[:, None] + np.arange(tile_h), 0, image_h - 1)
+    cols = np.clip(left[:, None] + np.arange(tile_w), 0, image_w - 1)
+
+    best = np.empty(len(candidates), dtype=np.float32)
+    for start in range(0, len(candidates), batch_size):
+        stop = min(start + batch_size, len(candidates))
+        tiles = image[rows[start:stop, :, None], cols[start:stop, None, :]]
+        count = stop - start
+        across = int(np.ceil(np.sqrt(count)))
+        down = -(-count // across)
+        mosaic = np.zeros((down * across, tile_h, tile_w), dtype=image.dtype)
+        mosaic[:count] = tiles
+        mosaic = mosaic.reshape(down, across, tile_h, tile_w).transpose(0, 2, 1, 3).reshape(down * tile_h,
+                                                                                          across * tile_w)
+        scores = cv2.matchTemplate(mosaic, template, cv2.TM_CCOEFF_NORMED)
+        # Template positions inside tile (r, c) start at its top left corner and can move 2 * pad in each direction
+        full = np.full((down * tile_h, across * tile_w), -np.inf, dtype=np.float32)
+        full[:scores.shape[0], :scores.shape[1]] = scores
+        full = full.reshape(down, tile_h, across, tile_w)[:, :2 * pad_y + 1, :, :2 * pad_x + 1]
+        best[start:stop] = full.max(axis=(1, 3)).reshape(-1)[:count]
+    return best
+
+
+def match_size_candidates(image, rect: Sequence[int], candidates, thresh_val: float) -> np.ndarray:
+    """
+    Which of the candidate boxes the template at rect matches
+    :param candidates: (N, 4) array like of x, y, w, h candidate boxes, normally the boxes of about the same size
+    :return: Boolean array, True for the candidates scoring at least thresh_val
+    """
+    return candidate_scores(image, rect, candidates) >= thresh_val
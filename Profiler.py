@@ -0,0 +1,138 @@
+"""Profiler
+
+Opt-in timing of the pipeline stages. instrument() swaps functions and methods for wrappers that time every call, and
+uninstall() puts the originals back. Until something is instrumented the code runs exactly as it is, so profiling
+costs nothing when it is off.
+
+Every call is counted per stage, with its total and longest time, and kept as an event for a timeline that can be
+saved in the Chrome trace format, to open in chrome://tracing or https://ui.perfetto.dev. Calls made from inside other
+instrumented calls show up nested on the timeline. The stage totals include the time of the calls inside them.
+"""
+import functools
+import inspect
+import json
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import cv2
+
+
+@dataclass
+class StageTimes:
+    count: int = 0
+    total: float = 0.0
+    longest: float = 0.0
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class Profiler:
+    """Times calls to the functions it instruments
+
+    :param max_events: Timeline events kept, the oldest are dropped after this many
+    """
+    def __init__(self, max_events: int = 200000):
+        self.stages: Dict[str, StageTimes] = {}
+        self.events = deque(maxlen=max_events)
+        # Name and seconds of the last outermost call, what the user last did
+        self.last: Optional[Tuple[str, float]] = None
+        self._origin = time.perf_counter()
+        self._patched: List[Tuple[object, str, object]] = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._patched)
+
+    def record(self, name: str, start: float, seconds: float, outermost: bool = True):
+        """Count one call. An outermost call on the main thread becomes the last operation"""
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = StageTimes()
+            stage.count += 1
+            stage.total += seconds
+            stage.longest = max(stage.longest, seconds)
+            self.events.append((name, start, seconds, threading.get_ident()))
+        if outermost and threading.current_thread() is threading.main_thread():
+            self.last = (name, seconds)
+
+    def wrap(self, name: str, function, operation: bool = True):
+        """
+        Timing wrapper for a function, recorded as stage name
+        :param operation: Whether a call can be the last operation. False for work done every frame, like drawing
+        """
+        local = self._local
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            depth = getattr(local, 'depth', 0)
+            local.depth = depth + 1
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, start, time.perf_counter() - start, outermost=operation and depth == 0)
+                local.depth = depth
+        return timed
+
+    def instrument(self, owner, names: Optional[Iterable[str]] = None, prefix: Optional[str] = None,
+                   operation: bool = True):
+        """
+        Time functions of a module, or methods of a class
+        :param names: Attributes to wrap. For a class, defaults to all the public methods it defines itself
+        :param prefix: Stage name prefix, defaults to the class or module name
+        :param operation: See wrap
+        """
+        if names is None:
+            names = [name for name, value in vars(owner).items()
+                     if not name.startswith('_') and inspect.isfunction(value)]
+        prefix = prefix or owner.__name__
+        for name in names:
+            # From the class __dict__, so a method inherited from a base class is not copied onto the subclass
+            original = vars(owner)[name]
+            setattr(owner, name, self.wrap(f"{prefix}.{name}", original, operation))
+            self._patched.append((owner, name, original))
+
+    def uninstall(self):
+        """Put back everything instrument() wrapped"""
+        for owner, name, original in reversed(self._patched):
+            setattr(owner, name, original)
+        self._patched.clear()
+
+    def summary(self) -> str:
+        """Table of the stages, the most total time first"""
+        lines = [f"{'stage':<45} {'calls':>8} {'total ms':>10} {'mean ms':>9} {'max ms':>9}"]
+        for name, stage in sorted(self.stages.items(), key=lambda item: -item[1].total):
+            lines.append(f"{name:<45} {stage.count:>8} {stage.total * 1000:>10.1f} {stage.mean * 1000:>9.3f} "
+                         f"{stage.longest * 1000:>9.2f}")
+        return '\n'.join(lines)
+
+    def save_trace(self, filename: str):
+        """Save the timeline in the Chrome trace event format, with the stage totals as metadata"""
+        events = [{'name': name, 'cat': name.split('.')[0], 'ph': 'X', 'pid': 0, 'tid': thread,
+                   'ts': (start - self._origin) * 1e6, 'dur': seconds * 1e6}
+                  for name, start, seconds, thread in list(self.events)]
+        stages = {name: {'count': stage.count, 'total': stage.total, 'longest': stage.longest}
+                  for name, stage in self.stages.items()}
+        with open(filename, 'w') as fp:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'stages': stages}}, fp)
+
+    def draw_overlay(self, image, frame_seconds: Optional[float] = None):
+        """Copy of the image with the frame time and the last operation written in the top left corner"""
+        text = [] if frame_seconds is None else [f"frame {frame_seconds * 1000:.1f} ms"]
+        if self.last is not None:
+            text.append(f"{self.last[0]} {self.last[1] * 1000:.1f} ms")
+        image = image.copy()
+        for row, line in enumerate(text):
+            y = 16 + 18 * row
+            (width, height), _ = cv2.getTextSize(line, cv2.FONT_HERSHEY_SIMPLEX, 0.45, 1)
+            cv2.rectangle(image, (2, y - height - 3), (8 + width, y + 4), (0, 0, 0), -1)
+            cv2.putText(image, line, (5, y), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (255, 255, 255), 1, cv2.LINE_AA)
+        return image
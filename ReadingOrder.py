@@ -0,0 +1,253 @@
+"""ReadingOrder
+
+Index of contour boxes in reading order: top to bottom by line, then left to right within a line.
+
+A line is a run of boxes whose centers are at most line_gap pixels apart vertically, from one box to the next when they
+are sorted by center. That makes the lines the same whatever order the boxes were added in. Adding or removing a box
+only changes its own line, or joins the two lines either side of it, or splits the line it leaves, so single boxes are
+patched into the index in place. Loads and large batches of boxes rebuild it in one vectorized pass on the next query.
+"""
+from typing import List, Mapping, Optional
+
+import numpy as np
+
+
+class ReadingOrder:
+    """Box indices in reading order, grouped by line
+
+    :param line_gap: Largest vertical distance between the centers of neighbouring boxes of one line, in pixels
+    :param max_pending: Batches of more boxes than this are indexed by rebuilding, instead of one at a time
+    """
+    def __init__(self, line_gap: int = 8, max_pending: int = 64):
+        self.line_gap = line_gap
+        self.max_pending = max_pending
+        # Twice the box center y, and x, of each box by index
+        self._keys = np.empty(0, dtype=np.int64)
+        self._x = np.empty(0, dtype=np.int64)
+        self._count = 0
+        self._dirty = False
+        # Box indices in reading order, where each line starts in it, and each line's lowest and highest key
+        self._order = np.empty(0, dtype=np.int64)
+        self._starts = np.zeros(1, dtype=np.int64)
+        self._low = np.empty(0, dtype=np.int64)
+        self._high = np.empty(0, dtype=np.int64)
+
+    @property
+    def _gap(self) -> int:
+        return 2 * self.line_gap
+
+    def set_line_gap(self, line_gap: int):
+        self.line_gap = line_gap
+        self._dirty = True
+
+    def _grow(self, extra: int):
+        if self._count + extra <= len(self._keys):
+            return
+        capacity = max(16, self._count + extra, 2 * len(self._keys))
+        for name in ('_keys', '_x'):
+            grown = np.empty(capacity, dtype=np.int64)
+            grown[:self._count] = getattr(self, name)[:self._count]
+            setattr(self, name, grown)
+
+    @staticmethod
+    def _columns(boxes):
+        boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        return 2 * boxes[:, 1] + boxes[:, 3], boxes[:, 0]
+
+    def build(self, boxes):
+        """Replace the whole index, index i being boxes[i] as x, y, w, h"""
+        keys, x = self._columns(boxes)
+        self._keys, self._x = keys.copy(), x.copy()
+        self._count = len(keys)
+        self._dirty = True
+
+    def add(self, index: int, box):
+        assert index == self._count, f"Reading order expects boxes in order, got {index} with {self._count} boxes"
+        self._grow(1)
+        self._keys[index] = 2 * box[1] + box[3]
+        self._x[index] = box[0]
+        self._count += 1
+        if not self._dirty:
+            self._place(index)
+
+    def add_many(self, index: int, boxes):
+        """Add boxes, given as x, y, w, h, at index, index + 1, ... in one go"""
+        assert index == self._count, f"Reading order expects boxes in order, got {index} with {self._count} boxes"
+        keys, x = self._columns(boxes)
+        self._grow(len(keys))
+        self._keys[index:index + len(keys)] = keys
+        self._x[index:index + len(keys)] = x
+        self._count += len(keys)
+        if len(keys) > self.max_pending:
+            self._dirty = True
+        elif not self._dirty:
+            for added in range(index, self._count):
+                self._place(added)
+
+    def truncate(self, count: int):
+        """Drop every box from index count up"""
+        self._count = count
+        self._dirty = True
+
+    def remove(self, index: int):
+        """Drop a box. Higher indices shift down by one, same as deleting from the container list"""
+        if not self._dirty:
+            self._unplace(index)
+            self._order[self._order > index] -= 1
+        self._keys = np.delete(self._keys[:self._count], index)
+        self._x = np.delete(self._x[:self._count], index)
+        self._count -= 1
+
+    def insert(self, index: int, box):
+        """Add a box at index. Indices from there up shift up by one, same as inserting into the container list"""
+        self._keys = np.insert(self._keys[:self._count], index, 2 * box[1] + box[3])
+        self._x = np.insert(self._x[:self._count], index, box[0])
+        self._count += 1
+        if not self._dirty:
+            self._order[self._order >= index] += 1
+            self._place(index)
+
+    def _sorted(self, members: np.ndarray, lines: Optional[np.ndarray] = None) -> np.ndarray:
+        """Members by line, then x, then index"""
+        keys = (members, self._x[members]) if lines is None else (members, self._x[members], lines)
+        return members[np.lexsort(keys)]
+
+    def _place(self, index: int):
+        """Put an indexed box into its line, joining the lines either side of it if it bridges them"""
+        key = self._keys[index]
+        line = int(np.searchsorted(self._low, key, side='right')) - 1
+        joins_above = line >= 0 and key <= self._high[line] + self._gap
+        joins_below = line + 1 < len(self._low) and key >= self._low[line + 1] - self._gap
+        if joins_above and joins_below:
+            start, stop = self._starts[line], self._starts[line + 2]
+            members = self._sorted(np.append(self._order[start:stop], index))
+            self._order = np.concatenate((self._order[:start], members, self._order[stop:]))
+            self._starts = np.delete(self._starts, line + 1)
+            self._starts[line + 1:] += 1
+            self._high[line] = self._high[line + 1]
+            self._low = np.delete(self._low, line + 1)
+            self._high = np.delete(self._high, line + 1)
+            return
+        if not joins_above and not joins_below:
+            # A new line of its own, between the two
+            line += 1
+            position = self._starts[line]
+            self._starts = np.insert(self._starts, line, position)
+            self._low = np.insert(self._low, line, key)
+            self._high = np.insert(self._high, line, key)
+        else:
+            line = line if joins_above else line + 1
+            start, stop = self._starts[line], self._starts[line + 1]
+            members = self._order[start:stop]
+            x = self._x[members]
+            first, last = np.searchsorted(x, self._x[index], side='left'), np.searchsorted(x, self._x[index], 'right')
+            position = start + first + int(np.searchsorted(members[first:last], index))
+            self._low[line] = min(self._low[line], key)
+            self._high[line] = max(self._high[line], key)
+        self._order = np.insert(self._order, position, index)
+        self._starts[line + 1:] += 1
+
+    def _unplace(self, index: int):
+        """Take a box out of its line, splitting the line where it leaves a gap"""
+        position = int(np.flatnonzero(self._order == index)[0])
+        line = int(np.searchsorted(self._starts, position, side='right')) - 1
+        start, stop = self._starts[line], self._starts[line + 1]
+        members = np.delete(self._order[start:stop], position - start)
+        self._order = np.delete(self._order, position)
+        self._starts[line + 1:] -= 1
+        if len(members) == 0:
+            self._starts = np.delete(self._starts, line)
+            self._low = np.delete(self._low, line)
+            self._high = np.delete(self._high, line)
+            return
+        keys = np.sort(self._keys[members])
+        cuts = keys[1:][np.diff(keys) > self._gap]
+        if len(cuts) == 0:
+            self._low[line], self._high[line] = keys[0], keys[-1]
+            return
+        parts = np.searchsorted(cuts, self._keys[members], side='right')
+        self._order[start:stop - 1] = self._sorted(members, parts)
+        sizes = np.bincount(parts)
+        self._starts = np.concatenate((self._starts[:line + 1], start + np.cumsum(sizes)[:-1],
+                                       self._starts[line + 1:]))
+        bounds = np.concatenate(([0], np.cumsum(sizes)))
+        self._low = np.concatenate((self._low[:line], keys[bounds[:-1]], self._low[line + 1:]))
+        self._high = np.concatenate((self._high[:line], keys[bounds[1:] - 1], self._high[line + 1:]))
+
+    def _ensure_built(self):
+        if not self._dirty:
+            return
+        keys = self._keys[:self._count]
+        by_key = np.sort(keys)
+        cuts = by_key[1:][np.diff(by_key) > self._gap]
+        lines = np.searchsorted(cuts, keys, side='right')
+        self._order = self._sorted(np.arange(self._count, dtype=np.int64), lines)
+        sizes = np.bincount(lines, minlength=len(cuts) + 1) if self._count else np.empty(0, dtype=np.int64)
+        self._starts = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+        self._low = np.concatenate((by_key[:1], cuts)) if self._count else np.empty(0, dtype=np.int64)
+        self._high = by_key[self._starts[1:] - 1] if self._count else np.empty(0, dtype=np.int64)
+        self._dirty = False
+
+    @property
+    def line_count(self) -> int:
+        self._ensure_built()
+        return len(self._low)
+
+    def order(self) -> np.ndarray:
+        """Every box index, in reading order"""
+        self._ensure_built()
+        return self._order.copy()
+
+    def line_starts(self) -> np.ndarray:
+        """Where each line starts in order(), with the number of boxes at the end"""
+        self._ensure_built()
+        return self._starts.copy()
+
+    def lines(self) -> List[np.ndarray]:
+        """Box indices of each line, top to bottom, each left to right"""
+        self._ensure_built()
+        return np.split(self._order, self._starts[1:-1])
+
+
+def transcribe(order: np.ndarray, line_starts: np.ndarray, groups: np.ndarray, letters: Mapping[int, str],
+               unknown: str = '?', boxes: Optional[np.ndarray] = None, space_gap: Optional[int] = None) -> str:
+    """
+    Text of a sheet, one letter per box in reading order and one line per line of boxes
+    :param order: Box indices in reading order, see ReadingOrder.order
+    :param line_starts: Where each line starts in order, see ReadingOrder.line_starts
+    :param groups: Group id of every box by index
+    :param letters: Letter, or any string, of each group id
+    :param unknown: Put in for groups that have no letter
+    :param boxes: (N, 4) x, y, w, h of every box, needed for space_gap
+    :param space_gap: Put a space between neighbouring boxes of a line more than this many pixels apart
+    """
+    if len(order) == 0:
+        return ''
+    groups = np.asarray(groups, dtype=np.int64)[order]
+    known = np.fromiter(letters.keys(), dtype=np.int64, count=len(letters))
+    table = np.full(max(int(groups.max()), int(known.max(initial=0))) + 1, unknown, dtype=object)
+    table[known] = list(letters.values())
+    separators = np.full(len(order), '', dtype=object)
+    if space_gap is not None:
+        boxes = np.asarray(boxes, dtype=np.int64)[order]
+        gaps = boxes[1:, 0] - (boxes[:-1, 0] + boxes[:-1, 2])
+        separators[1:][gaps > space_gap] = ' '
+    separators[line_starts[1:-1]] = '\n'
+    text = np.empty(2 * len(order), dtype=object)
+    text[0::2] = separators
+    text[1::2] = table[groups]
+    return ''.join(text.tolist())
+
+
+def group_frequencies(groups: np.ndarray, ungrouped: bool = False):
+    """
+    How many boxes are in each group
+    :param ungrouped: Count the ungrouped boxes too, as group 0
+    :return: Group ids and counts, the most common group first
+    """
+    ids, counts = np.unique(np.asarray(groups), return_counts=True)
+    if not ungrouped:
+        counts = counts[ids != 0]
+        ids = ids[ids != 0]
+    most = np.argsort(-counts, kind='stable')
+    return ids[most], counts[most]
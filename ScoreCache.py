@@ -0,0 +1,85 @@
+"""ScoreCache
+
+Keeps the expensive parts of template matching around between clicks: the dilated image, and the matchTemplate score
+map of each template. Changing the threshold then only needs the cached score map thresholded again. Given a
+DerivativeCache, the dilated images are also kept on disk for the next time the same image is opened.
+"""
+from collections import OrderedDict
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from DerivativeCache import DerivativeCache
+from Matching import dilate_image, match_scores
+
+
+class ScoreCache:
+    """LRU cache of dilated images and score maps for one source image
+
+    Score maps are keyed by template rect and dilation kernel, and the least recently used ones are dropped once the
+    cache holds more than max_bytes. Dilated images count towards the limit too, but are only dropped when the source
+    image changes. Passing a different source image array clears the cache.
+    :param derivatives: On-disk cache for the dilated images, used for sources given a hash with set_source
+    """
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, derivatives: Optional[DerivativeCache] = None):
+        self.max_bytes = max_bytes
+        self.derivatives = derivatives
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._source = None
+        self._source_hash = None
+        self._dilated = {}
+        self._scores: OrderedDict = OrderedDict()
+
+    def clear(self):
+        self._source = None
+        self._source_hash = None
+        self._dilated = {}
+        self._scores.clear()
+        self.bytes = 0
+
+    def _check_source(self, gray):
+        # Identity, not equality. Holding on to the source keeps its id from being reused
+        if gray is not self._source:
+            self.clear()
+            self._source = gray
+
+    def set_source(self, gray, source_hash: Optional[str] = None):
+        """
+        Start caching for a new source image
+        :param source_hash: Hash of the image file from DerivativeCache.load_image, to keep its dilated images on disk
+        """
+        self._check_source(gray)
+        self._source_hash = source_hash
+
+    def dilated(self, gray, kernel_size: Optional[Sequence[int]] = (2, 2)) -> np.ndarray:
+        """The source image dilated with kernel_size, or the source itself for None"""
+        self._check_source(gray)
+        if kernel_size is None:
+            return gray
+        kernel_size = tuple(kernel_size)
+        if kernel_size not in self._dilated:
+            if self.derivatives is not None and self._source_hash is not None:
+                self._dilated[kernel_size] = self.derivatives.dilated(self._source_hash, gray, kernel_size)
+            else:
+                self._dilated[kernel_size] = dilate_image(gray, kernel_size)
+            self.bytes += self._dilated[kernel_size].nbytes
+        return self._dilated[kernel_size]
+
+    def scores(self, gray, rect: Sequence[int], kernel_size: Optional[Sequence[int]] = (2, 2)) -> np.ndarray:
+        """Score map of the template at rect, over the source image dilated with kernel_size"""
+        image = self.dilated(gray, kernel_size)
+        key: Tuple = (tuple(int(v) for v in rect), None if kernel_size is None else tuple(kernel_size))
+        if key in self._scores:
+            self.hits += 1
+            self._scores.move_to_end(key)
+            return self._scores[key]
+        self.misses += 1
+        scores = match_scores(image, rect)
+        self._scores[key] = scores
+        self.bytes += scores.nbytes
+        while self.bytes > self.max_bytes and len(self._scores) > 1:
+            _, evicted = self._scores.popitem(last=False)
+            self.bytes -= evicted.nbytes
+        return scores
@@ -0,0 +1,159 @@
+"""SessionFile
+
+Compact binary session format for the contour containers. A 32 byte header is followed by the columns as raw little
+endian arrays: boxes as int32 x, y, w, h, then int32 groups, then one byte active flags. That is 21 bytes per contour,
+and loading maps the columns straight from the file instead of parsing them, so only the pages that are used get read.
+
+Anything after the columns is an optional JSON block. The journal uses it to save how the groups were merged, see
+Session.group_state.
+
+Files that don't start with the header are read as the original JSON sessions, so old settings.json files still load.
+
+Run this file directly to compare save and load times and file sizes against JSON:
+    python SessionFile.py --count 100000
+"""
+import dataclasses
+import json
+import os
+import struct
+from typing import List, Optional
+
+import numpy as np
+
+MAGIC = b'SYMSESS\x00'
+FORMAT_VERSION = 1
+# Magic, format version, min width, min height, contour count, journal sequence number. 32 bytes
+_HEADER = struct.Struct('<8sIIIQI')
+BOX_DTYPE = np.dtype('<i4')
+GROUP_DTYPE = np.dtype('<i4')
+ACTIVE_DTYPE = np.dtype('u1')
+
+
+@dataclasses.dataclass
+class Session:
+    """The saved state of a container. The columns may be read-only, copy-on-write maps of the file"""
+    min_size: List[int]
+    boxes: np.ndarray
+    groups: np.ndarray
+    active: np.ndarray
+    # Last journal operation included in this session, see Journal.py
+    sequence: int = 0
+    # When set, groups holds the ids the contours were given and this how they were merged (DisjointGroups.state).
+    # Otherwise groups holds the merged group ids
+    group_state: Optional[list] = None
+
+    @property
+    def length(self):
+        return len(self.groups)
+
+
+def is_binary_session(filename: str) -> bool:
+    with open(filename, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def save_session(filename: str, session: Session):
+    """Write a binary session. Written to a temporary file first, so a failed save leaves the old file alone"""
+    count = session.length
+    boxes = np.ascontiguousarray(session.boxes, dtype=BOX_DTYPE).reshape(count, 4)
+    groups = np.ascontiguousarray(session.groups, dtype=GROUP_DTYPE)
+    active = np.ascontiguousarray(session.active, dtype=ACTIVE_DTYPE)
+    temp_name = filename + '.tmp'
+    with open(temp_name, 'wb') as fp:
+        fp.write(_HEADER.pack(MAGIC, FORMAT_VERSION, session.min_size[0], session.min_size[1], count,
+                              session.sequence))
+        for column in (boxes, groups, active):
+            fp.write(column.tobytes())
+        if session.group_state is not None:
+            fp.write(json.dumps({'group_state': session.group_state}).encode())
+    os.replace(temp_name, filename)
+
+
+def load_session(filename: str, mmap: bool = True) -> Session:
+    """
+    Read a binary or JSON session
+    :param mmap: Map the binary columns from the file (copy-on-write) instead of reading them into memory
+    """
+    if not is_binary_session(filename):
+        return load_json_session(filename)
+    with open(filename, 'rb') as fp:
+        magic, version, min_width, min_height, count, sequence = _HEADER.unpack(fp.read(_HEADER.size))
+    assert version == FORMAT_VERSION, f"Unknown session format version {version} in {filename}"
+
+    offset = _HEADER.size
+    columns = []
+    for dtype, shape in ((BOX_DTYPE, (count, 4)), (GROUP_DTYPE, (count,)), (ACTIVE_DTYPE, (count,))):
+        size = int(np.prod(shape)) * dtype.itemsize
+        if count == 0:
+            column = np.empty(shape, dtype=dtype)
+        elif mmap:
+            column = np.memmap(filename, dtype=dtype, mode='c', offset=offset, shape=shape)
+        else:
+            column = np.fromfile(filename, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+        columns.append(column)
+        offset += size
+    boxes, groups, active = columns
+    extra = {}
+    if os.path.getsize(filename) > offset:
+        with open(filename, 'rb') as fp:
+            fp.seek(offset)
+            extra = json.loads(fp.read())
+    return Session(min_size=[min_width, min_height], boxes=boxes, groups=groups, active=active.view(bool),
+                   sequence=sequence, group_state=extra.get('group_state'))
+
+
+def save_json_session(filename: str, session: Session):
+    """The original settings.json format: the min size on the first line, then a list of contour dicts"""
+    contours_out = [{'box': box, 'active': active, 'group': group} for box, active, group in
+                    zip(np.asarray(session.boxes).tolist(), np.asarray(session.active, dtype=bool).tolist(),
+                        np.asarray(session.groups).tolist())]
+    with open(filename, 'w+') as fp:
+        fp.write(json.dumps(session.min_size)+'\n')
+        fp.write(json.dumps(contours_out))
+
+
+def load_json_session(filename: str) -> Session:
+    with open(filename, 'r') as fp:
+        min_size = json.loads(fp.readline())
+        contours_json = json.loads(fp.readline())
+    return Session(min_size=min_size,
+                   boxes=np.array([x['box'] for x in contours_json], dtype=np.int32).reshape(-1, 4),
+                   groups=np.array([x['group'] for x in contours_json], dtype=np.int32),
+                   active=np.array([x.get('active', False) for x in contours_json], dtype=bool))
+
+
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+    import time
+    from ContourContainer import ArrayContourContainer
+
+    parser = argparse.ArgumentParser(description='Compare the binary and JSON session formats.')
+    parser.add_argument('--count', help='Number of contours', type=int, default=100000)
+    parser.add_argument('--repeat', help='Best of this many runs', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    contour_container = ArrayContourContainer()
+    session = Session(min_size=[2, 2],
+                      boxes=np.column_stack((rng.integers(0, 5000, (args.count, 2)),
+                                             rng.integers(2, 40, (args.count, 2)))).astype(np.int32),
+                      groups=rng.integers(0, 200, args.count).astype(np.int32),
+                      active=rng.random(args.count) < 0.1)
+    contour_container.set_session(session)
+
+    def best_of(function):
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ('session.json', 'session.sym'):
+            filename = os.path.join(directory, name)
+            save_seconds = best_of(lambda: contour_container.save(filename))
+            load_seconds = best_of(lambda: ArrayContourContainer().load(filename))
+            print(f"{name}: {os.path.getsize(filename) / 1e6:.2f} MB, save {save_seconds * 1000:.1f} ms, "
+                  f"load {load_seconds * 1000:.1f} ms for {args.count} contours")
@@ -0,0 +1,89 @@
+"""SizeBuckets
+
+Index of contour boxes by size, so the boxes a template could possibly match can be found without looking at every
+box.
+"""
+import numpy as np
+
+# Bucket keys are packed as width * _KEY_STRIDE + height
+_KEY_STRIDE = 1 << 32
+
+
+class SizeBuckets:
+    """Box indices bucketed by (width, height)
+
+    The buckets are kept as the box indices sorted by size key, rebuilt in one vectorized pass the first time they
+    are queried after a change. A range of sizes is then one contiguous run of that order per width.
+    """
+    def __init__(self):
+        self._sizes = np.empty((0, 2), dtype=np.int64)
+        self._count = 0
+        self._dirty = False
+        self._keys = np.empty(0, dtype=np.int64)
+        self._order = np.empty(0, dtype=np.int64)
+
+    def build(self, boxes):
+        """Replace the whole index, index i being boxes[i] as x, y, w, h"""
+        self._sizes = np.array(boxes, dtype=np.int64).reshape(-1, 4)[:, 2:4].copy()
+        self._count = len(self._sizes)
+        self._dirty = True
+
+    def add(self, index: int, width: int, height: int):
+        assert index == self._count, f"Size buckets expect boxes in order, got {index} with {self._count} boxes"
+        if self._count == len(self._sizes):
+            grown = np.empty((max(16, 2 * len(self._sizes)), 2), dtype=np.int64)
+            grown[:self._count] = self._sizes[:self._count]
+            self._sizes = grown
+        self._sizes[self._count] = width, height
+        self._count += 1
+        self._dirty = True
+
+    def add_many(self, index: int, boxes):
+        """Add boxes, given as x, y, w, h, at index, index + 1, ... in one go"""
+        assert index == self._count, f"Size buckets expect boxes in order, got {index} with {self._count} boxes"
+        sizes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)[:, 2:4]
+        if self._count + len(sizes) > len(self._sizes):
+            grown = np.empty((max(16, self._count + len(sizes), 2 * len(self._sizes)), 2), dtype=np.int64)
+            grown[:self._count] = self._sizes[:self._count]
+            self._sizes = grown
+        self._sizes[self._count:self._count + len(sizes)] = sizes
+        self._count += len(sizes)
+        self._dirty = True
+
+    def truncate(self, count: int):
+        """Drop every box from index count up"""
+        self._count = count
+        self._dirty = True
+
+    def remove(self, index: int):
+        """Drop a box. Higher indices shift down by one, same as deleting from the container list"""
+        self._sizes = np.delete(self._sizes[:self._count], index, axis=0)
+        self._count -= 1
+        self._dirty = True
+
+    def insert(self, index: int, width: int, height: int):
+        """Add a box at index. Indices from there up shift up by one, same as inserting into the container list"""
+        self._sizes = np.insert(self._sizes[:self._count], index, (width, height), axis=0)
+        self._count += 1
+        self._dirty = True
+
+    def _ensure_built(self):
+        if not self._dirty:
+            return
+        sizes = self._sizes[:self._count]
+        keys = sizes[:, 0] * _KEY_STRIDE + sizes[:, 1]
+        self._order = np.argsort(keys, kind='stable')
+        self._keys = keys[self._order]
+        self._dirty = False
+
+    def query(self, min_width: int, max_width: int, min_height: int, max_height: int) -> np.ndarray:
+        """Sorted indices of the boxes with min_width <= w <= max_width and min_height <= h <= max_height"""
+        self._ensure_built()
+        if max_width < min_width or max_height < min_height or self._count == 0:
+            return np.empty(0, dtype=np.int64)
+        widths = np.arange(min_width, max_width + 1, dtype=np.int64)
+        starts = np.searchsorted(self._keys, widths * _KEY_STRIDE + min_height, side='left')
+        stops = np.searchsorted(self._keys, widths * _KEY_STRIDE + max_height, side='right')
+        counts = stops - starts
+        offset = np.arange(counts.sum(), dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.sort(self._order[np.repeat(starts, counts) + offset])
@@ -0,0 +1,196 @@
+"""SpatialGrid
+
+Uniform grid index over contour boxes, so point lookups only have to test the handful of boxes that share a grid cell
+with the point instead of every box in the container.
+"""
+import numpy as np
+from typing import Sequence
+
+# Cell keys are packed as cell_y * _KEY_STRIDE + cell_x
+_KEY_STRIDE = 1 << 32
+
+
+def _contains(boxes: np.ndarray, x_in, y_in) -> np.ndarray:
+    """Same test as ContourContainer.point_in_rect, for arrays of boxes and points"""
+    x, y, w, h = boxes[..., 0], boxes[..., 1], boxes[..., 2], boxes[..., 3]
+    return (x <= x_in) & (x_in <= x + w) & (y <= y_in) & (y_in <= y + h)
+
+
+class SpatialGrid:
+    """Grid of square cells, each listing the indices of the boxes that overlap it
+
+    The built part of the grid is stored CSR style: the sorted keys of all occupied cells, the start of each cell's
+    run in `_cell_indices`, and the box indices themselves, sorted so the lowest index in a cell comes first.
+    Boxes added after the last build go on a short pending list that is checked directly. The grid is rebuilt in
+    one vectorized pass the next time it is queried after the pending list gets too long or a box is removed.
+
+    Indices match the container, so lookups return the lowest index box that contains the point, like the original
+    linear scan did.
+    """
+    def __init__(self, cell_size: int = 32, max_pending: int = 256):
+        self.cell_size = cell_size
+        self.max_pending = max_pending
+        self._boxes = np.empty((0, 4), dtype=np.int64)
+        self._count = 0
+        self._built = 0
+        self._dirty = False
+        self._keys = np.empty(0, dtype=np.int64)
+        self._starts = np.zeros(1, dtype=np.int64)
+        self._cell_indices = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return self._count
+
+    def build(self, boxes: Sequence[Sequence[int]]):
+        """Replace the whole index with the given boxes, index i being boxes[i]"""
+        self._boxes = np.array(boxes, dtype=np.int64).reshape(-1, 4)
+        self._count = len(self._boxes)
+        self._built = 0
+        self._dirty = True
+
+    def add(self, index: int, box: Sequence[int]):
+        assert index == self._count, f"Grid expects boxes in order, got {index} with {self._count} boxes"
+        if self._count == len(self._boxes):
+            grown = np.empty((max(16, 2 * len(self._boxes)), 4), dtype=np.int64)
+            grown[:self._count] = self._boxes[:self._count]
+            self._boxes = grown
+        self._boxes[self._count] = box
+        self._count += 1
+        if self._count - self._built > self.max_pending:
+            self._dirty = True
+
+    def add_many(self, index: int, boxes):
+        """Add boxes at index, index + 1, ... in one go"""
+        assert index == self._count, f"Grid expects boxes in order, got {index} with {self._count} boxes"
+        boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        if self._count + len(boxes) > len(self._boxes):
+            grown = np.empty((max(16, self._count + len(boxes), 2 * len(self._boxes)), 4), dtype=np.int64)
+            grown[:self._count] = self._boxes[:self._count]
+            self._boxes = grown
+        self._boxes[self._count:self._count + len(boxes)] = boxes
+        self._count += len(boxes)
+        if self._count - self._built > self.max_pending:
+            self._dirty = True
+
+    def truncate(self, count: int):
+        """Drop every box from index count up"""
+        self._count = count
+        self._built = min(self._built, count)
+        self._dirty = True
+
+    def remove(self, index: int):
+        """Drop a box. Higher indices shift down by one, same as deleting from the container list"""
+        self._boxes = np.delete(self._boxes[:self._count], index, axis=0)
+        self._count -= 1
+        self._dirty = True
+
+    def insert(self, index: int, box: Sequence[int]):
+        """Add a box at index. Indices from there up shift up by one, same as inserting into the container list"""
+        self._boxes = np.insert(self._boxes[:self._count], index, box, axis=0)
+        self._count += 1
+        self._dirty = True
+
+    def _ensure_built(self):
+        if not self._dirty:
+            return
+        cs = self.cell_size
+        boxes = self._boxes[:self._count]
+        x0 = boxes[:, 0] // cs
+        y0 = boxes[:, 1] // cs
+        nx = (boxes[:, 0] + boxes[:, 2]) // cs - x0 + 1
+        ny = (boxes[:, 1] + boxes[:, 3]) // cs - y0 + 1
+        counts = nx * ny
+
+        # One entry per (box, cell) pair it overlaps
+        owner = np.repeat(np.arange(self._count, dtype=np.int64), counts)
+        offset = np.arange(counts.sum(), dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+        cell_x = x0[owner] + offset % nx[owner]
+        cell_y = y0[owner] + offset // nx[owner]
+        keys = cell_y * _KEY_STRIDE + cell_x
+
+        order = np.lexsort((owner, keys))
+        keys = keys[order]
+        self._cell_indices = owner[order]
+        self._keys, starts = np.unique(keys, return_index=True)
+        self._starts = np.append(starts, len(keys)).astype(np.int64)
+        self._built = self._count
+        self._dirty = False
+
+    def _key(self, x_in, y_in):
+        return (y_in // self.cell_size) * _KEY_STRIDE + x_in // self.cell_size
+
+    def query_point(self, x_in: int, y_in: int) -> int:
+        """
+        Find the lowest index box containing a point
+        :return: Box index or -1 for Not Found
+        """
+        self._ensure_built()
+        key = self._key(int(x_in), int(y_in))
+        pos = int(np.searchsorted(self._keys, key))
+        if pos < len(self._keys) and self._keys[pos] == key:
+            candidates = self._cell_indices[self._starts[pos]:self._starts[pos + 1]]
+            hits = _contains(self._boxes[candidates], x_in, y_in)
+            if hits.any():
+                return int(candidates[hits.argmax()])
+        for index in range(self._built, self._count):
+            if _contains(self._boxes[index], x_in, y_in):
+                return index
+        return -1
+
+    def query_points(self, points) -> np.ndarray:
+        """
+        Batch version of query_point
+        :param points: Array like of shape (N, 2) holding x, y pairs
+        :return: Integer array of N box indices, -1 where no box contains the point
+        """
+        points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+        result = np.full(len(points), -1, dtype=np.int64)
+        if len(points) == 0 or self._count == 0:
+            return result
+        self._ensure_built()
+        px, py = points[:, 0], points[:, 1]
+
+        if len(self._keys):
+            keys = self._key(px, py)
+            pos = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+            found = self._keys[pos] == keys
+            begin = np.where(found, self._starts[pos], 0)
+            counts = np.where(found, self._starts[pos + 1] - begin, 0)
+
+            # Expand every point into one row per candidate box in its cell, then keep the lowest hit per point
+            point_id = np.repeat(np.arange(len(points)), counts)
+            offset = np.arange(counts.sum(), dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+            candidates = self._cell_indices[np.repeat(begin, counts) + offset]
+            hits = _contains(self._boxes[candidates], px[point_id], py[point_id])
+            best = np.full(len(points), self._count, dtype=np.int64)
+            np.minimum.at(best, point_id[hits], candidates[hits])
+            result[best < self._count] = best[best < self._count]
+
+        if self._built < self._count:
+            missing = np.flatnonzero(result < 0)
+            pending = self._boxes[self._built:self._count]
+            hits = _contains(pending[None, :, :], px[missing, None], py[missing, None])
+            found = hits.any(axis=1)
+            result[missing[found]] = self._built + hits[found].argmax(axis=1)
+        return result
+
+    def query_rect(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        """
+        Find every box overlapping a rectangle, edges included
+        :param x0, y0, x1, y1: Top left and bottom right corners of the rectangle
+        :return: Sorted array of box indices
+        """
+        self._ensure_built()
+        cs = self.cell_size
+        cell_x, cell_y = np.meshgrid(np.arange(x0 // cs, x1 // cs + 1), np.arange(y0 // cs, y1 // cs + 1))
+        keys = (cell_y * _KEY_STRIDE + cell_x).reshape(-1)
+        candidates = [np.arange(self._built, self._count, dtype=np.int64)]
+        if len(self._keys):
+            pos = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+            for found in pos[self._keys[pos] == keys].tolist():
+                candidates.append(self._cell_indices[self._starts[found]:self._starts[found + 1]])
+        candidates = np.unique(np.concatenate(candidates))
+        boxes = self._boxes[candidates]
+        overlap = ((boxes[:, 0] <= x1) & (x0 <= boxes[:, 0] + boxes[:, 2]) &
+                   (boxes[:, 1] <= y1) & (y0 <= boxes[:, 1] + boxes[:, 3]))
+        return candidates[overlap]
@@ -0,0 +1,163 @@
+"""SymbolLibrary
+
+The symbols grouped on one page, kept for grouping the next pages of the same script without starting over.
+
+For each group a few exemplar boxes are kept: their thumbnail descriptors (FeatureGrouping.box_descriptors), sizes and
+group id, in a small .npz file. Classifying a new page scores every box against every exemplar with one matrix product
+per batch of boxes. A box takes the group of its best exemplar of about its size, if that scores at least thresh_val.
+The boxes that match nothing are left ungrouped for the usual grouping, which only looks at ungrouped boxes, so only
+the symbols the library doesn't know get the full matching.
+
+    python SymbolLibrary.py build Inputs/DetBwMod.png settings.sym symbols.npz
+    python SymbolLibrary.py classify page2.png symbols.npz --out page2.sym
+"""
+from typing import Optional, Sequence
+
+import numpy as np
+
+from ContourContainer import ContourContainer
+from FeatureGrouping import box_descriptors
+from Matching import dilate_image
+
+
+class SymbolLibrary:
+    """Exemplar descriptors of known symbol groups
+
+    :param descriptors: (K, D) float32 unit descriptors, one per exemplar
+    :param sizes: (K, 2) width, height of each exemplar box
+    :param groups: (K,) group id of each exemplar
+    :param size: Columns, rows of the thumbnail descriptors
+    :param kernel_size: Dilation kernel the descriptors were made with
+    """
+    def __init__(self, descriptors: np.ndarray, sizes: np.ndarray, groups: np.ndarray,
+                 size: Sequence[int] = (8, 12), kernel_size: Sequence[int] = (2, 2)):
+        self.descriptors = np.asarray(descriptors, dtype=np.float32)
+        self.sizes = np.asarray(sizes, dtype=np.int32).reshape(-1, 2)
+        self.groups = np.asarray(groups, dtype=np.int32)
+        self.size = tuple(int(x) for x in size)
+        self.kernel_size = tuple(int(x) for x in kernel_size)
+
+    @property
+    def length(self):
+        return len(self.groups)
+
+    @classmethod
+    def build(cls, gray, contours: ContourContainer, exemplars: int = 4, size: Sequence[int] = (8, 12),
+              kernel_size: Sequence[int] = (2, 2), redundant: float = 0.95) -> 'SymbolLibrary':
+        """
+        Pick the exemplars of every group in a container
+        The first exemplar of a group is its most typical box, the one closest to the mean descriptor. Each next one
+        is the box least like the exemplars so far, so variants of a symbol get covered
+        :param exemplars: Most exemplars per group
+        :param redundant: Stop adding exemplars to a group once every box scores at least this against one
+        """
+        boxes = contours.get_box_array(all=True)
+        labels = contours.get_group_array()
+        descriptors = box_descriptors(dilate_image(gray, kernel_size), boxes, size)
+        chosen = []
+        order = np.argsort(labels, kind='stable')
+        group_ids, starts = np.unique(labels[order], return_index=True)
+        for group, members in zip(group_ids.tolist(), np.split(order, starts[1:])):
+            if group == 0:
+                continue
+            member_descriptors = descriptors[members]
+            picks = [int(np.argmax(member_descriptors @ member_descriptors.mean(axis=0)))]
+            best = member_descriptors @ member_descriptors[picks[0]]
+            while len(picks) < exemplars and best.min() < redundant:
+                pick = int(np.argmin(best))
+                picks.append(pick)
+                best = np.maximum(best, member_descriptors @ member_descriptors[pick])
+            chosen.extend(members[picks].tolist())
+        chosen = np.array(chosen, dtype=np.int64)
+        return cls(descriptors[chosen], boxes[chosen, 2:], labels[chosen], size, kernel_size)
+
+    def save(self, filename: str):
+        np.savez(filename, descriptors=self.descriptors, sizes=self.sizes, groups=self.groups,
+                 size=np.array(self.size), kernel_size=np.array(self.kernel_size))
+
+    @classmethod
+    def load(cls, filename: str) -> 'SymbolLibrary':
+        with np.load(filename, allow_pickle=False) as data:
+            return cls(data['descriptors'], data['sizes'], data['groups'], data['size'], data['kernel_size'])
+
+    def classify(self, gray, boxes, thresh_val: float = 0.7, size_tolerance: float = 0.25,
+                 batch_size: int = 4096) -> np.ndarray:
+        """
+        Known group of each box
+        :param boxes: (N, 4) array like of x, y, w, h boxes
+        :param size_tolerance: How far a box's width and height can be from the exemplar's, as a fraction of the
+            exemplar's, plus 1 pixel. The same as ContourContainer.get_indices_by_size
+        :param batch_size: Boxes scored at a time, bounding the score matrix to batch_size x exemplars
+        :return: (N,) int32 group ids, 0 for boxes that match no exemplar
+        """
+        boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        result = np.zeros(len(boxes), dtype=np.int32)
+        if self.length == 0 or len(boxes) == 0:
+            return result
+        descriptors = box_descriptors(dilate_image(gray, self.kernel_size), boxes, self.size)
+        slack = (size_tolerance * self.sizes).astype(np.int64) + 1
+        for start in range(0, len(boxes), batch_size):
+            stop = min(start + batch_size, len(boxes))
+            scores = descriptors[start:stop] @ self.descriptors.T
+            box_sizes = boxes[start:stop, None, 2:]
+            fits = (np.abs(box_sizes - self.sizes[None, :, :]) <= slack[None, :, :]).all(axis=2)
+            scores[~fits] = -np.inf
+            best = np.argmax(scores, axis=1)
+            matched = scores[np.arange(stop - start), best] >= thresh_val
+            result[start:stop][matched] = self.groups[best[matched]]
+        return result
+
+    def apply(self, gray, contours: ContourContainer, thresh_val: float = 0.7, size_tolerance: float = 0.25,
+              boxes: Optional[np.ndarray] = None) -> int:
+        """
+        Put the ungrouped contours the library recognises in their groups
+        :return: Number of contours grouped
+        """
+        ungrouped = np.flatnonzero(contours.get_group_array() == 0)
+        if boxes is None:
+            boxes = contours.get_box_array(all=True)
+        found = self.classify(gray, boxes[ungrouped], thresh_val, size_tolerance)
+        known = found != 0
+        contours.set_groups(ungrouped[known], found[known])
+        return int(known.sum())
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from AutoGrouper import AutoGrouper
+    from SymbolPipeline import get_contours, load_image, new_container
+
+    parser = argparse.ArgumentParser(description='Build a symbol library from a grouped page, or group a new page '
+                                                 'with one.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Build a library from an image and its session')
+    build_parser.add_argument('image', help='Black and white image, symbols in white')
+    build_parser.add_argument('session', help='Session file with the groups of the image')
+    build_parser.add_argument('library', help='Library file to write')
+    build_parser.add_argument('--exemplars', help='Most exemplars per group', type=int, default=4)
+    classify_parser = subparsers.add_parser('classify', help='Group a new image with a library')
+    classify_parser.add_argument('image', help='Black and white image, symbols in white')
+    classify_parser.add_argument('library', help='Library file')
+    classify_parser.add_argument('--out', help='Session file to write', default=None)
+    classify_parser.add_argument('--thresh', help='Match threshold', type=float, default=0.7)
+    classify_parser.add_argument('--size-tolerance', help='Only match boxes of about the same size', type=float,
+                                 default=0.25)
+    args = parser.parse_args()
+
+    _, gray = load_image(args.image)
+    contour_container = new_container(gray)
+    if args.command == 'build':
+        contour_container.load(args.session)
+        library = SymbolLibrary.build(gray, contour_container, exemplars=args.exemplars)
+        library.save(args.library)
+        print(f"{library.length} exemplars of {len(np.unique(library.groups))} groups saved to {args.library}")
+    else:
+        get_contours(gray, contour_container)
+        start = time.perf_counter()
+        known = SymbolLibrary.load(args.library).apply(gray, contour_container, args.thresh, args.size_tolerance)
+        print(f"{known} of {contour_container.length} contours recognised in {time.perf_counter() - start:.2f} s")
+        # Only the ungrouped ones are matched
+        print(AutoGrouper(thresh_val=args.thresh, size_tolerance=args.size_tolerance).run(gray, contour_container))
+        if args.out is not None:
+            contour_container.save(args.out)
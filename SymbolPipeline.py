@@ -0,0 +1,203 @@
+"""SymbolPipeline
+
+The MatchSymbols processing without the GUI: find the contours in a black and white image, group them automatically,
+and save the session. Nothing is read or created until it is asked for, so this is cheap to import.
+
+Run it directly to process a batch of images on a process pool, writing one session file per image:
+    python SymbolPipeline.py Inputs/ --out Sessions --workers 4
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
+
+import cv2
+import numpy as np
+
+from AutoGrouper import AutoGrouper
+from BatchFiles import find_images, init_batch_worker
+from ContourContainer import ArrayContourContainer, ContourContainer
+from DerivativeCache import DerivativeCache
+from FeatureGrouping import FeatureGrouper
+from SymbolLibrary import SymbolLibrary
+
+GROUPERS = {'template': AutoGrouper, 'feature': FeatureGrouper}
+
+
+def load_image(path: str):
+    """
+    Read an image and its grayscale version
+    :return: The BGR image and the single channel image
+    """
+    base_image = cv2.imread(path)
+    if base_image is None:
+        raise FileNotFoundError(f"Could not read image {path}")
+    return base_image, cv2.cvtColor(base_image, cv2.COLOR_BGR2GRAY)
+
+
+def contour_boxes(found_contours) -> np.ndarray:
+    """
+    Bounding box of every contour, the same as cv2.boundingRect on each, computed in one pass over all the points
+    :return: (N, 4) int32 array of x, y, w, h
+    """
+    if len(found_contours) == 0:
+        return np.empty((0, 4), dtype=np.int32)
+    lengths = np.fromiter((len(contour) for contour in found_contours), dtype=np.int64, count=len(found_contours))
+    points = np.concatenate(found_contours).reshape(-1, 2)
+    starts = np.cumsum(lengths) - lengths
+    low = np.minimum.reduceat(points, starts, axis=0)
+    high = np.maximum.reduceat(points, starts, axis=0)
+    return np.hstack((low, high - low + 1)).astype(np.int32)
+
+
+def find_boxes(gray, dilate: bool = False, components: bool = False) -> np.ndarray:
+    """
+    Find the symbols in a black and white image
+    :param components: Use connected components instead of contours. Faster, but unlike the external contours it also
+        finds blobs inside the holes of other blobs, and orders them top to bottom
+    :return: (N, 4) int32 array of x, y, w, h, before the container's size filter
+    """
+    if dilate:
+        # each word instead of a sentence.
+        rect_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 4))
+
+        # Applying dilation on the threshold image
+        # Warning! Not clear if this assignment will modify the original image!
+        gray = cv2.dilate(gray, rect_kernel, iterations=1)
+
+    # converting to Greyscale and thresholding should have already been done
+    if components:
+        _, _, stats, _ = cv2.connectedComponentsWithStats(gray, connectivity=8)
+        # Label 0 is the background
+        return np.ascontiguousarray(stats[1:, :4], dtype=np.int32)
+    # Find contours in the thresholded image
+    found_contours, _ = cv2.findContours(gray, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return contour_boxes(found_contours)
+
+
+def get_contours(gray, contours: ContourContainer, dilate: bool = False, components: bool = False):
+    """
+    Find the symbols in a black and white image and add their boxes to the container
+    :param components: See find_boxes
+    """
+    # The size filter and indexing are done for all the boxes at once
+    contours.add_many(find_boxes(gray, dilate, components))
+
+
+def new_container(gray) -> ArrayContourContainer:
+    """Empty container sized to the image, with the minimum box size MatchSymbols uses"""
+    return ArrayContourContainer(width=gray.shape[1], height=gray.shape[0], min_width=2, min_height=2)
+
+
+@dataclass
+class PipelineResult:
+    image: str
+    session: Optional[str]
+    contours: int
+    groups: int
+    seconds: float
+
+    def __str__(self):
+        return (f"{self.image}: {self.contours} contours in {self.groups} groups, {self.seconds:.2f} s"
+                f"{f' -> {self.session}' if self.session else ''}")
+
+
+def process_image(image_path: str, session_path: Optional[str] = None, grouper: str = 'template',
+                  thresh_val: float = 0.7, size_tolerance: Optional[float] = None, workers: int = 1,
+                  library: Optional[str] = None, cache_dir: Optional[str] = None) -> PipelineResult:
+    """
+    Find and group the symbols in one image
+    :param image_path: Black and white image, symbols in white
+    :param session_path: Where to save the session, or None to not save it
+    :param grouper: 'template' for AutoGrouper matching, 'feature' for the FeatureGrouper thumbnails
+    :param thresh_val: Match threshold
+    :param size_tolerance: Only match boxes within this fraction of the template size. None matches templates over
+        the whole image, and leaves the library and feature grouper at their own tolerance
+    :param workers: Threads for template matching within this image
+    :param library: SymbolLibrary file. The symbols it knows are put in its groups first, and only the rest are matched
+    :param cache_dir: DerivativeCache directory, to reuse the decoded image, contours and dilated image of images seen
+        before
+    """
+    start = time.perf_counter()
+    derivatives = None
+    if cache_dir is None:
+        _, gray = load_image(image_path)
+        contour_container = new_container(gray)
+        get_contours(gray, contour_container)
+    else:
+        derivatives = DerivativeCache(cache_dir)
+        _, gray, source_hash = derivatives.load_image(image_path)
+        contour_container = new_container(gray)
+        contour_container.add_many(derivatives.contour_boxes(source_hash, gray))
+    tolerance = {} if size_tolerance is None else {'size_tolerance': size_tolerance}
+    if library is not None:
+        SymbolLibrary.load(library).apply(gray, contour_container, thresh_val, **tolerance)
+    if grouper == 'template':
+        auto_grouper = AutoGrouper(thresh_val=thresh_val, workers=workers, size_tolerance=size_tolerance)
+        image = None if derivatives is None else derivatives.dilated(source_hash, gray, auto_grouper.kernel_size)
+        auto_grouper.run(gray, contour_container, image)
+    else:
+        GROUPERS[grouper](thresh_val=thresh_val, **tolerance).run(gray, contour_container)
+    if session_path is not None:
+        contour_container.save(session_path)
+    groups = contour_container.get_group_array()
+    return PipelineResult(image=image_path, session=session_path, contours=contour_container.length,
+                          groups=len(set(groups[groups != 0].tolist())), seconds=time.perf_counter() - start)
+
+
+def session_path_for(image_path: str, out_dir: str) -> str:
+    return os.path.join(out_dir, os.path.splitext(os.path.basename(image_path))[0] + '.sym')
+
+
+def _process_one(job):
+    image_path, session_path, kwargs = job
+    return process_image(image_path, session_path, **kwargs)
+
+
+def run_batch(paths: Iterable[str], out_dir: Optional[str], workers: Optional[int] = None,
+              **kwargs) -> Iterator[PipelineResult]:
+    """
+    Process many images on a process pool, one image per task
+    :param paths: Images, or directories of images
+    :param out_dir: Directory for the session files, named after each image. None to not save
+    :param workers: Number of processes, defaults to one per CPU
+    :param kwargs: Passed on to process_image
+    :return: Results in the same order as the images
+    """
+    images = find_images(paths)
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+    jobs = [(image, None if out_dir is None else session_path_for(image, out_dir), kwargs) for image in images]
+    workers = min(workers or os.cpu_count() or 1, max(len(jobs), 1))
+    if workers == 1:
+        yield from map(_process_one, jobs)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker) as pool:
+        yield from pool.map(_process_one, jobs)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Find and group the symbols in a batch of images, without the GUI.')
+    parser.add_argument('paths', help='Images, or directories of images', nargs='+')
+    parser.add_argument('--out', help='Directory for the session files', default='Sessions')
+    parser.add_argument('--workers', help='Number of processes, defaults to one per CPU', type=int, default=None)
+    parser.add_argument('--grouper', help='Grouping method', choices=sorted(GROUPERS), default='template')
+    parser.add_argument('--thresh', help='Match threshold', type=float, default=0.7)
+    parser.add_argument('--size-tolerance', help='Only match boxes of about the same size, instead of over the whole '
+                        'image', type=float, default=None)
+    parser.add_argument('--library', help='SymbolLibrary file to group the known symbols with first', default=None)
+    parser.add_argument('--cache', help='DerivativeCache directory, to skip decoding and contour finding for images '
+                                        'seen before', default=None)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    count = 0
+    for result in run_batch(args.paths, args.out, workers=args.workers, grouper=args.grouper,
+                            thresh_val=args.thresh, size_tolerance=args.size_tolerance, library=args.library,
+                            cache_dir=args.cache):
+        print(result)
+        count += 1
+    print(f"Processed {count} images in {time.perf_counter() - start:.2f} s")
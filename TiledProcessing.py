@@ -0,0 +1,231 @@
+"""TiledProcessing
+
+Contour detection and template matching for images too big to handle in one piece. The image is split into tiles,
+each read with an overlap into its neighbours, which are processed concurrently on a thread pool (OpenCV releases the
+GIL in findContours, dilate and matchTemplate). The results are merged, dropping the duplicates found where tiles
+overlap.
+
+Images can be read from a .npy file, memory mapped, so only the tiles being worked on are ever in memory. Make one
+from a PNG with convert, then run contours or match on it:
+    python TiledProcessing.py convert scan.png scan.npy
+    python TiledProcessing.py contours scan.npy --tile 2048 --workers 8
+    python TiledProcessing.py match scan.npy --rect 310 483 16 24
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from ContourContainer import ContourContainer
+from Matching import dilate_image, peaks_from_scores
+from SymbolPipeline import contour_boxes
+
+# Tile as (left, top, right, bottom), right and bottom exclusive
+Rect = Tuple[int, int, int, int]
+
+
+def open_image(path: str) -> np.ndarray:
+    """
+    Open a single channel image. A .npy file is memory mapped, anything else is read whole with OpenCV
+    :return: 2D uint8 array, which may be a read-only memory map
+    """
+    if path.endswith('.npy'):
+        image = np.load(path, mmap_mode='r')
+        assert image.ndim == 2 and image.dtype == np.uint8, f"{path} is not a single channel 8 bit image"
+        return image
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise FileNotFoundError(f"Could not read image {path}")
+    return image
+
+
+def convert_to_npy(source: str, destination: str):
+    """Save an image as a grayscale .npy file that open_image can memory map"""
+    image = open_image(source)
+    out = np.lib.format.open_memmap(destination, mode='w+', dtype=np.uint8, shape=image.shape)
+    out[:] = image
+    out.flush()
+
+
+def split_tiles(shape: Sequence[int], tile_size: int, overlap: int) -> List[Tuple[Rect, Rect]]:
+    """
+    Cover an image with tiles
+    :return: List of (core, padded) rects. The cores cover the image without overlapping, each padded rect is its
+        core grown by overlap on every side, clipped to the image
+    """
+    height, width = shape[:2]
+    tiles = []
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            core = (left, top, min(left + tile_size, width), min(top + tile_size, height))
+            padded = (max(left - overlap, 0), max(top - overlap, 0),
+                      min(core[2] + overlap, width), min(core[3] + overlap, height))
+            tiles.append((core, padded))
+    return tiles
+
+
+def _region_boxes(image, region: Rect, dilate_kernel: Optional[np.ndarray], margin: int) -> np.ndarray:
+    """Contour boxes of part of the image, in image coordinates. Dilation reads margin extra pixels on each side"""
+    left, top, right, bottom = region
+    height, width = image.shape[:2]
+    read = (max(left - margin, 0), max(top - margin, 0), min(right + margin, width), min(bottom + margin, height))
+    pixels = np.ascontiguousarray(image[read[1]:read[3], read[0]:read[2]])
+    if dilate_kernel is not None:
+        pixels = cv2.dilate(pixels, dilate_kernel, iterations=1)
+    pixels = pixels[top - read[1]:bottom - read[1], left - read[0]:right - read[0]]
+    found_contours, _ = cv2.findContours(pixels, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = contour_boxes(found_contours)
+    boxes[:, 0] += left
+    boxes[:, 1] += top
+    return boxes
+
+
+def _touches_edge(boxes: np.ndarray, region: Rect, shape: Sequence[int]) -> np.ndarray:
+    """Boxes reaching an edge of region that is not also an edge of the image, so they may have been cut off"""
+    left, top, right, bottom = region
+    height, width = shape[:2]
+    return (((boxes[:, 0] == left) & (left > 0)) | ((boxes[:, 1] == top) & (top > 0)) |
+            ((boxes[:, 0] + boxes[:, 2] == right) & (right < width)) |
+            ((boxes[:, 1] + boxes[:, 3] == bottom) & (bottom < height)))
+
+
+def _tile_boxes(image, core: Rect, padded: Rect, dilate_kernel, margin: int):
+    """
+    Boxes found in one tile
+    :return: The complete boxes whose top left corner is in the core, and the boxes cut off by the tile edge
+    """
+    boxes = _region_boxes(image, padded, dilate_kernel, margin)
+    cut = _touches_edge(boxes, padded, image.shape)
+    owned = ((core[0] <= boxes[:, 0]) & (boxes[:, 0] < core[2]) & (core[1] <= boxes[:, 1]) & (boxes[:, 1] < core[3]))
+    return boxes[owned & ~cut], boxes[cut]
+
+
+def _whole_box(image, box: np.ndarray, dilate_kernel, margin: int) -> np.ndarray:
+    """Grow the region around a cut off piece of a blob until the blob fits in it, and return the blob's box"""
+    height, width = image.shape[:2]
+    x, y, w, h = box.tolist()
+    grow = max(w, h)
+    while True:
+        region = (max(x - grow, 0), max(y - grow, 0), min(x + w + grow, width), min(y + h + grow, height))
+        boxes = _region_boxes(image, region, dilate_kernel, margin)
+        # The piece is part of exactly one blob in the region, the one whose box covers it
+        inside = boxes[(boxes[:, 0] <= x) & (boxes[:, 1] <= y) & (boxes[:, 0] + boxes[:, 2] >= x + w) &
+                       (boxes[:, 1] + boxes[:, 3] >= y + h)]
+        whole = inside[np.argmax(inside[:, 2] * inside[:, 3])]
+        if not _touches_edge(whole[None, :], region, image.shape)[0]:
+            return whole
+        x, y, w, h = whole.tolist()
+        grow *= 2
+
+
+def tiled_contour_boxes(image, tile_size: int = 2048, overlap: int = 64, workers: Optional[int] = None,
+                        dilate: bool = False) -> np.ndarray:
+    """
+    The boxes get_contours would find, worked out tile by tile
+    Blobs up to overlap pixels across are found whole in the tile their top left corner is in. Bigger ones are cut off
+    by every tile edge they cross, so the pieces are looked at again in a region grown until the whole blob fits.
+    :param image: Single channel image, may be a memory map
+    :param dilate: Dilate first, same as get_contours
+    :return: (N, 4) int32 array of x, y, w, h, sorted top to bottom then left to right
+    """
+    dilate_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 4)) if dilate else None
+    margin = 4 if dilate else 0
+    tiles = split_tiles(image.shape, tile_size, overlap)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        results = list(pool.map(lambda tile: _tile_boxes(image, tile[0], tile[1], dilate_kernel, margin), tiles))
+        owned = [boxes for boxes, _ in results]
+        cut = np.concatenate([pieces for _, pieces in results] + [np.empty((0, 4), dtype=np.int32)])
+        if len(cut):
+            # Pieces of the same blob all grow into the same box, so only distinct results are kept
+            owned.append(np.array(list(pool.map(lambda box: _whole_box(image, box, dilate_kernel, margin), cut)),
+                                  dtype=np.int32).reshape(-1, 4))
+    boxes = np.unique(np.concatenate(owned), axis=0)
+    return boxes[np.lexsort((boxes[:, 0], boxes[:, 1]))]
+
+
+def get_contours_tiled(image, contours: ContourContainer, tile_size: int = 2048, overlap: int = 64,
+                       workers: Optional[int] = None, dilate: bool = False):
+    """Tiled version of get_contours. See tiled_contour_boxes"""
+    contours.add_many(tiled_contour_boxes(image, tile_size, overlap, workers, dilate))
+
+
+def _tile_peaks(image, template, core: Rect, thresh_val: float, kernel_size) -> np.ndarray:
+    """Match peaks whose template position is in the core of the tile"""
+    height, width = image.shape[:2]
+    template_h, template_w = template.shape[:2]
+    pad_y, pad_x = template_h // 2, template_w // 2
+    # Score the core positions plus half a template around them, so peaks at the core edge see all their neighbours
+    left, top = max(core[0] - pad_x, 0), max(core[1] - pad_y, 0)
+    right = min(core[2] + pad_x + template_w - 1, width)
+    bottom = min(core[3] + pad_y + template_h - 1, height)
+    margin = max(kernel_size) if kernel_size is not None else 0
+    read = (max(left - margin, 0), max(top - margin, 0), min(right + margin, width), min(bottom + margin, height))
+    pixels = np.ascontiguousarray(image[read[1]:read[3], read[0]:read[2]])
+    if kernel_size is not None:
+        pixels = dilate_image(pixels, kernel_size)
+    pixels = pixels[top - read[1]:bottom - read[1], left - read[0]:right - read[0]]
+    if pixels.shape[0] < template_h or pixels.shape[1] < template_w:
+        return np.empty((0, 2), dtype=np.int64)
+
+    scores = cv2.matchTemplate(pixels, template, cv2.TM_CCOEFF_NORMED)
+    centers = peaks_from_scores(scores, pixels.shape, thresh_val) + (left, top)
+    position_x, position_y = centers[:, 0] - template_w // 2, centers[:, 1] - template_h // 2
+    keep = (core[0] <= position_x) & (position_x < core[2]) & (core[1] <= position_y) & (position_y < core[3])
+    return centers[keep]
+
+
+def tiled_match_peaks(image, rect: Sequence[int], thresh_val: float, tile_size: int = 2048,
+                      workers: Optional[int] = None, kernel_size: Optional[Sequence[int]] = (2, 2)) -> np.ndarray:
+    """
+    match_peaks on the dilated image, worked out tile by tile without dilating or scoring the whole image at once.
+    Gives the same peaks, except that a flat topped peak lying across two tiles can come out once in each
+    :param kernel_size: Dilation kernel, None to not dilate
+    :return: (N, 2) array of the x, y centers of the matches, sorted top to bottom then left to right
+    """
+    x, y, w, h = rect
+    height, width = image.shape[:2]
+    margin = max(kernel_size) if kernel_size is not None else 0
+    read = (max(x - margin, 0), max(y - margin, 0), min(x + w + margin, width), min(y + h + margin, height))
+    template = np.ascontiguousarray(image[read[1]:read[3], read[0]:read[2]])
+    if kernel_size is not None:
+        template = dilate_image(template, kernel_size)
+    template = np.ascontiguousarray(template[y - read[1]:y + h - read[1], x - read[0]:x + w - read[0]])
+
+    cores = [core for core, _ in split_tiles(image.shape, tile_size, 0)]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        peaks = list(pool.map(lambda core: _tile_peaks(image, template, core, thresh_val, kernel_size), cores))
+    peaks = np.concatenate(peaks + [np.empty((0, 2), dtype=np.int64)])
+    return peaks[np.lexsort((peaks[:, 0], peaks[:, 1]))]
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from SymbolPipeline import new_container
+
+    parser = argparse.ArgumentParser(description='Contour detection and template matching on large images in tiles.')
+    parser.add_argument('command', choices=('convert', 'contours', 'match'))
+    parser.add_argument('image', help='Black and white image, symbols in white. Use a .npy to memory map it')
+    parser.add_argument('output', help='For convert, the .npy file to write', nargs='?')
+    parser.add_argument('--tile', help='Tile size in pixels', type=int, default=2048)
+    parser.add_argument('--overlap', help='Tile overlap for contours, the size of the biggest symbol', type=int,
+                        default=64)
+    parser.add_argument('--workers', help='Threads, defaults to one per CPU', type=int, default=None)
+    parser.add_argument('--rect', help='Template x y w h for match', type=int, nargs=4)
+    parser.add_argument('--thresh', help='Match threshold', type=float, default=0.7)
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        convert_to_npy(args.image, args.output)
+    else:
+        gray = open_image(args.image)
+        start = time.perf_counter()
+        if args.command == 'contours':
+            contour_container = new_container(gray)
+            get_contours_tiled(gray, contour_container, args.tile, args.overlap, args.workers)
+            print(f"{contour_container.length} contours in {time.perf_counter() - start:.2f} s")
+        else:
+            peaks = tiled_match_peaks(gray, args.rect, args.thresh, args.tile, args.workers)
+            print(f"{len(peaks)} matches in {time.perf_counter() - start:.2f} s")
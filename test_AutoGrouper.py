@@ -0,0 +1,54 @@
+import cv2
+import numpy as np
+import pytest
+
+from AutoGrouper import AutoGrouper
+from Benchmark import filled_container, make_sheet
+from DerivativeCache import DerivativeCache
+from FeatureGrouping import rand_index
+from Matching import dilate_image
+from SymbolPipeline import process_image
+
+
+def groups_of(sheet, grouper: AutoGrouper) -> np.ndarray:
+    contours = filled_container(sheet)
+    grouper.run(sheet.gray, contours)
+    return contours.get_group_array()
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_size_mode_matches_whole_image_on_same_size_symbols(seed):
+    # With every box the same size, the size buckets hold every box a template could match, so the groups are the same
+    sheet = make_sheet(400, alphabet=12, seed=seed, glyph_size=(12, 16))
+    whole = groups_of(sheet, AutoGrouper(workers=1))
+    by_size = groups_of(sheet, AutoGrouper(workers=1, size_tolerance=0.25))
+    assert len(np.unique(whole)) > 1
+    assert rand_index(whole, by_size) == 1.0
+
+
+def test_size_mode_differs_on_mixed_sizes():
+    # A small template matches inside larger symbols over the whole image, but never with size buckets. This is why
+    # size buckets are opt-in, see AutoGrouper.py --compare for the same check on a real sheet
+    sheet = make_sheet(400, seed=0)
+    whole = groups_of(sheet, AutoGrouper(workers=1))
+    by_size = groups_of(sheet, AutoGrouper(workers=1, size_tolerance=0.25))
+    assert len(np.unique(by_size)) > len(np.unique(whole))
+    assert rand_index(whole, by_size) < 1.0
+
+
+def test_given_dilated_image():
+    sheet = make_sheet(200, seed=2)
+    contours = filled_container(sheet)
+    AutoGrouper(workers=1).run(sheet.gray, contours, dilate_image(sheet.gray))
+    assert rand_index(groups_of(sheet, AutoGrouper(workers=1)), contours.get_group_array()) == 1.0
+
+
+def test_pipeline_caches_dilated_image(tmp_path):
+    image_path = str(tmp_path / 'sheet.png')
+    cv2.imwrite(image_path, make_sheet(100, seed=3).gray)
+    cache_dir = str(tmp_path / 'cache')
+    first = process_image(image_path, cache_dir=cache_dir)
+    derivatives = DerivativeCache(cache_dir)
+    _, gray, source_hash = derivatives.load_image(image_path)
+    assert derivatives.load(DerivativeCache.key(source_hash, 'dilated', kernel_size=[2, 2])) is not None
+    assert process_image(image_path, cache_dir=cache_dir).groups == first.groups
@@ -0,0 +1,36 @@
+import pytest
+
+from ContourContainer import ArrayContourContainer, ContourContainer
+from DisjointGroups import MAX_GROUP, DisjointGroups
+
+CONTAINERS = [ContourContainer, ArrayContourContainer]
+
+
+def test_merge_without_members_keeps_no_ids():
+    groups = DisjointGroups()
+    groups.merge(39, 5)
+    assert groups.max_group == 0
+    assert not groups.known(39) and not groups.known(5)
+
+
+@pytest.mark.parametrize('container', CONTAINERS)
+def test_merge_with_empty_group(container):
+    contours = container()
+    contours.add(rect=[1, 1, 5, 5], group=3)
+    assert contours.merge_groups(39, 3) == 3
+    assert contours.max_group == 3
+    assert contours.get_group_indices(3).tolist() == [0]
+    assert contours.get_group_indices(39).tolist() == []
+
+
+@pytest.mark.parametrize('container', CONTAINERS)
+def test_large_group_ids(container):
+    contours = container()
+    contours.add(rect=[1, 1, 5, 5], group=MAX_GROUP)
+    contours.add(rect=[10, 1, 5, 5], group=7)
+    assert contours.merge_groups(7, MAX_GROUP) in (7, MAX_GROUP)
+    assert contours.get_group(index=0) == contours.get_group(index=1)
+    with pytest.raises(ValueError):
+        contours.set_group(MAX_GROUP + 1, index=0)
+    with pytest.raises(ValueError):
+        contours.set_group(-1, index=0)
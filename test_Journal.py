@@ -0,0 +1,183 @@
+"""Randomized check of the journal: every undo and redo gets back the exact earlier state, and so does recovering"""
+import random
+
+import numpy as np
+import pytest
+
+from ContourContainer import ArrayContourContainer, ContourContainer
+from Journal import OperationJournal
+
+CONTAINERS = [ContourContainer, ArrayContourContainer]
+
+
+def state(contours: ContourContainer):
+    """Everything undo has to put back, including how the group ids are merged"""
+    # Every id random_op uses, and a few past the largest
+    labels = range(max(31, contours.max_group + 3))
+    return (contours.get_box_array(all=True).tolist(), [contours.get_group(index=i) for i in range(contours.length)],
+            [contours.get_active(i) for i in range(contours.length)], contours.max_group,
+            {label: contours.get_group_indices(label).tolist() for label in labels})
+
+
+def visible(contours: ContourContainer):
+    return (contours.get_box_array(all=True).tolist(), contours.get_group_array().tolist(),
+            [contours.get_active(i) for i in range(contours.length)], contours.max_group)
+
+
+def distinct(states: list) -> list:
+    """Drop the states equal to the one before, for the changes that left nothing to undo"""
+    return [item for i, item in enumerate(states) if i == 0 or item != states[i - 1]]
+
+
+def undo_all(journal: OperationJournal, contours: ContourContainer) -> list:
+    """Undo everything, returning the state before and after each step"""
+    states = [state(contours)]
+    while journal.undo():
+        states.append(state(contours))
+    return states
+
+
+def redo_all(journal: OperationJournal, contours: ContourContainer) -> list:
+    states = [state(contours)]
+    while journal.redo():
+        states.append(state(contours))
+    return states
+
+
+def quiet(journal: OperationJournal):
+    """Wait for the compaction in progress, and don't start another, so what is on disk stays put"""
+    journal.compact(wait=True)
+    journal.compact_every = 10 ** 9
+
+
+def random_box(rng: random.Random, min_size: int = 1):
+    return [rng.randrange(300), rng.randrange(300), rng.randrange(min_size, 30), rng.randrange(min_size, 30)]
+
+
+def random_op(contours: ContourContainer, rng: random.Random):
+    count = contours.length
+    r = rng.random()
+    if r < 0.15 or count < 5:
+        contours.add(rect=random_box(rng), group=rng.choice([0, 0, rng.randrange(1, 20)]))
+    elif r < 0.25:
+        contours.remove(rng.randrange(count))
+    elif r < 0.45:
+        group = rng.choice([0, contours.max_group + 1, contours.get_group(index=rng.randrange(count)),
+                            rng.randrange(1, 30)])
+        contours.set_group(group, index=rng.randrange(count))
+    elif r < 0.6:
+        contours.merge_groups(rng.randrange(1, 30), rng.randrange(1, 30))
+    elif r < 0.7:
+        contours.select_boxes(group=contours.get_group(index=rng.randrange(count)))
+    elif r < 0.8:
+        contours.unselect_boxes(all=True)
+    elif r < 0.9:
+        contours.select_boxes(index=rng.randrange(count))
+    elif r < 0.92:
+        contours.set_group(rng.randrange(3), all=True)
+    elif r < 0.95:
+        indices = [rng.randrange(count) for _ in range(rng.randrange(1, 6))]
+        contours.set_groups(indices, [rng.choice([0, contours.max_group + 1, rng.randrange(1, 30)])
+                                      for _ in indices])
+    else:
+        contours.unselect_boxes(index=rng.randrange(count))
+
+
+@pytest.mark.parametrize('container', CONTAINERS)
+@pytest.mark.parametrize('seed', range(20))
+def test_undo_redo_recover(container, seed, tmp_path):
+    rng = random.Random(seed)
+    base_path = str(tmp_path / 'image.autosave')
+    contours = container(min_width=2, min_height=2)
+    for _ in range(20):
+        contours.add(rect=random_box(rng, 2))
+    journal = OperationJournal(contours, base_path, compact_every=rng.choice([5, 40, 1000]), max_undo=1000)
+    journal.start()
+
+    states = [state(contours)]
+    for _ in range(120):
+        if rng.random() < 0.3:
+            with journal.action():
+                for _ in range(rng.randrange(1, 5)):
+                    random_op(contours, rng)
+        else:
+            random_op(contours, rng)
+        states.append(state(contours))
+
+    # Every undo steps back exactly one change, to the first state, and redo goes forward through the same ones
+    undone = undo_all(journal, contours)
+    assert not journal.undo()
+    assert undone[-1] == states[0]
+    assert distinct(undone) == distinct(states)[::-1]
+    redone = redo_all(journal, contours)
+    assert not journal.redo()
+    assert distinct(redone) == distinct(states)
+    assert len(redone) == len(undone)
+
+    if seed % 2:
+        journal.compact(wait=True)
+    for _ in range(10):
+        random_op(contours, rng)
+    quiet(journal)
+    for _ in range(4):
+        journal.undo()
+    for _ in range(5):
+        random_op(contours, rng)
+
+    # A crash, the journal is never closed. Recovering replays the operations after the snapshot
+    recovered = container(min_width=2, min_height=2)
+    recovered_journal = OperationJournal(recovered, base_path)
+    recovered_journal.recover()
+    assert state(recovered) == state(contours)
+
+    for _ in range(20):
+        random_op(recovered, rng)
+    recovered_journal.close(keep=True)
+    kept = container()
+    OperationJournal(kept, base_path).recover()
+    assert visible(kept) == visible(recovered)
+
+
+@pytest.mark.parametrize('container', CONTAINERS)
+def test_add_many(container, tmp_path):
+    rng = random.Random(5)
+    base_path = str(tmp_path / 'image.autosave')
+    contours = container(min_width=2, min_height=2)
+    contours.add_many(np.array([[1, 1, 5, 5], [3, 3, 1, 9], [10, 10, 4, 4]]))
+    journal = OperationJournal(contours, base_path, compact_every=7)
+    journal.start()
+
+    states = [state(contours)]
+    for _ in range(60):
+        if rng.random() < 0.2:
+            boxes = np.array([[rng.randrange(300), rng.randrange(300), rng.randrange(1, 9), rng.randrange(1, 9)]
+                              for _ in range(rng.randrange(1, 6))])
+            contours.add_many(boxes, group=rng.choice([0, rng.randrange(1, 30)]))
+        else:
+            random_op(contours, rng)
+        states.append(state(contours))
+
+    quiet(journal)
+    undone = undo_all(journal, contours)
+    assert distinct(undone) == distinct(states)[::-1]
+    redone = redo_all(journal, contours)
+    assert redone[-1] == states[-1]
+
+    recovered = container()
+    OperationJournal(recovered, base_path).recover()
+    assert state(recovered) == states[-1]
+
+
+@pytest.mark.parametrize('container', CONTAINERS)
+def test_close_deletes_autosave(container, tmp_path):
+    base_path = str(tmp_path / 'image.autosave')
+    contours = container()
+    contours.add(rect=[1, 1, 5, 5])
+    journal = OperationJournal(contours, base_path, compact_every=1)
+    journal.start()
+    contours.set_group(1, index=0)
+    assert journal.exists()
+
+    journal.close()
+    assert not journal.exists()
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from Benchmark import make_sheet
+from Matching import dilate_image, match_peaks, match_pyramid
+
+SHEETS = {'mixed': dict(), 'same_size': dict(glyph_size=(20, 28))}
+
+
+def unmatched(points: np.ndarray, others: np.ndarray) -> int:
+    """Number of points with no point of others within a pixel, ties in the scores can move a peak by one"""
+    if len(others) == 0:
+        return len(points)
+    distance = np.abs(points[:, None, :] - others[None, :, :]).max(axis=2)
+    return int((distance.min(axis=1) > 1).sum())
+
+
+def compare(sheet_kind: str, levels: int, **slack):
+    sheet = make_sheet(300, alphabet=12, seed=1, **SHEETS[sheet_kind])
+    image = dilate_image(sheet.gray)
+    missing = extra = total = 0
+    # One template per glyph
+    _, firsts = np.unique(sheet.labels, return_index=True)
+    for rect in sheet.boxes[firsts].tolist():
+        single = match_peaks(image, rect, 0.7)
+        pyramid = match_pyramid(image, rect, 0.7, levels, **slack)
+        missing += unmatched(single, pyramid)
+        extra += unmatched(pyramid, single)
+        total += len(single)
+    return missing, extra, total
+
+
+@pytest.mark.parametrize('sheet_kind', sorted(SHEETS))
+@pytest.mark.parametrize('levels', [1, 2, 3])
+def test_pyramid_refining_everything_is_single_scale(sheet_kind, levels):
+    # See Matching.pyramid_scores, with this much slack every location is refined
+    assert compare(sheet_kind, levels, coarse_slack=1.7)[:2] == (0, 0)
+
+
+@pytest.mark.parametrize('levels', [1, 2, 3])
+def test_pyramid_default_slack(levels):
+    # Symbols of different shapes stand out at the coarse level too, so the default slack loses nothing
+    missing, extra, total = compare('mixed', levels)
+    assert total > 300
+    assert (missing, extra) == (0, 0)
+
+
+@pytest.mark.parametrize('levels', [2, 3])
+def test_pyramid_thin_strokes(levels):
+    # The 1 pixel strokes of these glyphs blur out once the image is shrunk 4 times, so at the default slack even
+    # some exact copies are lost. A few percent of the matches at most, and none with more slack
+    missing, extra, total = compare('same_size', levels)
+    assert extra == 0
+    assert 0 < missing <= 0.05 * total
+    assert compare('same_size', levels, coarse_slack=0.5)[:2] == (0, 0)